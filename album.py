@@ -0,0 +1,63 @@
+import config
+import asyncio
+import time
+
+# Telegram delivers an album as separate updates that share a media_group_id.
+# The first update registers the group when it arrives (before it waits for the user's
+# turn in UserOrderedUpdateProcessor); the album's other photos then join the group
+# without waiting for that turn. Once the first update has the turn, it waits out the
+# rest of the collection window and processes the whole group, still holding the turn:
+# a photo or button press sent after the album waits until the album is processed.
+
+_groups = {}   # media_group_id -> {'owner': Update, 'opened': monotonic time, 'updates': [...]}
+
+def _group_id(update):
+    message = getattr(update, 'message', None)
+    return message.media_group_id if message else None
+
+def is_open(update):
+    """
+    True if the update is a photo of an album whose group is already registered.
+    """
+    group_id = _group_id(update)
+    return bool(group_id and group_id in _groups)
+
+def register(update):
+    """
+    Registers the group of an album's first photo as soon as it arrives.
+    """
+    group_id = _group_id(update)
+    if group_id and group_id not in _groups:
+        _groups[group_id] = {'owner': update, 'opened': time.monotonic(), 'updates': []}
+
+def discard(update):
+    """
+    Drops the group `update` registered if its handler never collected it
+    (e.g. the update was ignored). Called once the update is done.
+    """
+    group_id = _group_id(update)
+    group = _groups.get(group_id) if group_id else None
+    if group is not None and group['owner'] is update:
+        del _groups[group_id]
+
+async def collect(update, context, process):
+    """
+    Adds an album photo to its group. The update that registered the group waits out
+    the window and then runs `process(updates, context)` once for the whole group.
+    """
+    group_id = update.message.media_group_id
+    group = _groups.get(group_id)
+    if group is None:
+        register(update) # Not dispatched through UserOrderedUpdateProcessor
+        group = _groups[group_id]
+    group['updates'].append(update)
+    if group['owner'] is not update:
+        return
+
+    try:
+        # Photos that arrived while this update waited for its turn are already in
+        await asyncio.sleep(max(0.0, group['opened'] + config.ALBUM_WINDOW - time.monotonic()))
+    finally:
+        del _groups[group_id]
+    updates = sorted(group['updates'], key=lambda u: u.message.message_id)
+    await process(updates, context)
@@ -0,0 +1,85 @@
+import config
+import asyncio
+
+import state_backend
+
+# In-memory set of banned user ids, checked at the webhook before an update is
+# deserialized or dispatched, so a banned user's traffic costs one dict lookup.
+# The shared state backend is the only source, so bans and unbans made on any worker
+# are picked up (re-read every BAN_INDEX_REFRESH seconds).
+
+_banned = set()
+_refresh_task = None
+_stats = {'dropped': 0}
+
+def is_banned(user_id):
+    return user_id in _banned
+
+def add(user_id):
+    _banned.add(user_id)
+
+def remove(user_id):
+    _banned.discard(user_id)
+
+def sender_id(update_json):
+    """
+    Returns from.id of a raw update dict (message, callback_query, ...), or None.
+    """
+    for value in update_json.values():
+        if isinstance(value, dict):
+            sender = value.get('from')
+            if isinstance(sender, dict):
+                return sender.get('id')
+    return None
+
+def should_drop(update_json):
+    user_id = sender_id(update_json)
+    if user_id is not None and user_id in _banned:
+        _stats['dropped'] += 1
+        return True
+    return False
+
+async def _migrate_ban_list(application):
+    """
+    Moves the old per-process admin ban list (bot_data['ban_list']) into the state
+    backend once. bot_data is not shared between workers, so it cannot stay a source.
+    """
+    ban_list = application.bot_data.pop('ban_list', None)
+    if ban_list:
+        backend = state_backend.get()
+        for user_id in ban_list:
+            await backend.set_banned(user_id, True)
+        print(f"Moved {len(ban_list)} bans from bot_data to the state backend")
+
+async def _load():
+    global _banned
+    _banned = await state_backend.get().banned_users() # Swapped in one step
+
+async def _refresh_loop():
+    while True:
+        await asyncio.sleep(config.BAN_INDEX_REFRESH)
+        try:
+            await _load()
+        except Exception as e:
+            print(f"Ban index refresh failed: {e}")
+
+async def start(application):
+    global _refresh_task
+    await _migrate_ban_list(application)
+    await _load()
+    print(f"Ban index loaded: {len(_banned)} users")
+    if config.BAN_INDEX_REFRESH > 0:
+        _refresh_task = asyncio.create_task(_refresh_loop())
+
+async def stop():
+    global _refresh_task
+    if _refresh_task is not None:
+        _refresh_task.cancel()
+        try:
+            await _refresh_task
+        except asyncio.CancelledError:
+            pass
+        _refresh_task = None
+
+def stats():
+    return {'banned': len(_banned), 'dropped': _stats['dropped']}
@@ -0,0 +1,252 @@
+"""
+Local stand-ins for the Telegram Bot API, remove.bg and Sight Engine, for benchmarks.
+
+Each service has a configurable latency, error rate and rate limit. Over the rate
+limit a service answers 429 with Retry-After, the way the real APIs do.
+
+    python bench/mock_servers.py --port 8081 --removebg-latency 1.5 --removebg-rate 5
+
+Prints "READY <port>" once it accepts connections. GET /stats returns the call counts.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import time
+import zipfile
+
+from aiohttp import web
+from PIL import Image
+
+_images = {}   # (kind, width, height) -> bytes, generated once
+
+def _photo(width, height):
+    key = ('jpg', width, height)
+    if key not in _images:
+        # Smooth shapes plus some noise compress roughly like a real photo
+        img = Image.effect_mandelbrot((width, height), (-2.2, -1.4, 0.8, 1.4), 64).convert('RGB')
+        noise = Image.effect_noise((width, height), 24).convert('RGB')
+        img = Image.blend(img, noise, 0.15)
+        output = io.BytesIO()
+        img.save(output, format='JPEG', quality=90)
+        _images[key] = output.getvalue()
+    return _images[key]
+
+def _cutout(width, height, kind):
+    key = (kind, width, height)
+    if key not in _images:
+        img = Image.open(io.BytesIO(_photo(width, height))).convert('RGB')
+        alpha = Image.new('L', (width, height), 0)
+        alpha.paste(255, (width // 4, height // 4, 3 * width // 4, 3 * height // 4))
+        output = io.BytesIO()
+        if kind == 'zip':
+            color, mask = io.BytesIO(), io.BytesIO()
+            img.save(color, format='JPEG', quality=90)
+            alpha.save(mask, format='PNG')
+            with zipfile.ZipFile(output, 'w') as zf:
+                zf.writestr('color.jpg', color.getvalue())
+                zf.writestr('alpha.png', mask.getvalue())
+        else:
+            img.putalpha(alpha)
+            img.save(output, format='PNG')
+        _images[key] = output.getvalue()
+    return _images[key]
+
+
+class Service:
+    """
+    Latency, error injection and a token-bucket rate limit for one mock API.
+    """
+
+    def __init__(self, name, latency, jitter, error_rate, rate):
+        self.name = name
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.calls = 0
+        self.errors = 0
+        self.limited = 0
+
+    def _take(self):
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def enter(self):
+        """
+        Returns 'ok', 'limited' or 'error' after the simulated latency.
+        """
+        self.calls += 1
+        if not self._take():
+            self.limited += 1
+            return 'limited'
+        await asyncio.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return 'error'
+        return 'ok'
+
+    def stats(self):
+        return {'calls': self.calls, 'errors': self.errors, 'limited': self.limited}
+
+
+# --- Telegram Bot API ---
+
+_ids = {'message': 1000}
+
+def _message(chat_id, **extra):
+    _ids['message'] += 1
+    return dict(message_id=_ids['message'], date=int(time.time()),
+                chat={'id': chat_id, 'type': 'private'}, **extra)
+
+def _document(n):
+    return {'file_id': f"doc-{n}", 'file_unique_id': f"udoc-{n}", 'file_name': 'file', 'file_size': 1}
+
+async def _params(request):
+    if request.content_type.startswith('multipart/'):
+        form = await request.post()
+        return {k: v for k, v in form.items() if isinstance(v, str)}
+    if request.content_type == 'application/json':
+        return await request.json()
+    return dict(await request.post())
+
+def _chat_id(params):
+    try:
+        return int(params.get('chat_id', 0))
+    except (TypeError, ValueError):
+        return 0
+
+async def telegram_method(request):
+    service = request.app['telegram']
+    method = request.match_info['method']
+    params = await _params(request)
+    outcome = await service.enter()
+    if outcome == 'limited':
+        return web.json_response({'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                                  'parameters': {'retry_after': 1}}, status=429)
+    if outcome == 'error':
+        return web.json_response({'ok': False, 'error_code': 500, 'description': 'Internal Server Error'},
+                                 status=500)
+
+    request.app['methods'][method] = request.app['methods'].get(method, 0) + 1
+    chat_id = _chat_id(params)
+    if method == 'getMe':
+        result = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+    elif method == 'getFile':
+        # file_id is "photo-<width>x<height>-..." (see bench/run.py)
+        size = params['file_id'].split('-')[1]
+        width, height = (int(v) for v in size.split('x'))
+        result = {'file_id': params['file_id'], 'file_unique_id': 'u' + params['file_id'],
+                  'file_size': len(_photo(width, height)), 'file_path': f"photos/{size}/{params['file_id']}.jpg"}
+    elif method == 'sendDocument':
+        result = _message(chat_id, document=_document(_ids['message']))
+    elif method == 'sendMediaGroup':
+        media = json.loads(params.get('media', '[]'))
+        result = [_message(chat_id, document=_document(_ids['message'])) for _ in media]
+    elif method in ('sendMessage', 'editMessageText'):
+        result = _message(chat_id, text=params.get('text', ''))
+    else:
+        # deleteMessage, answerCallbackQuery, setWebhook, ...
+        result = True
+    return web.json_response({'ok': True, 'result': result})
+
+async def telegram_file(request):
+    service = request.app['telegram']
+    if await service.enter() != 'ok':
+        return web.Response(status=502)
+    width, height = (int(v) for v in request.match_info['size'].split('x'))
+    # Bytes after the JPEG end marker are ignored by decoders but make every file's hash unique
+    body = _photo(width, height) + request.match_info['name'].encode()
+    return web.Response(body=body, content_type='image/jpeg')
+
+
+# --- remove.bg / Sight Engine ---
+
+async def removebg(request):
+    service = request.app['removebg']
+    form = await request.post()
+    outcome = await service.enter()
+    if outcome == 'limited':
+        return web.json_response({'errors': [{'title': 'Rate limit exceeded'}]}, status=429,
+                                 headers={'Retry-After': '1'})
+    if outcome == 'error':
+        return web.json_response({'errors': [{'title': 'Internal error'}]}, status=500)
+    upload = form['image_file'].file.read()
+    with Image.open(io.BytesIO(upload)) as img:
+        width, height = img.size
+    kind = 'zip' if form.get('format') == 'zip' else 'png'
+    body = _cutout(width, height, kind)
+    if kind == 'png':
+        body += os.urandom(8) # Unique result, like a real cutout (ignored after the PNG end chunk)
+    return web.Response(body=body,
+                        content_type='application/zip' if kind == 'zip' else 'image/png')
+
+async def sightengine(request):
+    service = request.app['sightengine']
+    await request.post()
+    outcome = await service.enter()
+    if outcome == 'limited':
+        return web.json_response({'status': 'failure', 'error': {'type': 'usage_limit'}}, status=429)
+    if outcome == 'error':
+        return web.json_response({'status': 'failure', 'error': {'type': 'internal'}}, status=500)
+    explicit = random.random() < request.app['explicit_rate']
+    return web.json_response({'status': 'success', 'nudity': {'raw': 0.9 if explicit else 0.01},
+                              'weapon': 0.0, 'alcohol': 0.0, 'drugs': 0.0})
+
+async def stats(request):
+    app = request.app
+    return web.json_response({
+        'telegram': app['telegram'].stats(),
+        'removebg': app['removebg'].stats(),
+        'sightengine': app['sightengine'].stats(),
+        'methods': app['methods'],
+    })
+
+
+def make_app(args):
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app['telegram'] = Service('telegram', args.telegram_latency, args.telegram_latency / 4,
+                              args.telegram_errors, args.telegram_rate)
+    app['removebg'] = Service('removebg', args.removebg_latency, args.removebg_latency / 4,
+                              args.removebg_errors, args.removebg_rate)
+    app['sightengine'] = Service('sightengine', args.sightengine_latency, args.sightengine_latency / 4,
+                                 args.sightengine_errors, args.sightengine_rate)
+    app['explicit_rate'] = args.explicit_rate
+    app['methods'] = {}
+    app.router.add_post('/bot{token}/{method}', telegram_method)
+    app.router.add_get('/file/bot{token}/photos/{size}/{name}.jpg', telegram_file)
+    app.router.add_post('/removebg', removebg)
+    app.router.add_post('/sightengine', sightengine)
+    app.router.add_get('/stats', stats)
+    return app
+
+def add_arguments(parser):
+    for name, latency in (('telegram', 0.05), ('removebg', 1.0), ('sightengine', 0.3)):
+        parser.add_argument(f"--{name}-latency", type=float, default=latency, help="seconds (mean)")
+        parser.add_argument(f"--{name}-errors", type=float, default=0.0, help="error rate, 0..1")
+        parser.add_argument(f"--{name}-rate", type=float, default=0.0, help="requests/second (0 = unlimited)")
+    parser.add_argument("--explicit-rate", type=float, default=0.0, help="share of images Sight Engine flags")
+
+async def _serve(args):
+    runner = web.AppRunner(make_app(args), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', args.port).start()
+    print(f"READY {args.port}", flush=True)
+    await asyncio.Event().wait()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8081)
+    add_arguments(parser)
+    asyncio.run(_serve(parser.parse_args()))
@@ -0,0 +1,301 @@
+"""
+Benchmark harness: posts synthetic webhook updates to main.asgi_app while Telegram,
+remove.bg and Sight Engine are served by bench/mock_servers.py. No real API is called.
+
+    python bench/run.py --users 1,10,50 --sizes 1280x960,2560x1920
+    python bench/run.py --users 20 --removebg-latency 2 --removebg-rate 5 --env RBG_FORMAT=zip
+
+Every (users, size) pair runs in a fresh process with its own temporary working
+directory, so caches, persistence and credits start empty. Reported per scenario:
+updates/sec, p50/p95/p99 of each pipeline stage, peak RSS, the startup breakdown
+and the time spent flushing persistence.
+
+Each user sends --photos photos (default 3, the daily credit limit) and, with
+--convert, presses a conversion button after each one.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+
+import mock_servers  # noqa: E402
+
+BOT_TOKEN = "123456:BENCH"
+FIRST_USER_ID = 100_000
+
+
+# --- One scenario (runs in its own process) ---
+
+def _photo_sizes(width, height, user, n):
+    """
+    PhotoSize list as Telegram sends it: smallest first.
+    """
+    sizes = []
+    for scale in (0.125, 0.5, 1.0):
+        w, h = max(1, int(width * scale)), max(1, int(height * scale))
+        sizes.append({'file_id': f"photo-{w}x{h}-{user}-{n}", 'file_unique_id': f"u{w}x{h}-{user}-{n}",
+                      'width': w, 'height': h, 'file_size': w * h // 8})
+    return sizes
+
+def _updates_for_user(user, args, width, height, counter):
+    user_id = FIRST_USER_ID + user
+    sender = {'id': user_id, 'is_bot': False, 'first_name': f"User{user}"}
+    chat = {'id': user_id, 'type': 'private'}
+    updates = []
+    for n in range(args.photos):
+        update_id = next(counter)
+        updates.append({'update_id': update_id, 'message': {
+            'message_id': update_id, 'date': int(time.time()), 'chat': chat, 'from': sender,
+            'photo': _photo_sizes(width, height, user, n)}})
+        if args.convert:
+            update_id = next(counter)
+            updates.append({'update_id': update_id, 'callback_query': {
+                'id': str(update_id), 'from': sender, 'chat_instance': 'bench', 'data': f"convert_{args.convert}",
+                'message': {'message_id': update_id, 'date': int(time.time()), 'chat': chat, 'text': 'convert'}}})
+    return updates
+
+def _percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(p * len(sorted_values)) - 1)]
+
+async def _lifespan():
+    """
+    Starts main.asgi_app through its lifespan protocol and returns a coroutine
+    function that shuts it down again.
+    """
+    import main
+    incoming, outgoing = asyncio.Queue(), asyncio.Queue()
+    task = asyncio.create_task(main.asgi_app({'type': 'lifespan'}, incoming.get, outgoing.put))
+    await incoming.put({'type': 'lifespan.startup'})
+    reply = await outgoing.get()
+    if reply['type'] != 'lifespan.startup.complete':
+        raise RuntimeError(f"Startup failed: {reply.get('message')}")
+
+    async def shutdown():
+        await incoming.put({'type': 'lifespan.shutdown'})
+        await outgoing.get()
+        await task
+    return shutdown
+
+async def _post(main, update):
+    body = json.dumps(update).encode()
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        sent.append(message)
+
+    await main.asgi_app({'type': 'http', 'method': 'POST', 'path': main.WEBHOOK_PATH, 'headers': []},
+                        receive, send)
+    return sent[0]['status']
+
+async def _wait_idle(application, timeout):
+    deadline = time.monotonic() + timeout
+    quiet = 0
+    while time.monotonic() < deadline:
+        busy = application.update_queue.qsize() or application.update_processor.queued()
+        quiet = 0 if busy else quiet + 1
+        if quiet >= 3:
+            return True
+        await asyncio.sleep(0.05)
+    return False
+
+async def _mock_stats(port):
+    import aiohttp
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"http://127.0.0.1:{port}/stats") as response:
+            return await response.json()
+
+async def _scenario(args, users, width, height, port):
+    # Record every stage sample, not just histogram buckets, for exact percentiles
+    import metrics
+    samples = defaultdict(list)
+    observe = metrics.observe
+
+    def recording_observe(stage, seconds):
+        samples[stage].append(seconds)
+        observe(stage, seconds)
+    metrics.observe = recording_observe
+
+    started = time.perf_counter()
+    import main
+    import_seconds = time.perf_counter() - started
+    shutdown = await _lifespan()
+    startup_seconds = time.perf_counter() - started
+
+    counter = iter(range(1, 10**9))
+    per_user = [_updates_for_user(user, args, width, height, counter) for user in range(users)]
+    total = sum(len(updates) for updates in per_user)
+
+    async def user_traffic(updates):
+        for update in updates:
+            await _post(main, update)
+            if args.interval:
+                await asyncio.sleep(args.interval)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user_traffic(updates) for updates in per_user))
+    completed = await _wait_idle(main.application, args.timeout)
+    elapsed = time.perf_counter() - started
+
+    started = time.perf_counter()
+    await main.application.update_persistence()
+    persistence_seconds = time.perf_counter() - started
+    mocks = await _mock_stats(port)
+    import startup
+    startup_phases = startup.stats()['phases']
+
+    started = time.perf_counter()
+    await shutdown()
+    shutdown_seconds = time.perf_counter() - started
+
+    stages = {}
+    for stage, values in sorted(samples.items()):
+        values.sort()
+        stages[stage] = {'count': len(values),
+                         'p50': _percentile(values, 0.50),
+                         'p95': _percentile(values, 0.95),
+                         'p99': _percentile(values, 0.99)}
+    return {
+        'users': users,
+        'size': f"{width}x{height}",
+        'updates': total,
+        'completed': completed,
+        'seconds': elapsed,
+        'updates_per_sec': total / elapsed if elapsed else 0.0,
+        'stages': stages,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'import_seconds': import_seconds,
+        'startup_seconds': startup_seconds,
+        'startup_phases': startup_phases,
+        'persistence_flush_seconds': persistence_seconds,
+        'shutdown_seconds': shutdown_seconds,
+        'mocks': mocks,
+    }
+
+def _mock_arguments(args):
+    argv = []
+    for name in ('telegram', 'removebg', 'sightengine'):
+        for field in ('latency', 'errors', 'rate'):
+            argv += [f"--{name}-{field}", str(getattr(args, f"{name}_{field}"))]
+    argv += ["--explicit-rate", str(args.explicit_rate)]
+    return argv
+
+def run_single(args):
+    users = int(args.users)
+    width, height = (int(v) for v in args.sizes.split('x'))
+    mock = subprocess.Popen([sys.executable, os.path.join(HERE, 'mock_servers.py'), '--port', str(args.port)]
+                            + _mock_arguments(args), stdout=subprocess.PIPE, text=True)
+    try:
+        line = mock.stdout.readline()
+        if not line.startswith('READY'):
+            raise RuntimeError("Mock servers did not start")
+
+        base = f"http://127.0.0.1:{args.port}"
+        os.environ.update({
+            'BOT_TOKEN': BOT_TOKEN, 'ADMIN_ID': '1', 'DB_C_ID': '-1001',
+            'RBG_API': 'bench', 'SE_API_USER': 'bench', 'SE_API_SECRET': 'bench',
+            'TELEGRAM_BASE_URL': f"{base}/bot", 'TELEGRAM_BASE_FILE_URL': f"{base}/file/bot",
+            'RBG_API_URL': f"{base}/removebg", 'SE_API_URL': f"{base}/sightengine",
+        })
+        os.environ.pop('WEBHOOK_SECRET', None)
+        for item in args.env:
+            key, _, value = item.partition('=')
+            os.environ[key] = value
+
+        sys.path.insert(0, ROOT)
+        with tempfile.TemporaryDirectory(prefix='bench-') as workdir:
+            os.chdir(workdir) # Persistence, state and caches all start empty
+            result = asyncio.run(_scenario(args, users, width, height, args.port))
+            os.chdir(ROOT)
+        print(json.dumps(result))
+    finally:
+        mock.terminate()
+        mock.wait()
+
+
+# --- Matrix driver ---
+
+def _report(result):
+    lines = [f"users={result['users']} size={result['size']} updates={result['updates']} "
+             f"{'' if result['completed'] else '(TIMED OUT) '}"
+             f"-> {result['updates_per_sec']:.2f} updates/s in {result['seconds']:.1f}s",
+             f"  startup {result['startup_seconds']:.2f}s (import {result['import_seconds']:.2f}s) | "
+             f"persistence flush {result['persistence_flush_seconds'] * 1000:.1f} ms | "
+             f"shutdown {result['shutdown_seconds']:.2f}s | peak RSS {result['peak_rss_mb']:.0f} MB"]
+    lines.append("  startup phases: " + ", ".join(
+        f"{name} {seconds * 1000:.0f} ms" for name, seconds in result['startup_phases'].items()))
+    for stage, s in result['stages'].items():
+        lines.append(f"  {stage:<14} n={s['count']:<5} p50 {s['p50'] * 1000:8.1f} ms  "
+                     f"p95 {s['p95'] * 1000:8.1f} ms  p99 {s['p99'] * 1000:8.1f} ms")
+    mocks = result['mocks']
+    lines.append("  api calls: " + ", ".join(
+        f"{name} {mocks[name]['calls']} ({mocks[name]['errors']} errors, {mocks[name]['limited']} limited)"
+        for name in ('telegram', 'removebg', 'sightengine')))
+    return "\n".join(lines)
+
+def run_matrix(args):
+    results = []
+    for users in args.users.split(','):
+        for size in args.sizes.split(','):
+            argv = _replace_option(sys.argv[1:], '--users', users)
+            argv = _replace_option(argv, '--sizes', size)
+            child = subprocess.run([sys.executable, os.path.abspath(__file__), '--single'] + argv,
+                                   stdout=subprocess.PIPE, text=True, cwd=ROOT)
+            output = child.stdout.strip().splitlines()
+            if child.returncode != 0 or not output:
+                print(f"users={users} size={size}: scenario failed (exit {child.returncode})")
+                continue
+            result = json.loads(output[-1])
+            results.append(result)
+            print(_report(result), flush=True)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+def _replace_option(argv, option, value):
+    out, skip = [], False
+    for a in argv:
+        if skip:
+            skip = False
+            continue
+        if a == option:
+            skip = True
+            continue
+        if a.startswith(option + '='):
+            continue
+        out.append(a)
+    return out + [option, value]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", default="1,10", help="comma-separated user counts")
+    parser.add_argument("--sizes", default="1280x960", help="comma-separated photo sizes (WxH)")
+    parser.add_argument("--photos", type=int, default=3, help="photos per user")
+    parser.add_argument("--convert", default=None, help="press this conversion button after each photo (e.g. JPG)")
+    parser.add_argument("--interval", type=float, default=0.0, help="seconds between one user's updates")
+    parser.add_argument("--timeout", type=float, default=600.0, help="max seconds to wait for a scenario")
+    parser.add_argument("--port", type=int, default=8081, help="port of the mock servers")
+    parser.add_argument("--env", action='append', default=[], help="extra bot setting, KEY=VALUE (repeatable)")
+    parser.add_argument("--json", default=None, help="also write all results to this file")
+    parser.add_argument("--single", action='store_true', help=argparse.SUPPRESS)
+    mock_servers.add_arguments(parser)
+    args = parser.parse_args()
+    if args.single:
+        run_single(args)
+    else:
+        run_matrix(args)
@@ -0,0 +1,102 @@
+import config
+import asyncio
+import hashlib
+import os
+import time
+
+# Content-addressed file store. Blobs are named by their sha256, so identical images
+# are stored once and user_data only needs the hex digest as a reference.
+
+_total_bytes = None   # Running size estimate, computed on first write
+_EVICT_EVERY = 32     # Full directory scan at most once per this many writes
+_writes_since_scan = 0
+
+def _path(ref):
+    return os.path.join(config.BLOB_STORE_DIR, ref[:2], ref)
+
+def _scan():
+    """
+    Returns [(mtime, size, path)] for every blob, removing expired ones.
+    """
+    now = time.time()
+    entries = []
+    for root, _, files in os.walk(config.BLOB_STORE_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if now - st.st_mtime > config.BLOB_STORE_TTL:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+    return entries
+
+def _evict():
+    global _total_bytes, _writes_since_scan
+    entries = _scan()
+    total = sum(size for _, size, _ in entries)
+    entries.sort()
+    for _, size, path in entries:
+        if total <= config.BLOB_STORE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+    _total_bytes = total
+    _writes_since_scan = 0
+
+def _put(ref, data):
+    global _total_bytes, _writes_since_scan
+    path = _path(ref)
+    if os.path.exists(path):
+        os.utime(path) # Refresh TTL
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+    _writes_since_scan += 1
+    if _total_bytes is not None:
+        _total_bytes += len(data)
+    if (_total_bytes is None or _total_bytes > config.BLOB_STORE_MAX_BYTES
+            or _writes_since_scan >= _EVICT_EVERY):
+        _evict()
+
+def _get(ref):
+    path = _path(ref)
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        os.utime(path) # Recently used blobs stay alive
+        return data
+    except OSError:
+        return None
+
+def make_ref(data):
+    return hashlib.sha256(data).hexdigest()
+
+async def put(data, ref=None):
+    """
+    Stores bytes and returns their reference (sha256 hex).
+    Derived data (e.g. a rendition) may pass its own `ref` built from its source instead.
+    """
+    ref = ref or make_ref(data)
+    await asyncio.to_thread(_put, ref, data)
+    return ref
+
+async def get(ref):
+    """
+    Returns the bytes for a reference, or None if it expired or was evicted.
+    """
+    if not ref:
+        return None
+    return await asyncio.to_thread(_get, ref)
@@ -0,0 +1,307 @@
+import config
+import asyncio
+import time
+import db_helpers
+import state_backend
+from rate_limit import TokenBucket, retry_seconds
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+
+# Background engine for /sendmsgall.
+# Sends with bounded concurrency behind a global token bucket, backs off on flood errors,
+# prunes users who blocked the bot, and checkpoints progress in the state backend
+# so an interrupted broadcast resumes after a restart.
+# With several workers only the one holding the 'broadcast' lock sends; the others
+# poll and take over (from the checkpoint) if its lease runs out.
+# The recipient list is stored once under its own key; the checkpoint holds only
+# the position and counters.
+
+_STATE_KEY = 'broadcast'
+_USERS_KEY = 'broadcast_users'
+_CANCEL_KEY = 'broadcast_cancel'
+
+_task = None
+_resume_task = None
+
+async def _send_one(bot, bucket, user_id, text):
+    """
+    Returns 'sent', 'blocked' or 'failed'.
+    """
+    for attempt in range(5):
+        await bucket.acquire()
+        try:
+            await bot.send_message(chat_id=user_id, text=text)
+            return 'sent'
+        except RetryAfter as e:
+            bucket.pause(retry_seconds(e) + 1)
+        except Forbidden:
+            return 'blocked' # User blocked the bot or deactivated
+        except BadRequest as e:
+            if "chat not found" in str(e).lower():
+                return 'blocked'
+            print(f"Failed to send to {user_id}: {e}")
+            return 'failed'
+        except NetworkError:
+            await asyncio.sleep(2 ** attempt)
+        except TelegramError as e:
+            print(f"Failed to send to {user_id}: {e}")
+            return 'failed'
+    return 'failed'
+
+def _progress_text(state, done=False):
+    total = state['total']
+    header = "Broadcast complete." if done else "Broadcast in progress..."
+    return (
+        f"{header}\n"
+        f"Progress: {state['next_index']}/{total}\n"
+        f"Successfully sent: {state['sent']}\n"
+        f"Failed: {state['failed']}\n"
+        f"Removed (blocked the bot): {state['pruned']}"
+    )
+
+async def _edit_status(bot, state, done=False):
+    try:
+        await bot.edit_message_text(chat_id=state['chat_id'], message_id=state['status_msg_id'],
+                                    text=_progress_text(state, done))
+    except TelegramError as e:
+        if "message is not modified" not in str(e).lower():
+            print(f"Broadcast status edit failed: {e}")
+
+async def _keep_lease(token, lost):
+    """
+    Renews the lock while chunks are being sent (a chunk can take long, e.g. on flood
+    waits). Sets `lost` if another worker took the broadcast over.
+    """
+    while True:
+        await asyncio.sleep(config.BROADCAST_LEASE / 3)
+        try:
+            renewed = await state_backend.get().renew_lock(_STATE_KEY, token, config.BROADCAST_LEASE)
+        except Exception as e:
+            print(f"Broadcast lease renewal failed: {e}")
+            renewed = False # Stop rather than risk sending alongside another worker
+        if not renewed:
+            lost.set()
+            return
+
+async def _abandon(bot, state, reason):
+    backend = state_backend.get()
+    await backend.delete_value(_STATE_KEY)
+    await backend.delete_value(_USERS_KEY)
+    await backend.delete_value(_CANCEL_KEY)
+    try:
+        await bot.send_message(chat_id=state['chat_id'], text=f"Broadcast abandoned: {reason}")
+    except TelegramError as e:
+        print(f"Broadcast abandon notice failed: {e}")
+
+async def _send_chunk(bot, bucket, chunk, text, lost):
+    """
+    Sends one chunk. Returns the results, or None if the lease was lost meanwhile.
+    """
+    sending = asyncio.ensure_future(asyncio.gather(*(_send_one(bot, bucket, uid, text) for uid in chunk)))
+    lease_lost = asyncio.ensure_future(lost.wait())
+    try:
+        await asyncio.wait({sending, lease_lost}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        lease_lost.cancel()
+        if not sending.done():
+            sending.cancel()
+            try:
+                await sending
+            except asyncio.CancelledError:
+                pass
+    return None if lost.is_set() else sending.result()
+
+async def _run(application, token):
+    global _task
+    bot = application.bot
+    backend = state_backend.get()
+    bucket = TokenBucket(config.BROADCAST_RATE)
+    chunk_size = config.BROADCAST_CONCURRENCY
+    last_progress = time.monotonic()
+    cancelled = False
+    lost = asyncio.Event()
+    keeper = asyncio.create_task(_keep_lease(token, lost))
+    state = None
+
+    try:
+        state = await backend.get_value(_STATE_KEY)
+        ids = (await backend.get_value(_USERS_KEY) or []) if state else []
+        while state and state['next_index'] < len(ids):
+            if await backend.get_value(_CANCEL_KEY):
+                cancelled = True
+                break
+            chunk = ids[state['next_index']:state['next_index'] + chunk_size]
+            results = await _send_chunk(bot, bucket, chunk, state['text'], lost)
+            if results is None:
+                print("Broadcast lease lost; another worker continues it")
+                return
+
+            for uid, result in zip(chunk, results):
+                if result == 'sent':
+                    state['sent'] += 1
+                elif result == 'blocked':
+                    state['failed'] += 1
+                    state['pruned'] += 1
+                    await backend.remove_user(uid)
+                else:
+                    state['failed'] += 1
+            state['next_index'] += len(chunk)
+            state['errors'] = 0 # Progress was made
+
+            # Checkpoint after every chunk, so a takeover repeats at most one chunk
+            if lost.is_set():
+                print("Broadcast lease lost; another worker continues it")
+                return
+            await backend.set_value(_STATE_KEY, state)
+
+            if time.monotonic() - last_progress >= config.BROADCAST_PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                await _edit_status(bot, state)
+
+        if state:
+            await _edit_status(bot, state, done=True)
+            if cancelled:
+                await bot.send_message(chat_id=state['chat_id'], text="Broadcast stopped.")
+        await backend.delete_value(_STATE_KEY)
+        await backend.delete_value(_USERS_KEY)
+        await backend.delete_value(_CANCEL_KEY)
+    except asyncio.CancelledError:
+        # Shutdown: the checkpoint stays, the broadcast resumes on the next start
+        # (or right away in another worker, since the lock is released below)
+        raise
+    except Exception as e:
+        print(f"Broadcast error: {e}")
+        # Kept for another attempt (by _resume_loop), unless it keeps failing at the same point
+        try:
+            if state and not lost.is_set():
+                state['errors'] = state.get('errors', 0) + 1
+                if state['errors'] >= config.BROADCAST_MAX_ERRORS:
+                    await _abandon(bot, state, f"{state['errors']} errors in a row, last: {e}")
+                else:
+                    await backend.set_value(_STATE_KEY, state)
+        except Exception as e:
+            print(f"Broadcast error bookkeeping failed: {e}")
+    finally:
+        _task = None
+        keeper.cancel()
+        try:
+            await backend.release_lock(_STATE_KEY, token)
+        except Exception as e:
+            print(f"Broadcast lock release failed: {e}")
+
+def is_running():
+    return _task is not None and not _task.done()
+
+def _launch(application, token):
+    global _task
+    _task = asyncio.create_task(_run(application, token))
+
+async def start(application, chat_id, text):
+    """
+    Starts a broadcast to every known user. Returns False if one is already running.
+    """
+    backend = state_backend.get()
+    token = await backend.acquire_lock(_STATE_KEY, config.BROADCAST_LEASE)
+    if token is None:
+        return False # Running in this or another worker
+    if await backend.get_value(_STATE_KEY) is not None:
+        await backend.release_lock(_STATE_KEY, token) # Interrupted one, about to be resumed
+        return False
+
+    user_ids = sorted(await db_helpers.get_all_users())
+    status = await application.bot.send_message(
+        chat_id=chat_id, text=f"Starting broadcast to {len(user_ids)} users.")
+    if not await backend.renew_lock(_STATE_KEY, token, config.BROADCAST_LEASE):
+        return False # The lease ran out meanwhile and someone else started one
+    await backend.delete_value(_CANCEL_KEY)
+    await backend.set_value(_USERS_KEY, user_ids) # Before the checkpoint that refers to it
+    await backend.set_value(_STATE_KEY, {
+        'text': text,
+        'total': len(user_ids),
+        'next_index': 0,
+        'errors': 0,
+        'sent': 0,
+        'failed': 0,
+        'pruned': 0,
+        'chat_id': chat_id,
+        'status_msg_id': status.message_id,
+    })
+    _launch(application, token)
+    return True
+
+async def stop(application):
+    """
+    Stops the running broadcast (in whichever worker runs it), or discards a stale
+    checkpoint left by a crash.
+    """
+    backend = state_backend.get()
+    if await backend.get_value(_STATE_KEY) is None:
+        return False
+    token = await backend.acquire_lock(_STATE_KEY, config.BROADCAST_LEASE)
+    if token is None:
+        # The runner checks this before every chunk
+        await backend.set_value(_CANCEL_KEY, True, ttl=config.BROADCAST_LEASE * 2)
+        return True
+    await backend.delete_value(_STATE_KEY)
+    await backend.delete_value(_USERS_KEY)
+    await backend.release_lock(_STATE_KEY, token)
+    return True
+
+async def _try_resume(application):
+    if is_running():
+        return
+    backend = state_backend.get()
+    state = await backend.get_value(_STATE_KEY)
+    if not state:
+        return
+    token = await backend.acquire_lock(_STATE_KEY, config.BROADCAST_LEASE)
+    if token is not None:
+        print(f"Resuming broadcast at {state['next_index']}/{state['total']}")
+        _launch(application, token)
+
+async def _resume_loop(application):
+    while True:
+        try:
+            await _try_resume(application)
+        except Exception as e:
+            print(f"Broadcast resume check failed: {e}")
+        await asyncio.sleep(config.BROADCAST_LEASE)
+
+async def _store_checkpoint(state):
+    # Older checkpoints carry the recipient list inline
+    backend = state_backend.get()
+    user_ids = state.pop('user_ids')
+    state['total'] = len(user_ids)
+    await backend.set_value(_USERS_KEY, user_ids)
+    await backend.set_value(_STATE_KEY, state)
+
+async def _migrate_checkpoint(application):
+    # Older versions checkpointed in bot_data, which is per process
+    state = application.bot_data.pop('broadcast', None)
+    backend = state_backend.get()
+    current = await backend.get_value(_STATE_KEY)
+    if state and current is None:
+        await _store_checkpoint(state)
+        print("Moved the broadcast checkpoint from bot_data to the state backend")
+    elif current is not None and 'user_ids' in current:
+        await _store_checkpoint(current)
+
+async def resume(application):
+    """
+    Called on startup in every worker. Continues a broadcast interrupted by a restart;
+    whichever worker gets the lock runs it, the others keep watching its lease.
+    """
+    global _resume_task
+    await _migrate_checkpoint(application)
+    if _resume_task is None:
+        _resume_task = asyncio.create_task(_resume_loop(application))
+
+async def shutdown():
+    global _resume_task
+    for task in (_resume_task, _task):
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+    _resume_task = None
@@ -12,8 +12,9 @@ if not BOT_TOKEN:
 SE_API_USER = os.getenv("SE_API_USER")
 SE_API_SECRET = os.getenv("SE_API_SECRET")
 
-# Remove.bg API
+# Remove.bg API (one key, or several comma-separated keys used as a pool)
 RBG_API = os.getenv("RBG_API")
+RBG_API_KEYS = [key.strip() for key in (RBG_API or "").split(',') if key.strip()]
 
 # Telegram IDs
 try:
@@ -25,3 +26,130 @@ except (ValueError, TypeError):
 
 if not all([SE_API_USER, SE_API_SECRET, RBG_API]):
     raise ValueError("One or more API environment variables are missing.")
+
+# API endpoints (overridable, e.g. to point the bot at the local stand-ins in bench/)
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL", "https://api.telegram.org/bot")
+TELEGRAM_BASE_FILE_URL = os.getenv("TELEGRAM_BASE_FILE_URL", "https://api.telegram.org/file/bot")
+RBG_API_URL = os.getenv("RBG_API_URL", "https://api.remove.bg/v1.0/removebg")
+SE_API_URL = os.getenv("SE_API_URL", "https://api.sightengine.com/1.0/check.json")
+
+# Shared HTTP client (remove.bg / Sight Engine)
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "60"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "20"))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "30"))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))
+
+# Cold start: before traffic is accepted, open connections to the remote APIs; once
+# ready, load Pillow into the conversion workers in the background
+WARM_UP = os.getenv("WARM_UP", "true").lower() == "true"
+WARM_UP_TIMEOUT = float(os.getenv("WARM_UP_TIMEOUT", "3"))
+
+# Diagnostics: /profile sampling profiler, slow-update capture, event-loop lag (see diagnostics.py)
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))        # seconds between stack samples
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "300"))
+SLOW_UPDATE_THRESHOLD = float(os.getenv("SLOW_UPDATE_THRESHOLD", "15"))  # handling time that gets recorded
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.25"))
+LOOP_STALL_THRESHOLD = float(os.getenv("LOOP_STALL_THRESHOLD", "0.5"))   # loop blocked this long -> stack captured
+DIAGNOSTICS_KEEP = int(os.getenv("DIAGNOSTICS_KEEP", "20"))              # slow updates / stalls kept for /slow
+
+# remove.bg transport: "png" downloads the finished RGBA PNG; "zip" downloads a
+# JPEG color image plus an alpha mask and rebuilds the PNG locally (much smaller download)
+RBG_FORMAT = os.getenv("RBG_FORMAT", "png").lower()
+
+# Background removal result cache
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "cache/results")
+RESULT_CACHE_MEM_ITEMS = int(os.getenv("RESULT_CACHE_MEM_ITEMS", "64"))
+RESULT_CACHE_MEM_BYTES = int(os.getenv("RESULT_CACHE_MEM_BYTES", str(64 * 1024 * 1024)))
+RESULT_CACHE_DISK_BYTES = int(os.getenv("RESULT_CACHE_DISK_BYTES", str(512 * 1024 * 1024)))
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", str(7 * 24 * 3600)))
+
+# Photos larger than this are spilled to a temp file instead of being held in memory
+PHOTO_SPILL_BYTES = int(os.getenv("PHOTO_SPILL_BYTES", str(20 * 1024 * 1024)))
+PHOTO_SPILL_DIR = os.getenv("PHOTO_SPILL_DIR") or None  # None = system temp dir
+
+# Input pre-processing before the remove.bg / Sightengine uploads.
+# Telegram offers several sizes of every photo; the smallest one with at least
+# INPUT_TARGET_MP megapixels is downloaded (0 = always the largest).
+INPUT_TARGET_MP = float(os.getenv("INPUT_TARGET_MP", "0"))
+# Downscale locally to at most this many megapixels (0 = never)
+INPUT_MAX_MP = float(os.getenv("INPUT_MAX_MP", "0"))
+# Re-encode the upload as JPEG at this quality if that makes it smaller (0 = never)
+INPUT_JPEG_QUALITY = int(os.getenv("INPUT_JPEG_QUALITY", "0"))
+
+# Image conversion worker pool
+CONVERT_POOL_KIND = os.getenv("CONVERT_POOL_KIND", "thread")  # "thread" or "process"
+CONVERT_POOL_WORKERS = int(os.getenv("CONVERT_POOL_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Max total megapixels being decoded/encoded at once (caps peak RAM)
+CONVERT_PIXEL_BUDGET = int(float(os.getenv("CONVERT_PIXEL_BUDGET_MP", "80")) * 1_000_000)
+
+# Persistence (SQLite, WAL mode). The old pickle file is migrated once if present.
+PERSISTENCE_DB = os.getenv("PERSISTENCE_DB", "bot_persistence.sqlite3")
+PERSISTENCE_PICKLE = os.getenv("PERSISTENCE_PICKLE", "bot_persistence")
+
+# Blob store for last processed images (user_data keeps only a reference)
+BLOB_STORE_DIR = os.getenv("BLOB_STORE_DIR", "cache/blobs")
+BLOB_STORE_MAX_BYTES = int(os.getenv("BLOB_STORE_MAX_BYTES", str(1024 * 1024 * 1024)))
+BLOB_STORE_TTL = int(os.getenv("BLOB_STORE_TTL", str(2 * 24 * 3600)))
+
+# /sendmsgall broadcast engine
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))  # messages per second (Telegram allows ~30)
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "10"))
+BROADCAST_LEASE = int(os.getenv("BROADCAST_LEASE", "60"))  # seconds; a dead worker's broadcast is resumed after this
+BROADCAST_MAX_ERRORS = int(os.getenv("BROADCAST_MAX_ERRORS", "3"))  # failed runs in a row before a broadcast is abandoned
+
+# DB channel stats messages (write-behind queue)
+DB_CHANNEL_COALESCE_WINDOW = float(os.getenv("DB_CHANNEL_COALESCE_WINDOW", "5"))
+DB_CHANNEL_RATE = float(os.getenv("DB_CHANNEL_RATE", "0.33"))  # edits per second (~20/min per channel)
+DB_CHANNEL_SHUTDOWN_TIMEOUT = float(os.getenv("DB_CHANNEL_SHUTDOWN_TIMEOUT", "5"))  # max seconds spent draining at shutdown
+
+# Webhook
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # Optional; checked against X-Telegram-Bot-Api-Secret-Token
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "64"))
+USER_UPDATE_BACKLOG = int(os.getenv("USER_UPDATE_BACKLOG", "20"))  # queued updates per user before dropping
+# Seconds between re-reads of the shared ban list into the webhook's ban index (0 = only at startup)
+BAN_INDEX_REFRESH = float(os.getenv("BAN_INDEX_REFRESH", "60"))
+
+# Shared state (credits, per-user lock, spam window, ban list) across gunicorn workers.
+# "sqlite:///path" for one host, "redis://host:port/db" for many.
+STATE_BACKEND_URL = os.getenv("STATE_BACKEND_URL", "sqlite:///bot_state.sqlite3")
+PROCESSING_LOCK_LEASE = int(os.getenv("PROCESSING_LOCK_LEASE", "180"))
+
+# Remote API resilience (see resilience.py)
+API_MIN_TIMEOUT = float(os.getenv("API_MIN_TIMEOUT", "5"))        # adaptive timeout floor; HTTP_TIMEOUT is the cap
+API_MIN_UPLOAD_RATE = float(os.getenv("API_MIN_UPLOAD_RATE", str(256 * 1024)))  # bytes/s; remove.bg timeout grows by size / this
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))        # consecutive failures that open a circuit
+BREAKER_RESET = float(os.getenv("BREAKER_RESET", "30"))           # seconds before a trial call is allowed
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "10"))       # longer Retry-After waits give up instead
+REMOVEBG_RETRIES = int(os.getenv("REMOVEBG_RETRIES", "2"))
+SIGHTENGINE_RETRIES = int(os.getenv("SIGHTENGINE_RETRIES", "2"))
+# Hedging sends a second copy of a slow request; both may be billed, so it is off by default
+REMOVEBG_HEDGE = os.getenv("REMOVEBG_HEDGE", "false").lower() == "true"
+SIGHTENGINE_HEDGE = os.getenv("SIGHTENGINE_HEDGE", "false").lower() == "true"
+KEY_EXHAUSTED_COOLDOWN = float(os.getenv("KEY_EXHAUSTED_COOLDOWN", "3600"))  # after a 402 (no credits)
+
+# Job scheduling for the paid APIs
+REMOVEBG_CONCURRENCY = int(os.getenv("REMOVEBG_CONCURRENCY", "8"))
+SIGHTENGINE_CONCURRENCY = int(os.getenv("SIGHTENGINE_CONCURRENCY", "16"))
+
+# Albums (media groups)
+ALBUM_WINDOW = float(os.getenv("ALBUM_WINDOW", "1.5"))  # seconds to collect photos of one album
+ALBUM_RESULT_MODE = os.getenv("ALBUM_RESULT_MODE", "album")  # "album" or "zip"
+
+# Conversion renditions
+EAGER_RENDITIONS = [f.strip().upper() for f in os.getenv("EAGER_RENDITIONS", "JPG,PDF").split(',') if f.strip()]
+RENDITION_MEM_BYTES = int(os.getenv("RENDITION_MEM_BYTES", str(32 * 1024 * 1024)))
+
+# Telegram file_id reuse (content hash + format -> file_id of an earlier upload)
+FILE_ID_DB = os.getenv("FILE_ID_DB", "file_ids.sqlite3")
+
+# Background replacement (composited locally, no remove.bg call)
+BACKGROUND_BLUR_RADIUS = float(os.getenv("BACKGROUND_BLUR_RADIUS", "6"))  # applied at quarter size
+CUSTOM_BACKGROUND_TIMEOUT = int(os.getenv("CUSTOM_BACKGROUND_TIMEOUT", "300"))  # seconds to send the background photo
+
+# Moderation index in front of Sight Engine (verdicts by content hash + flagged perceptual hashes)
+MODERATION_DB = os.getenv("MODERATION_DB", "moderation.sqlite3")
+MODERATION_HAMMING_RADIUS = int(os.getenv("MODERATION_HAMMING_RADIUS", "6"))  # of 64 bits
@@ -1,17 +1,31 @@
 import config
-from telegram import Bot
+import state_backend
+import metrics
+from rate_limit import TokenBucket, retry_seconds
 from telegram.constants import ParseMode
-from telegram.error import TelegramError
+from telegram.error import RetryAfter, TelegramError
+import asyncio
 import datetime
 
 # Helper to add user to the global list for /sendmsgall
-def add_user_to_db(context, user_id):
-    if 'user_ids' not in context.bot_data:
-        context.bot_data['user_ids'] = set()
-    context.bot_data['user_ids'].add(user_id)
+# (kept in the state backend: bot_data is per worker process)
+async def add_user_to_db(user_id):
+    await state_backend.get().add_user(user_id)
 
-def get_all_users(context):
-    return context.bot_data.get('user_ids', set())
+async def get_all_users():
+    return await state_backend.get().user_ids()
+
+async def migrate_shared_state(application):
+    """
+    Moves the user list older versions kept in bot_data (per process) into the
+    state backend. Safe to run in every worker.
+    """
+    backend = state_backend.get()
+    user_ids = application.bot_data.pop('user_ids', None)
+    if user_ids:
+        for user_id in user_ids:
+            await backend.add_user(user_id)
+        print(f"Moved {len(user_ids)} users from bot_data to the state backend")
 
 # Helper to format the stats message
 def get_user_stats_text(user, user_data):
@@ -27,45 +41,142 @@ def get_user_stats_text(user, user_data):
         f"<b>Banned:</b> {'Yes' if user_data.get('banned', False) else 'No'}"
     )
 
-# This function sends or edits the message in the DB channel
+# --- DB channel write-behind queue ---
+# Stats edits are queued per user and sent by a background task, so handlers never wait
+# on the channel. Only the latest state matters: repeated updates for the same user
+# within the coalescing window collapse into one edit.
+
+_pending = {}   # user_id -> (user, user_data)
+_wakeup = None
+_flusher_task = None
+_bucket = None
+
+# This function queues a send/edit of the user's message in the DB channel
 async def update_db_channel_message(context, user):
-    user_data = context.user_data
+    global _wakeup, _flusher_task
+    _pending[user.id] = (user, context.user_data)
+
+    if _flusher_task is None or _flusher_task.done():
+        _wakeup = asyncio.Event()
+        _flusher_task = asyncio.create_task(_flush_loop(context.application))
+    _wakeup.set()
+
+async def _flush_loop(application):
+    global _bucket
+    if _bucket is None:
+        _bucket = TokenBucket(config.DB_CHANNEL_RATE, capacity=5)
+    while True:
+        await _wakeup.wait()
+        _wakeup.clear()
+        # Let more updates for the same users pile up before sending
+        await asyncio.sleep(config.DB_CHANNEL_COALESCE_WINDOW)
+        await _flush_pending(application)
+
+async def _flush_pending(application):
+    while _pending:
+        user_id = next(iter(_pending))
+        user, user_data = _pending.pop(user_id)
+        await _bucket.acquire()
+        await _send_db_channel_message(application, user, user_data)
+
+def _db_msg_key(user_id):
+    return f"db_msg:{user_id}"
+
+async def _get_db_msg_id(backend, user, user_data):
+    db_msg_id = await backend.get_value(_db_msg_key(user.id))
+    if db_msg_id is None and user_data.get('db_msg_id'):
+        # Kept in per-process user_data by older versions
+        db_msg_id = user_data['db_msg_id']
+        await backend.set_value(_db_msg_key(user.id), db_msg_id)
+    user_data.pop('db_msg_id', None)
+    return db_msg_id
+
+async def _send_db_channel_message(application, user, user_data):
     stats_text = get_user_stats_text(user, user_data)
+    # The message id is in the state backend, so every worker edits the same message
+    backend = state_backend.get()
+    db_msg_id = None
     
-    db_msg_id = user_data.get('db_msg_id')
-    
-    try:
-        if db_msg_id:
+    with metrics.timer('db_edit'):
+        try:
+            db_msg_id = await _get_db_msg_id(backend, user, user_data)
+            if not db_msg_id:
+                # Only one worker posts a user's first message
+                token = await backend.acquire_lock(_db_msg_key(user.id), 30)
+                if token is None:
+                    _pending.setdefault(user.id, (user, user_data)) # Edited once the other post is done
+                    return
+                try:
+                    db_msg_id = await backend.get_value(_db_msg_key(user.id))
+                    if not db_msg_id:
+                        # Send new message and save its ID
+                        message = await application.bot.send_message(
+                            chat_id=config.DB_C_ID,
+                            text=stats_text,
+                            parse_mode=ParseMode.HTML
+                        )
+                        await backend.set_value(_db_msg_key(user.id), message.message_id)
+                        return
+                finally:
+                    await backend.release_lock(_db_msg_key(user.id), token)
+
             # Edit existing message
-            await context.bot.edit_message_text(
+            await application.bot.edit_message_text(
                 chat_id=config.DB_C_ID,
                 message_id=db_msg_id,
                 text=stats_text,
                 parse_mode=ParseMode.HTML
             )
-        else:
-            # Send new message and save its ID
-            message = await context.bot.send_message(
-                chat_id=config.DB_C_ID,
-                text=stats_text,
-                parse_mode=ParseMode.HTML
-            )
-            user_data['db_msg_id'] = message.message_id
             
-    except TelegramError as e:
-        error_str = str(e).lower()
-        # If message content is the same, no update needed - silently ignore
-        if "message is not modified" in error_str:
-            return  # Nothing to update, this is fine
-        # If message was deleted or bot was kicked, send a new one
-        if "message to edit not found" in error_str:
-            print(f"DB Channel Error: Message not found. Sending new message.")
-            user_data['db_msg_id'] = None # Reset
-            await update_db_channel_message(context, user) # Recurse
-        else:
-            print(f"DB Channel Error: {e}")
-    except Exception as e:
-        print(f"Failed to update DB channel: {e}")
+        except RetryAfter as e:
+            metrics.error('db_edit', 'retry_after')
+            # Flood limit: pause all channel edits and retry this one later (unless newer state arrived)
+            _bucket.pause(retry_seconds(e) + 1)
+            _pending.setdefault(user.id, (user, user_data))
+        except TelegramError as e:
+            error_str = str(e).lower()
+            # If message content is the same, no update needed - silently ignore
+            if "message is not modified" in error_str:
+                return  # Nothing to update, this is fine
+            # If message was deleted or bot was kicked, send a new one
+            if "message to edit not found" in error_str:
+                metrics.error('db_edit', 'message_not_found')
+                print(f"DB Channel Error: Message not found. Sending new message.")
+                # Reset, unless another worker already posted a new one
+                if await backend.get_value(_db_msg_key(user.id)) == db_msg_id:
+                    await backend.delete_value(_db_msg_key(user.id))
+                _pending.setdefault(user.id, (user, user_data)) # Re-queue instead of recursing
+            else:
+                metrics.error('db_edit', 'telegram_error')
+                print(f"DB Channel Error: {e}")
+        except Exception as e:
+            metrics.error('db_edit', type(e).__name__)
+            print(f"Failed to update DB channel: {e}")
+
+def pending_count():
+    return len(_pending)
+
+async def shutdown_db_channel_queue(application):
+    """
+    Stops the background task and sends what is still queued, for at most
+    DB_CHANNEL_SHUTDOWN_TIMEOUT seconds (the channel rate limit allows only a few
+    edits per second, and the persistence flush runs after this). Edits left over are
+    dropped: a user's stats message is brought up to date on their next update.
+    """
+    global _flusher_task
+    if _flusher_task is not None:
+        _flusher_task.cancel()
+        try:
+            await _flusher_task
+        except asyncio.CancelledError:
+            pass
+        _flusher_task = None
+    if _pending and _bucket is not None:
+        try:
+            await asyncio.wait_for(_flush_pending(application), timeout=config.DB_CHANNEL_SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"Dropped {len(_pending)} queued DB channel edits at shutdown")
+            _pending.clear()
 
 # Logs a new event (like a ban) to the DB channel
 async def log_event_to_db(context, event_text):
@@ -77,24 +188,84 @@ async def log_event_to_db(context, event_text):
     except Exception as e:
         print(f"Failed to log event to DB channel: {e}")
 
+# --- Daily credits ---
+# The authoritative count lives in the shared state backend so every worker sees it.
+# user_data['daily_limit'] is only a mirror for the stats/status messages.
+
+DAILY_LIMIT = 3
+
+def _today():
+    return datetime.date.today().isoformat()
+
+def _mirror_credits(user_data, remaining):
+    user_data['last_used_date'] = _today()
+    user_data['daily_limit'] = remaining
+
 # Helper to check and reset daily limits
-def check_daily_limit(user_data, is_admin):
+async def check_daily_limit(user_id, user_data, is_admin):
     if is_admin:
         return True # Admins have no limit
-        
-    today = datetime.date.today().isoformat()
-    last_used = user_data.get('last_used_date')
     
-    if last_used != today:
-        user_data['last_used_date'] = today
-        user_data['daily_limit'] = 3 # Reset limit
-    
-    return user_data.get('daily_limit', 3) > 0
+    remaining = await state_backend.get().get_credits(user_id, _today(), DAILY_LIMIT)
+    _mirror_credits(user_data, remaining)
+    return remaining > 0
 
-def use_credit(user_data, is_admin):
+async def use_credit(user_id, user_data, is_admin, amount=1):
+    """
+    Atomically takes credits. Returns how many were granted (admins always get `amount`).
+    """
     if is_admin:
-        return # Admins don't use credits
-        
-    if user_data.get('daily_limit', 3) > 0:
-        user_data['daily_limit'] = user_data.get('daily_limit', 3) - 1
-  
+        return amount # Admins don't use credits
+    
+    granted, remaining = await state_backend.get().take_credits(user_id, _today(), DAILY_LIMIT, amount)
+    _mirror_credits(user_data, remaining)
+    return granted
+
+async def refund_credit(user_id, user_data, is_admin, amount=1):
+    if is_admin or amount <= 0:
+        return
+    
+    remaining = await state_backend.get().refund_credits(user_id, _today(), DAILY_LIMIT, amount)
+    _mirror_credits(user_data, remaining)
+
+# --- Violations ---
+# Counted in the state backend like credits; user_data['violations'] is a mirror.
+
+async def _seed_violations(user_id, user_data):
+    # Counts recorded in user_data before violations moved to the state backend
+    # (user_data is loaded lazily per user, so this happens on first use, not at startup)
+    if not user_data.get('violations_shared'):
+        if user_data.get('violations'):
+            await state_backend.get().seed_violations(user_id, user_data['violations'])
+        user_data['violations_shared'] = True
+
+async def add_violations(user_id, user_data, count=1):
+    await _seed_violations(user_id, user_data)
+    total = await state_backend.get().add_violations(user_id, count)
+    user_data['violations'] = total
+    return total
+
+async def get_violations(user_id, user_data):
+    await _seed_violations(user_id, user_data)
+    total = await state_backend.get().get_violations(user_id)
+    user_data['violations'] = total
+    return total
+
+# --- Last result per user (for the convert/background buttons) ---
+
+def _last_key(user_id):
+    return f"last:{user_id}"
+
+async def set_last_result(user_id, ref, original_file_id):
+    await state_backend.get().set_value(
+        _last_key(user_id), {'ref': ref, 'file_id': original_file_id}, ttl=config.BLOB_STORE_TTL)
+
+async def get_last_result(user_id, user_data):
+    """
+    Returns (blob ref, original photo file_id); either may be None.
+    """
+    last = await state_backend.get().get_value(_last_key(user_id))
+    if last:
+        return last['ref'], last['file_id']
+    # Results saved before this moved to the state backend
+    return user_data.get('last_processed_ref'), user_data.get('last_original_file_id')
@@ -0,0 +1,234 @@
+import config
+import asyncio
+import itertools
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+
+import metrics
+
+# What the event loop is doing, for latency spikes in production.
+# - Sampling profiler (/profile N): a thread samples the event loop thread's stack every
+#   PROFILE_INTERVAL and counts identical stacks (collapsed-stack format).
+# - Event-loop lag: a task that sleeps LOOP_LAG_INTERVAL and measures how late it wakes.
+#   If the loop is blocked longer than LOOP_STALL_THRESHOLD, the watchdog thread captures
+#   the blocking stack while it is still running.
+# - Slow updates: every update's handling time is measured; one that runs longer than
+#   SLOW_UPDATE_THRESHOLD gets its await stack captured and its stage timings recorded.
+
+_WATCH_INTERVAL = 0.1   # watchdog period while not profiling
+
+_loop_thread_id = None
+_lag_task = None
+_watchdog = None
+_stop = threading.Event()
+_heartbeat = 0.0         # monotonic time the lag task last woke up
+_stalled_beat = None     # heartbeat of the stall already captured
+_open_stall = None       # captured stall whose total length is not known yet
+
+_profile = None          # {'counts': Counter, 'samples': int} while /profile runs
+_running = {}            # key -> in-flight update (see update_started)
+_keys = itertools.count()
+
+_slow = deque(maxlen=config.DIAGNOSTICS_KEEP)
+_stalls = deque(maxlen=config.DIAGNOSTICS_KEEP)
+_stats = {'lag_last': 0.0, 'lag_max': 0.0, 'stalls': 0, 'slow_updates': 0, 'profiles': 0}
+
+# --- Stacks ---
+
+def _collapse(frame):
+    """
+    One stack as "module:function;module:function;..." (outermost first).
+    """
+    names = []
+    while frame is not None:
+        names.append(f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_name}")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+def _loop_frame():
+    return sys._current_frames().get(_loop_thread_id)
+
+def _await_stack(task):
+    """
+    The chain of coroutines a task is suspended in, innermost (what it waits on) last.
+    (Task.get_stack only returns the outermost frame of a suspended coroutine.)
+    """
+    frames = []
+    awaitable = task.get_coro()
+    while awaitable is not None:
+        frame = getattr(awaitable, 'cr_frame', None) or getattr(awaitable, 'gi_frame', None)
+        if frame is None:
+            break
+        frames.append((frame, frame.f_lineno))
+        awaitable = getattr(awaitable, 'cr_await', None) or getattr(awaitable, 'gi_yieldfrom', None)
+    return ''.join(traceback.StackSummary.extract(frames).format())
+
+# --- Watchdog thread (profiler samples, loop stalls) ---
+
+def _watch():
+    global _stalled_beat, _open_stall
+    while not _stop.wait(config.PROFILE_INTERVAL if _profile is not None else _WATCH_INTERVAL):
+        frame = _loop_frame()
+        if frame is None:
+            continue
+        profile = _profile
+        if profile is not None:
+            profile['counts'][_collapse(frame)] += 1
+            profile['samples'] += 1
+
+        beat = _heartbeat
+        blocked = time.monotonic() - beat - config.LOOP_LAG_INTERVAL
+        if blocked > config.LOOP_STALL_THRESHOLD and beat != _stalled_beat:
+            _stalled_beat = beat
+            _open_stall = {'at': time.time(), 'seconds': None, 'stack': ''.join(traceback.format_stack(frame))}
+            _stalls.append(_open_stall)
+            _stats['stalls'] += 1
+        del frame
+
+# --- Event-loop lag ---
+
+async def _lag_loop():
+    global _heartbeat, _open_stall
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(config.LOOP_LAG_INTERVAL)
+        _heartbeat = now = time.monotonic()
+        lag = max(0.0, now - started - config.LOOP_LAG_INTERVAL)
+        metrics.observe('event_loop_lag', lag)
+        _stats['lag_last'] = lag
+        _stats['lag_max'] = max(_stats['lag_max'], lag)
+        if _open_stall is not None:
+            _open_stall['seconds'] = lag
+            print(f"Event loop was blocked for {lag:.2f}s (stack captured, see /slow)")
+            _open_stall = None
+        _check_running(now)
+
+def _check_running(now):
+    """
+    Captures where each too-slow update is waiting, while it is still waiting there.
+    """
+    for entry in list(_running.values()):
+        if entry['stack'] is None and now - entry['started'] > config.SLOW_UPDATE_THRESHOLD:
+            entry['stack'] = _await_stack(entry['task'])
+
+# --- Slow updates (called by UserOrderedUpdateProcessor) ---
+
+def _describe(update):
+    user = update.effective_user.id if getattr(update, 'effective_user', None) else None
+    if getattr(update, 'callback_query', None):
+        kind = f"callback {update.callback_query.data}"
+    elif getattr(update, 'message', None):
+        message = update.message
+        if message.photo:
+            kind = "photo"
+        elif message.text and message.text.startswith('/'):
+            kind = message.text.split()[0] # Command name only, never the user's text
+        else:
+            kind = "message"
+    else:
+        kind = type(update).__name__
+    return f"update {getattr(update, 'update_id', '?')} from {user}: {kind}"
+
+def update_started(update):
+    key = next(_keys)
+    _running[key] = {'task': asyncio.current_task(), 'update': update, 'started': time.monotonic(),
+                     'trace': metrics.start_trace(), 'stack': None}
+    return key
+
+def update_finished(key):
+    entry = _running.pop(key)
+    seconds = time.monotonic() - entry['started']
+    metrics.observe('update', seconds)
+    if seconds < config.SLOW_UPDATE_THRESHOLD:
+        return
+
+    stages = {}
+    for stage, elapsed in entry['trace']:
+        total, count = stages.get(stage, (0.0, 0))
+        stages[stage] = (total + elapsed, count + 1)
+    record = {'at': time.time(), 'update': _describe(entry['update']), 'seconds': seconds,
+              'stages': stages, 'stack': entry['stack']}
+    _slow.append(record)
+    _stats['slow_updates'] += 1
+    timed = ", ".join(f"{stage} {total:.1f}s" for stage, (total, _) in stages.items())
+    print(f"Slow {record['update']} took {seconds:.1f}s" + (f" ({timed})" if timed else ""))
+
+# --- Profiler ---
+
+def start_profile():
+    """
+    Starts sampling the event loop. Returns False if a profile is already running.
+    """
+    global _profile
+    if _profile is not None:
+        return False
+    _profile = {'counts': Counter(), 'samples': 0}
+    _stats['profiles'] += 1
+    return True
+
+async def finish_profile(seconds):
+    """
+    Lets the profile started by start_profile() run for `seconds`, stops it and
+    returns (collapsed stacks text, sample count).
+    """
+    global _profile
+    profile = _profile
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        _profile = None
+    lines = [f"{stack} {count}" for stack, count in profile['counts'].most_common()]
+    return "\n".join(lines) + "\n", profile['samples']
+
+def report():
+    """
+    Recent slow updates and event-loop stalls as text, newest first.
+    """
+    parts = []
+    for record in reversed(_slow):
+        stages = ", ".join(f"{stage} {total:.2f}s ({count}x)" for stage, (total, count) in record['stages'].items())
+        parts.append(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(record['at']))} UTC "
+                     f"{record['update']} took {record['seconds']:.2f}s\n"
+                     f"Stages: {stages or 'none timed'}\n"
+                     f"{record['stack'] or 'Finished before its stack was captured.'}\n")
+    for stall in reversed(_stalls):
+        length = f"{stall['seconds']:.2f}s" if stall['seconds'] is not None else "still blocked when captured"
+        parts.append(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(stall['at']))} UTC "
+                     f"event loop blocked ({length})\n{stall['stack']}")
+    return "\n".join(parts)
+
+# --- Lifecycle ---
+
+def start():
+    """
+    Starts the lag monitor and the watchdog thread. Called from post_init.
+    """
+    global _loop_thread_id, _lag_task, _watchdog, _heartbeat
+    if _lag_task is not None:
+        return
+    _loop_thread_id = threading.get_ident()
+    _heartbeat = time.monotonic()
+    _stop.clear()
+    _lag_task = asyncio.create_task(_lag_loop())
+    _watchdog = threading.Thread(target=_watch, name='diagnostics', daemon=True)
+    _watchdog.start()
+
+async def stop():
+    global _lag_task, _watchdog
+    _stop.set()
+    if _lag_task is not None:
+        _lag_task.cancel()
+        try:
+            await _lag_task
+        except asyncio.CancelledError:
+            pass
+        _lag_task = None
+    if _watchdog is not None:
+        await asyncio.to_thread(_watchdog.join)
+        _watchdog = None
+
+def stats():
+    return dict(_stats, running=len(_running))
@@ -0,0 +1,131 @@
+import config
+import metrics
+import asyncio
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from telegram import InputMediaDocument
+from telegram.error import BadRequest
+
+# After the first upload of some content, Telegram gives back a file_id.
+# Sending that file_id again costs no upload, so identical outputs (cache hits,
+# repeated conversions, re-sends) are delivered by reference instead of by bytes.
+
+_MEMORY_ITEMS = 10_000
+
+_memory = OrderedDict()   # key -> file_id
+_conn = None
+_lock = threading.Lock()
+
+_stats = {'reused': 0, 'uploaded': 0, 'invalidated': 0}
+
+def make_key(content_ref, fmt):
+    return f"{content_ref}:{fmt.upper()}"
+
+def _execute(sql, params=(), fetch=False):
+    global _conn
+    with _lock:
+        if _conn is None:
+            _conn = sqlite3.connect(config.FILE_ID_DB, timeout=10, check_same_thread=False, isolation_level=None)
+            _conn.execute("PRAGMA journal_mode=WAL")
+            _conn.execute("CREATE TABLE IF NOT EXISTS file_ids (key TEXT PRIMARY KEY, file_id TEXT NOT NULL, updated REAL NOT NULL)")
+        cur = _conn.execute(sql, params)
+        return cur.fetchone() if fetch else None
+
+def _cache(key, file_id):
+    _memory[key] = file_id
+    _memory.move_to_end(key)
+    while len(_memory) > _MEMORY_ITEMS:
+        _memory.popitem(last=False)
+
+async def lookup(key):
+    file_id = _memory.get(key)
+    if file_id is None:
+        row = await asyncio.to_thread(_execute, "SELECT file_id FROM file_ids WHERE key = ?", (key,), True)
+        if row is None:
+            return None
+        file_id = row[0]
+        _cache(key, file_id)
+    return file_id
+
+async def remember(key, file_id):
+    _cache(key, file_id)
+    await asyncio.to_thread(_execute, "INSERT OR REPLACE INTO file_ids (key, file_id, updated) VALUES (?, ?, ?)",
+                            (key, file_id, time.time()))
+
+async def forget(key):
+    _memory.pop(key, None)
+    await asyncio.to_thread(_execute, "DELETE FROM file_ids WHERE key = ?", (key,))
+
+async def send_document(message, key, filename, load):
+    """
+    Replies to `message` with a document. Uses a known file_id for `key` if there is one,
+    otherwise awaits load() for the bytes, uploads them and records the new file_id.
+    Returns the sent Message, or None if load() had nothing to send.
+    """
+    file_id = await lookup(key)
+    if file_id:
+        try:
+            with metrics.timer('upload'):
+                sent = await message.reply_document(document=file_id)
+            _stats['reused'] += 1
+            return sent
+        except BadRequest as e:
+            # file_id no longer valid (e.g. wrong file identifier); fall back to uploading
+            print(f"Stale file_id for {key}: {e}")
+            _stats['invalidated'] += 1
+            await forget(key)
+
+    data = await load()
+    if not data:
+        return None
+    with metrics.timer('upload'):
+        sent = await message.reply_document(document=data, filename=filename)
+    metrics.add_bytes('telegram_upload', len(data))
+    _stats['uploaded'] += 1
+    if sent.document:
+        await remember(key, sent.document.file_id)
+    return sent
+
+async def send_media_group(message, items):
+    """
+    Replies with an album of documents. `items` is [(key, filename, bytes)].
+    Known file_ids are used where possible; if Telegram rejects any of them,
+    they are dropped and the whole album is uploaded from bytes.
+    """
+    file_ids = [await lookup(key) for key, _, _ in items]
+    if any(file_ids):
+        media = [InputMediaDocument(media=file_id) if file_id else InputMediaDocument(media=data, filename=filename)
+                 for file_id, (_, filename, data) in zip(file_ids, items)]
+        try:
+            with metrics.timer('upload'):
+                sent = await message.reply_media_group(media=media)
+            metrics.add_bytes('telegram_upload', sum(len(data) for file_id, (_, _, data) in zip(file_ids, items)
+                                                     if not file_id))
+            _stats['reused'] += sum(1 for file_id in file_ids if file_id)
+            _stats['uploaded'] += sum(1 for file_id in file_ids if not file_id)
+            await _remember_sent(items, sent)
+            return sent
+        except BadRequest as e:
+            print(f"Stale file_id in album: {e}")
+            _stats['invalidated'] += 1
+            for (key, _, _), file_id in zip(items, file_ids):
+                if file_id:
+                    await forget(key)
+
+    media = [InputMediaDocument(media=data, filename=filename) for _, filename, data in items]
+    with metrics.timer('upload'):
+        sent = await message.reply_media_group(media=media)
+    metrics.add_bytes('telegram_upload', sum(len(data) for _, _, data in items))
+    _stats['uploaded'] += len(items)
+    await _remember_sent(items, sent)
+    return sent
+
+async def _remember_sent(items, sent):
+    for (key, _, _), msg in zip(items, sent):
+        if msg.document and _memory.get(key) != msg.document.file_id:
+            await remember(key, msg.document.file_id)
+
+def stats():
+    return dict(_stats)
@@ -1,5 +1,18 @@
 import config
 import db_helpers
+import broadcast
+import result_cache
+import worker_pool
+import state_backend
+import scheduler
+import file_id_index
+import image_processing
+import moderation_index
+import ban_index
+import resilience
+import startup
+import diagnostics
+import time
 from telegram import Update
 from telegram.ext import ContextTypes
 from telegram.constants import ParseMode
@@ -16,23 +29,11 @@ async def ban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user_id_to_ban = int(context.args[0])
         
-        # We need to access that user's data. 
-        # This is tricky without loading their data first.
-        # A simple ban flag might not be stored yet if the user never started the bot.
-        # A better approach (not implemented here) would be a separate ban list.
-        # For simplicity, we assume we can fetch their user_data if they ever used the bot.
-        
-        # This line is complex with PicklePersistence. We'll use a simpler 'ban list'.
-        if 'ban_list' not in context.bot_data:
-            context.bot_data['ban_list'] = set()
-        
-        context.bot_data['ban_list'].add(user_id_to_ban)
-        
-        # Also update the user's personal data if they exist
-        # This requires manually loading/saving persistence data, which is complex.
-        # We will rely on checking the ban_list AND user_data.
-        # When the user next messages, their `user_data` will be loaded, 
-        # and we can set `user_data['banned'] = True` then.
+        # The state backend is the ban list, shared by every worker (see ban_index)
+        await state_backend.get().set_banned(user_id_to_ban, True)
+        ban_index.add(user_id_to_ban) # Dropped at the webhook from now on
+        # Other workers pick the ban up on their next ban_index refresh; user_data['banned']
+        # is only a mirror for the stats message and follows the backend.
         
         await update.message.reply_text(f"User {user_id_to_ban} has been added to the ban list.")
         await db_helpers.log_event_to_db(context, f"Admin {update.effective_user.id} banned user {user_id_to_ban}")
@@ -47,15 +48,10 @@ async def unban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user_id_to_unban = int(context.args[0])
         
-        if 'ban_list' in context.bot_data:
-            context.bot_data['ban_list'].discard(user_id_to_unban)
+        await state_backend.get().set_banned(user_id_to_unban, False)
+        ban_index.remove(user_id_to_unban) # Other workers follow on their next refresh
             
-        # We also need to reset their user_data if it's loaded
-        # This is a limitation of this simple model.
-        # A proper implementation would fetch and update the user's pickled data.
-            
-        await update.message.reply_text(f"User {user_id_to_unban} has been removed from the ban list. "
-                                        "They may need to type /start to reset their status.")
+        await update.message.reply_text(f"User {user_id_to_unban} has been removed from the ban list.")
     except (IndexError, ValueError):
         await update.message.reply_text("Usage: /unban <user_id>")
 
@@ -90,24 +86,133 @@ async def send_message_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Usage: /sendmsgall <message>")
         return
 
-    all_users = db_helpers.get_all_users(context)
-    sent_count = 0
-    failed_count = 0
-    
-    await update.message.reply_text(f"Starting broadcast to {len(all_users)} users. This may take time.")
-
-    for user_id in all_users:
-        try:
-            await context.bot.send_message(chat_id=user_id, text=message_text)
-            sent_count += 1
-        except TelegramError as e:
-            # User blocked the bot, etc.
-            print(f"Failed to send to {user_id}: {e}")
-            failed_count += 1
-            
-    await update.message.reply_text(
-        f"Broadcast complete.\n"
-        f"Successfully sent: {sent_count}\n"
-        f"Failed: {failed_count}"
-    )
-    
+    # Runs in the background; progress is edited into a status message
+    started = await broadcast.start(context.application, update.effective_chat.id, message_text)
+    if not started:
+        await update.message.reply_text("A broadcast is already running. Use /stopbroadcast to stop it.")
+
+
+async def stop_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+
+    if await broadcast.stop(context.application):
+        await update.message.reply_text("Stopping broadcast...")
+    else:
+        await update.message.reply_text("No broadcast is running.")
+
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+
+    try:
+        seconds = int(context.args[0]) if context.args else 10
+    except ValueError:
+        await update.message.reply_text("Usage: /profile <seconds>")
+        return
+    if not 1 <= seconds <= config.PROFILE_MAX_SECONDS:
+        await update.message.reply_text(f"Seconds must be between 1 and {config.PROFILE_MAX_SECONDS}.")
+        return
+    if not diagnostics.start_profile():
+        await update.message.reply_text("A profile is already running.")
+        return
+
+    await update.message.reply_text(f"Profiling the event loop for {seconds}s...")
+    # Runs in the background so this admin's next updates are not held up
+    context.application.create_task(_send_profile(update.message, seconds), update=update)
+
+async def _send_profile(message, seconds):
+    collapsed, samples = await diagnostics.finish_profile(seconds)
+    await message.reply_document(
+        document=collapsed.encode(), filename=f"profile-{int(time.time())}.txt",
+        caption=f"{samples} samples over {seconds}s, collapsed stacks (flamegraph.pl or speedscope). "
+                "Stacks ending in selectors:select are idle time.")
+
+
+async def slow_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+
+    text = diagnostics.report()
+    if not text:
+        await update.message.reply_text(
+            f"No slow updates (over {config.SLOW_UPDATE_THRESHOLD:g}s) or event-loop stalls recorded.")
+        return
+    d = diagnostics.stats()
+    await update.message.reply_document(
+        document=text.encode(), filename="slow-updates.txt",
+        caption=f"{d['slow_updates']} slow updates, {d['stalls']} event-loop stalls since start.")
+
+
+async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+
+    cache = result_cache.stats()
+    pool = worker_pool.stats()
+
+    lines = [
+        "<b>Result Cache</b>",
+        f"Hit rate: {cache['hit_rate']:.1%} "
+        f"(memory {cache['memory_hits']}, disk {cache['disk_hits']}, misses {cache['misses']})",
+        f"Memory: {cache['memory_items']} items, {cache['memory_bytes'] // 1024} KB",
+        "",
+        "<b>Conversion Pool</b>",
+        f"Workers: {pool['workers']} | Running: {pool['running']} | "
+        f"Waiting: {pool['waiting']} (max {pool['max_waiting']})",
+        f"Pixels in use: {pool['pixels_in_use']:,} / {pool['pixel_budget']:,}",
+    ]
+    for label, t in sorted(pool['timings'].items()):
+        lines.append(f"{label}: {t['count']}x, avg {t['avg'] * 1000:.0f} ms, max {t['max'] * 1000:.0f} ms")
+
+    lines += ["", "<b>API Queues</b>"]
+    for name, q in sorted(scheduler.all_stats().items()):
+        lines.append(f"{name}: {q['running']}/{q['concurrency']} running, {q['waiting']} waiting, "
+                     f"avg {q['avg_service_time']:.1f}s")
+
+    inputs = image_processing.input_stats()
+    saved = inputs['bytes_in'] - inputs['bytes_out']
+    lines += ["", "<b>Input Pre-processing</b>",
+              f"Photos: {inputs['photos']} | Saved: {saved // 1024} KB "
+              f"({saved / inputs['bytes_in'] if inputs['bytes_in'] else 0:.1%} of upload bytes)"]
+
+    moderation = moderation_index.stats()
+    lines += ["", "<b>Moderation Index</b>",
+              f"Sight Engine calls avoided: {moderation['avoided_rate']:.1%} "
+              f"(exact {moderation['exact_hits']}, near-duplicate {moderation['near_hits']}, "
+              f"API {moderation['api_calls']})",
+              f"Flagged hashes: {moderation['flagged_hashes']}"]
+
+    bans = ban_index.stats()
+    lines += ["", "<b>Ban Index</b>",
+              f"Banned: {bans['banned']} | Updates dropped at webhook: {bans['dropped']}"]
+
+    remote = resilience.stats()
+    lines += ["", "<b>Remote APIs</b>"]
+    for name, e in sorted(remote['endpoints'].items()):
+        lines.append(f"{name}: {e['state']} | latency {e['latency']:.1f}s, timeout {e['timeout']:.1f}s | "
+                     f"retries {e['retries']}, timeouts {e['timeouts']}, hedges {e['hedges']}, "
+                     f"rejected {e['rejected']}, failed {e['failed']}")
+    for k in remote['removebg_keys']:
+        benched = f", benched {k['benched_for']:.0f}s" if k['benched_for'] else ""
+        lines.append(f"key …{k['key']}: {k['requests']} requests, {k['credits']:g} credits, "
+                     f"{k['in_flight']} in flight{benched}")
+
+    uploads = file_id_index.stats()
+    lines += ["", "<b>Uploads</b>",
+              f"Sent by file_id: {uploads['reused']} | Uploaded: {uploads['uploaded']} | "
+              f"Stale file_ids: {uploads['invalidated']}"]
+
+    d = diagnostics.stats()
+    lines += ["", "<b>Event Loop</b>",
+              f"Lag: {d['lag_last'] * 1000:.0f} ms (max {d['lag_max'] * 1000:.0f} ms) | "
+              f"Stalls: {d['stalls']} | Slow updates: {d['slow_updates']} (/slow)"]
+
+    boot = startup.stats()
+    if boot['ready'] is not None:
+        lines += ["", "<b>Startup</b>",
+                  f"Ready in {boot['ready']:.2f}s: " + ", ".join(
+                      f"{name} {seconds:.2f}s" for name, seconds in boot['phases'].items())]
+
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
@@ -2,9 +2,20 @@ import config
 import db_helpers
 import safety_check
 import image_processing
-import os
+import result_cache
+import image_buffer
+import blob_store
+import state_backend
+import scheduler
+import album
+import renditions
+import file_id_index
+import moderation_index
+import ban_index
+import asyncio
+import io
+import zipfile
 import time
-from collections import deque
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import ContextTypes, ConversationHandler
 from telegram.constants import ParseMode
@@ -26,12 +37,10 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data['banned'] = False
         context.user_data['daily_limit'] = 3
         context.user_data['last_used_date'] = None
-        context.user_data['db_msg_id'] = None
-        context.user_data['is_processing'] = False
-        context.user_data['msg_timestamps'] = deque(maxlen=10)
     
     # Add user to global list (for /sendmsgall)
-    db_helpers.add_user_to_db(context, user.id)
+    await db_helpers.add_user_to_db(user.id)
+    await _take_awaiting_background(user.id)
     
     # Send welcome message with terms of service
     welcome_text = (
@@ -66,7 +75,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "2. <b>Safety Check:</b> I will first scan the photo for any explicit content. "
         "Uploading such content will result in a violation.\n"
         "3. <b>Background Removal:</b> If the photo is safe, I will remove its background and send it back to you.\n"
-        "4. <b>Convert:</b> After receiving the processed photo, you can choose to convert it into other formats like JPG, PDF, or ZIP.\n\n"
+        "4. <b>Convert:</b> After receiving the processed photo, you can choose to convert it into other formats like JPG, PDF, WEBP, TIFF or ZIP, or put it on a new background (a color, a blurred version of your photo, or a photo of your own).\n\n"
         "<b>Limits and Rules:</b>\n"
         f"• You can process <b>3 photos per day</b>.\n"
         f"• Admins have no limits.\n"
@@ -83,10 +92,10 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     admin = is_admin(user_id)
     
     # Ensure limits are fresh
-    db_helpers.check_daily_limit(context.user_data, admin)
+    await db_helpers.check_daily_limit(user_id, context.user_data, admin)
     
     # Get user data
-    violations = context.user_data.get('violations', 0)
+    violations = await db_helpers.get_violations(user_id, context.user_data)
     banned = context.user_data.get('banned', False)
     credits = context.user_data.get('daily_limit', 3)
     
@@ -112,7 +121,7 @@ async def show_credits_callback(update: Update, context: ContextTypes.DEFAULT_TY
     admin = is_admin(user_id)
     
     # Ensure limits are fresh
-    db_helpers.check_daily_limit(context.user_data, admin)
+    await db_helpers.check_daily_limit(user_id, context.user_data, admin)
     
     credits = context.user_data.get('daily_limit', 3)
     
@@ -128,22 +137,27 @@ async def handle_spam_and_ban(update: Update, context: ContextTypes.DEFAULT_TYPE
     user_id = update.effective_user.id
     user_data = context.user_data
     
-    # 1. Check if banned
-    if user_data.get('banned', False):
+    backend = state_backend.get()
+    
+    # 1. Check if banned (the state backend is the ban list, shared by all workers;
+    #    user_data['banned'] only mirrors it for the stats message)
+    if user_data.get('banned') and not user_data.get('ban_shared'):
+        await backend.set_banned(user_id, True) # Banned by an older version, in user_data only
+    user_data['ban_shared'] = True
+    user_data['banned'] = await backend.is_banned(user_id)
+    if user_data['banned']:
         return True # User is banned
         
     # 2. Check for spam (Requirement #8)
     if not is_admin(user_id):
-        timestamps = user_data.get('msg_timestamps', deque(maxlen=10))
-        timestamps.append(time.time())
-        user_data['msg_timestamps'] = timestamps
-        
-        # 10 messages in 5 seconds
-        if len(timestamps) == 10 and (timestamps[-1] - timestamps[0]) < 5:
+        # 10 messages in 5 seconds, counted across all workers
+        if await backend.hit_window(f"spam:{user_id}", 5) >= 10:
             user_data['banned'] = True
+            await backend.set_banned(user_id, True)
+            ban_index.add(user_id)
             ban_reason = f"**User Banned for Spamming**\nUser ID: `{user_id}`"
             await db_helpers.log_event_to_db(context, ban_reason)
-            await update_db_channel_message(context, update.effective_user)
+            await db_helpers.update_db_channel_message(context, update.effective_user)
             
             button = [[InlineKeyboardButton("Contact Support", url="https://t.me/Pro_Support_24_7_Bot/")]] # এখানে আপনার লিংক দিন
             await update.message.reply_text(
@@ -157,111 +171,389 @@ async def handle_spam_and_ban(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    user_data = context.user_data
+    # Albums are collected and processed as one batch
+    if update.message.media_group_id:
+        await album.collect(update, context, _process_album)
+        return
 
     # Check for spam or existing ban
     if await handle_spam_and_ban(update, context):
         return
 
-    # Check concurrency lock (Requirement #5)
-    if user_data.get('is_processing', False):
-        await update.message.reply_text("I am currently processing your previous request. Please wait.")
+    # The user pressed "Custom Background" and this photo is the new background
+    context.user_data.pop('awaiting_background', None) # Per-process flag of older versions
+    if await _take_awaiting_background(update.effective_user.id):
+        await _apply_custom_background(update, context)
         return
 
-    user_data['is_processing'] = True
+    # Same-user updates are already serialized by UserOrderedUpdateProcessor (Requirement #5);
+    # a later photo simply waits its turn.
+    await _process_photo(update, context)
+
+
+async def _acquire_processing_lock(backend, lock_key):
+    """
+    Waits for the user's processing lock, which is only contended when another
+    worker process is handling the same user. Returns the token, or None on timeout.
+    """
+    deadline = time.monotonic() + config.PROCESSING_LOCK_LEASE
+    while True:
+        token = await backend.acquire_lock(lock_key, config.PROCESSING_LOCK_LEASE)
+        if token is not None or time.monotonic() >= deadline:
+            return token
+        await asyncio.sleep(0.5)
+
+
+def _choose_photo_size(photo_sizes):
+    """
+    Picks the smallest PhotoSize with at least INPUT_TARGET_MP megapixels
+    (Telegram lists them smallest first). Falls back to the largest.
+    """
+    target = config.INPUT_TARGET_MP * 1_000_000
+    if target > 0:
+        for size in photo_sizes:
+            if size.width * size.height >= target:
+                return size
+    return photo_sizes[-1]
+
+
+async def _prepare_photo(photo, user_id, admin, largest_size=None):
+    """
+    Cache lookup, download, upload pre-processing and safety check for one photo.
+    Returns (processed_bytes, digest, photo_buffer, is_explicit); processed_bytes is set on
+    a cache hit, is_explicit is None if the safety check could not be made.
+    The caller must close photo_buffer.
+    """
+    # Re-sent or forwarded photos are answered from the cache without any API call
+    processed_bytes, digest = await result_cache.get(unique_id=photo.file_unique_id)
+    if processed_bytes is not None:
+        return processed_bytes, digest, None, False
     
+    # Download photo into memory (no working-directory files)
+    photo_file = await photo.get_file()
+    photo_buffer = await image_buffer.download(photo_file, photo.file_size)
     try:
-        # Download photo
-        photo_file = await update.message.photo[-1].get_file()
-        file_path = f"{user.id}_input.jpg"
-        await photo_file.download_to_drive(file_path)
+        digest = result_cache.content_hash(photo_buffer.view)
+        processed_bytes, _ = await result_cache.get(unique_id=photo.file_unique_id, digest=digest)
+        if processed_bytes is not None:
+            return processed_bytes, digest, photo_buffer, False
+        
+        # Shrink what we upload (the cache stays keyed by the downloaded photo)
+        smaller, saved = await image_processing.prepare_upload(photo_buffer.view, largest_size)
+        if smaller is not None:
+            photo_buffer.close()
+            photo_buffer = image_buffer.ImageBuffer(smaller)
+        if saved:
+            print(f"Upload for user {user_id} is {saved // 1024} KB smaller after pre-processing")
+        
+        # 1. Sight Engine Check (Requirement #1), skipped for photos the moderation index already knows
+        async def check_api():
+            return await scheduler.get('sightengine').run(
+                user_id, lambda: safety_check.check_image(photo_buffer.view), priority=admin)
+        is_explicit = await moderation_index.check(photo_buffer.view, digest, check_api)
+        return None, digest, photo_buffer, is_explicit
+    except Exception:
+        photo_buffer.close()
+        raise
+
 
-        # 1. Sight Engine Check (Requirement #1)
-        is_explicit = await safety_check.check_image(file_path)
+async def _remove_background(photo, photo_buffer, digest, user_id, admin, is_explicit, on_wait=None):
+    processed_bytes = await scheduler.get('removebg').run(
+        user_id, lambda: image_processing.remove_background(photo_buffer.view),
+        priority=admin, on_wait=on_wait)
+    
+    # Only cache results for images that passed the safety check
+    if processed_bytes and is_explicit is False:
+        await result_cache.put(digest, processed_bytes, unique_id=photo.file_unique_id)
+    return processed_bytes
+
+
+def _forget_legacy_result(user_data):
+    # The last result now lives in the state backend (db_helpers.set_last_result)
+    for key in ('last_processed_ref', 'last_original_file_id', 'last_processed_bytes'):
+        user_data.pop(key, None)
+
+
+async def _record_violation(message, context, user, count=1):
+    user_data = context.user_data
+    violations = await db_helpers.add_violations(user.id, user_data, count)
+    await message.reply_text(
+        "**Warning:** Your image was detected as explicit content. "
+        "This violation has been recorded. "
+        f"You now have {violations} of 5 violations."
+    )
+    
+    # Check for ban (Requirement #7)
+    if violations >= 5:
+        user_data['banned'] = True
+        await state_backend.get().set_banned(user.id, True)
+        ban_index.add(user.id)
+        ban_reason = f"**User Banned for Violations**\nUser ID: `{user.id}`\nViolations: 5"
+        await db_helpers.log_event_to_db(context, ban_reason)
         
-        if is_explicit and not is_admin(user.id):
+        button = [[InlineKeyboardButton("Contact Support", url="LINK_HERE")]] # এখানে আপনার লিংক দিন
+        await message.reply_text(
+            "You have been **banned** for accumulating 5 violations. "
+            "Contact support to appeal.",
+            reply_markup=InlineKeyboardMarkup(button)
+        )
+    
+    await db_helpers.update_db_channel_message(context, user)
+
+
+async def _delete_message(message):
+    try:
+        await message.delete()
+    except Exception as e:
+        print(f"Could not delete message: {e}")
+
+
+def _conversion_buttons():
+    """
+    One button per registered output format (see image_processing.FORMATS), two per row.
+    """
+    labels = {'ZIP': "ZIP (PNG inside)"}
+    formats = [f for f in image_processing.available_formats() if f != 'PNG']
+    buttons = [InlineKeyboardButton(labels.get(f, f), callback_data=f"convert_{f}") for f in formats]
+    rows = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    # Background replacement, done locally without another remove.bg call
+    rows.append([InlineKeyboardButton(f"{name.title()} Background", callback_data=f"bg_{name}")
+                 for name in image_processing.BACKGROUND_COLORS])
+    rows.append([InlineKeyboardButton("Blurred Background", callback_data="bg_blur"),
+                 InlineKeyboardButton("Custom Background", callback_data="bg_custom")])
+    return InlineKeyboardMarkup(rows)
+
+
+async def _process_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    user_data = context.user_data
+
+    backend = state_backend.get()
+    lock_key = f"processing:{user.id}"
+    lock_token = await _acquire_processing_lock(backend, lock_key)
+    if lock_token is None:
+        await update.message.reply_text("I am currently processing your previous request. Please wait.")
+        return
+    
+    photo_buffer = None
+    admin = is_admin(user.id)
+    charged = False
+    processed_bytes = None
+    
+    try:
+        photo = _choose_photo_size(update.message.photo)
+        processed_bytes, digest, photo_buffer, is_explicit = await _prepare_photo(
+            photo, user.id, admin, largest_size=update.message.photo[-1].file_size)
+
+        if is_explicit and not admin:
             # Delete user's message
-            try:
-                await update.message.delete()
-            except Exception as e:
-                print(f"Could not delete message: {e}")
-                
-            user_data['violations'] = user_data.get('violations', 0) + 1
-            await update.message.reply_text(
-                "**Warning:** Your image was detected as explicit content. "
-                "This violation has been recorded. "
-                f"You now have {user_data['violations']} of 5 violations."
-            )
-            
-            # Check for ban (Requirement #7)
-            if user_data['violations'] >= 5:
-                user_data['banned'] = True
-                ban_reason = f"**User Banned for Violations**\nUser ID: `{user.id}`\nViolations: 5"
-                await db_helpers.log_event_to_db(context, ban_reason)
-                
-                button = [[InlineKeyboardButton("Contact Support", url="LINK_HERE")]] # এখানে আপনার লিংক দিন
-                await update.message.reply_text(
-                    "You have been **banned** for accumulating 5 violations. "
-                    "Contact support to appeal.",
-                    reply_markup=InlineKeyboardMarkup(button)
-                )
-            
-            await db_helpers.update_db_channel_message(context, user)
+            await _delete_message(update.message)
+            await _record_violation(update.message, context, user)
             return # Stop processing
+        if is_explicit is None and not admin:
+            # Sight Engine is down (or its circuit is open): nothing is charged
+            await update.message.reply_text(
+                "Sorry, I could not check your photo right now. Please try again later.")
+            return
 
-        # 2. Check Daily Limit (Requirement #6)
-        admin = is_admin(user.id)
-        if not db_helpers.check_daily_limit(user_data, admin):
+        # 2. Check Daily Limit (Requirement #6) - the credit is reserved atomically up front
+        if not await db_helpers.use_credit(user.id, user_data, admin):
             await update.message.reply_text("You have reached your daily limit of 3 photo removals.")
             return
+        charged = True
 
-        # 3. Process Image
-        processing_msg = await update.message.reply_text("Processing your image. Please wait...")
-        processed_bytes = await image_processing.remove_background(file_path)
+        # 3. Process Image (skipped on a cache hit)
+        processing_msg = None
+        if processed_bytes is None:
+            processing_msg = await update.message.reply_text("Processing your image. Please wait...")
+            
+            async def show_queue_position(position, eta):
+                await processing_msg.edit_text(
+                    f"Processing your image. You are #{position} in line (about {eta:.0f}s). Please wait...")
+            
+            processed_bytes = await _remove_background(
+                photo, photo_buffer, digest, user.id, admin, is_explicit, on_wait=show_queue_position)
         
         if processed_bytes:
-            # Use credit
-            db_helpers.use_credit(user_data, admin)
             # Update DB channel
             await db_helpers.update_db_channel_message(context, user)
             
-            # Save bytes for conversion
-            context.user_data['last_processed_bytes'] = processed_bytes
+            # Save a reference for conversion (the bytes live in the blob store, not in user_data)
+            ref = await blob_store.put(processed_bytes)
+            await db_helpers.set_last_result(user.id, ref, photo.file_id)
+            _forget_legacy_result(context.user_data)
+            # Start rendering the popular formats before the user presses a button
+            renditions.prefetch(ref, processed_bytes)
             
-            # Send processed image as document
-            await update.message.reply_document(
-                document=processed_bytes,
-                filename="background_removed.png"
-            )
+            # Send processed image as document (by file_id if this exact result was sent before)
+            async def load_result():
+                return processed_bytes
+            await file_id_index.send_document(
+                update.message, file_id_index.make_key(ref, 'PNG'), "background_removed.png", load_result)
             
             # Ask for conversion (Requirement: infinite formats)
-            # We provide a few common ones as requested.
-            buttons = [
-                [InlineKeyboardButton("JPG", callback_data="convert_JPG"),
-                 InlineKeyboardButton("PDF", callback_data="convert_PDF")],
-                [InlineKeyboardButton("ZIP (PNG inside)", callback_data="convert_ZIP")]
-                # আপনি এখানে বাটন যোগ করতে পারেন
-            ]
             await update.message.reply_text(
                 "Would you like to convert this file to another format?",
-                reply_markup=InlineKeyboardMarkup(buttons)
+                reply_markup=_conversion_buttons()
             )
-            await processing_msg.delete()
+            if processing_msg:
+                await processing_msg.delete()
 
         else:
+            # Give the reserved credit back
+            await db_helpers.refund_credit(user.id, user_data, admin)
+            charged = False
             await processing_msg.edit_text("Sorry, an error occurred while removing the background.")
 
     except Exception as e:
         print(f"Error in handle_photo: {e}")
+        if charged and not processed_bytes:
+            await db_helpers.refund_credit(user.id, user_data, admin)
         await update.message.reply_text("An error occurred. Please try again.")
         
     finally:
-        # Clean up local file
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        # Release the photo buffer (and spill file, if any)
+        if photo_buffer is not None:
+            photo_buffer.close()
         # Release lock
-        user_data['is_processing'] = False
+        await backend.release_lock(lock_key, lock_token)
+
+
+def _zip_results(results):
+    output_bytes = io.BytesIO()
+    # PNGs are already compressed; store them as-is
+    with zipfile.ZipFile(output_bytes, 'w', compression=zipfile.ZIP_STORED) as zf:
+        for n, png in enumerate(results, 1):
+            zf.writestr(f"background_removed_{n}.png", png)
+    return output_bytes.getvalue()
+
+
+async def _process_album(updates, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Processes all photos of one album: one spam-window entry, one credit charge,
+    concurrent safety checks and removals, and one reply (album or ZIP).
+    """
+    first = updates[0]
+    user = first.effective_user
+    user_data = context.user_data
+    admin = is_admin(user.id)
+
+    # Check for spam or existing ban (once for the whole album)
+    if await handle_spam_and_ban(first, context):
+        return
+
+    backend = state_backend.get()
+    lock_key = f"processing:{user.id}"
+    lock_token = await _acquire_processing_lock(backend, lock_key)
+    if lock_token is None:
+        await first.message.reply_text("I am currently processing your previous request. Please wait.")
+        return
+
+    prepared = []
+    granted = 0
+    delivered = 0
+    try:
+        processing_msg = await first.message.reply_text(f"Processing your album of {len(updates)} photos. Please wait...")
+        
+        photos = [_choose_photo_size(u.message.photo) for u in updates]
+        prepared = await asyncio.gather(
+            *(_prepare_photo(photo, user.id, admin, largest_size=u.message.photo[-1].file_size)
+              for photo, u in zip(photos, updates)), return_exceptions=True)
+        
+        # Any explicit image stops the whole album
+        explicit = [u for u, p in zip(updates, prepared) if not isinstance(p, Exception) and p[3]]
+        if explicit and not admin:
+            for u in explicit:
+                await _delete_message(u.message)
+            await processing_msg.delete()
+            await _record_violation(first.message, context, user, count=len(explicit))
+            return
+
+        usable = [(photo, p) for photo, p in zip(photos, prepared) if not isinstance(p, Exception)]
+        # Photos the safety check could not be made for are not processed (or charged)
+        unchecked = 0
+        if not admin:
+            unchecked = sum(1 for _, p in usable if p[3] is None)
+            usable = [(photo, p) for photo, p in usable if p[3] is not None]
+            if unchecked and not usable:
+                await processing_msg.edit_text(
+                    "Sorry, I could not check your photos right now. Please try again later.")
+                return
+        
+        # 2. Check Daily Limit (Requirement #6) - one atomic charge for the whole album
+        granted = await db_helpers.use_credit(user.id, user_data, admin, amount=len(usable))
+        if not granted:
+            await processing_msg.edit_text("You have reached your daily limit of 3 photo removals.")
+            return
+        skipped = len(usable) - granted
+        usable = usable[:granted]
+
+        # 3. Remove backgrounds concurrently (cache hits are used directly)
+        async def finish(photo, p):
+            processed_bytes, digest, photo_buffer, is_explicit = p
+            if processed_bytes is not None:
+                return processed_bytes
+            return await _remove_background(photo, photo_buffer, digest, user.id, admin, is_explicit)
+
+        outputs = await asyncio.gather(*(finish(photo, p) for photo, p in usable), return_exceptions=True)
+        done = [(photo, out) for (photo, _), out in zip(usable, outputs) if out and not isinstance(out, Exception)]
+        results = [out for _, out in done]
+        delivered = len(results)
+        
+        if delivered < granted:
+            await db_helpers.refund_credit(user.id, user_data, admin, amount=granted - delivered)
+            granted = delivered
+        
+        if not results:
+            await processing_msg.edit_text("Sorry, an error occurred while removing the background.")
+            return
+
+        await db_helpers.update_db_channel_message(context, user)
+        await db_helpers.set_last_result(user.id, await blob_store.put(results[-1]), done[-1][0].file_id)
+        _forget_legacy_result(context.user_data)
+
+        refs = [blob_store.make_ref(png) for png in results]
+        if config.ALBUM_RESULT_MODE == 'zip' or len(results) == 1:
+            if len(results) == 1:
+                async def load_result():
+                    return results[0]
+                await file_id_index.send_document(
+                    first.message, file_id_index.make_key(refs[0], 'PNG'), "background_removed.png", load_result)
+            else:
+                # The archive is only built if this exact set of results was never sent before
+                async def load_archive():
+                    return await asyncio.to_thread(_zip_results, results)
+                archive_ref = blob_store.make_ref("".join(refs).encode())
+                await file_id_index.send_document(
+                    first.message, file_id_index.make_key(archive_ref, 'ZIP'), "background_removed.zip", load_archive)
+        else:
+            items = [(file_id_index.make_key(r, 'PNG'), f"background_removed_{n}.png", png)
+                     for n, (r, png) in enumerate(zip(refs, results), 1)]
+            await file_id_index.send_media_group(first.message, items)
+
+        notes = []
+        failed = len(updates) - skipped - delivered - unchecked
+        if failed:
+            notes.append(f"{failed} photo(s) could not be processed.")
+        if unchecked:
+            notes.append(f"{unchecked} photo(s) could not be checked right now; please try again later.")
+        if skipped:
+            notes.append(f"{skipped} photo(s) were skipped: daily limit reached.")
+        if notes:
+            await first.message.reply_text(" ".join(notes))
+        await processing_msg.delete()
+
+    except Exception as e:
+        print(f"Error in album processing: {e}")
+        if granted > delivered:
+            await db_helpers.refund_credit(user.id, user_data, admin, amount=granted - delivered)
+        await first.message.reply_text("An error occurred. Please try again.")
+
+    finally:
+        for p in prepared:
+            if not isinstance(p, Exception) and p[2] is not None:
+                p[2].close()
+        await backend.release_lock(lock_key, lock_token)
 
 
 async def handle_conversion(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -269,26 +561,162 @@ async def handle_conversion(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
 
     target_format = query.data.split('_')[1] # e.g., 'JPG'
+    fmt = target_format.upper()
     
-    image_bytes = context.user_data.get('last_processed_bytes')
+    ref, original_file_id = await db_helpers.get_last_result(query.from_user.id, context.user_data)
+    legacy_bytes = None
+    if not ref:
+        # Users processed before the blob store kept the bytes inline
+        legacy_bytes = context.user_data.pop('last_processed_bytes', None)
+        if legacy_bytes:
+            ref = await blob_store.put(legacy_bytes)
+            await db_helpers.set_last_result(query.from_user.id, ref, original_file_id)
     
-    if not image_bytes:
+    if not ref:
         await query.edit_message_text("Sorry, I cannot find the original image to convert. Please send a new photo.")
         return
+    if fmt not in image_processing.FORMATS:
+        await query.edit_message_text(f"Sorry, I cannot convert to {target_format}.")
+        return
 
+    await _take_awaiting_background(query.from_user.id) # Any other action cancels "Custom Background"
     await query.edit_message_text(f"Converting to {target_format}...")
     
-    converted_bytes, filename = await image_processing.convert_format(image_bytes, target_format)
+    # Only touched if this rendition has no file_id yet
+    missing_source = False
+    async def load_rendition():
+        nonlocal missing_source
+        image_bytes = legacy_bytes or await blob_store.get(ref)
+        if not image_bytes:
+            missing_source = True
+            return None
+        converted_bytes, _ = await renditions.get(ref, image_bytes, fmt)
+        return converted_bytes
     
-    if converted_bytes:
-        await query.message.reply_document(
-            document=converted_bytes,
-            filename=filename
-        )
+    sent = await file_id_index.send_document(
+        query.message, file_id_index.make_key(ref, fmt), image_processing.FORMATS[fmt]['filename'], load_rendition)
+    
+    if sent:
         await query.edit_message_text("Here is your converted file.")
+    elif missing_source:
+        await query.edit_message_text("Sorry, I cannot find the original image to convert. Please send a new photo.")
     else:
         await query.edit_message_text(f"Sorry, I cannot convert to {target_format}.")
 
+async def _send_with_background(message, ref, mode, variant, color=None, load_background=None):
+    """
+    Sends the last result on a new background. `variant` identifies the background
+    (color name, original photo, custom photo id) so repeats are sent by file_id.
+    Returns the sent Message, or None.
+    """
+    async def load():
+        png = await blob_store.get(ref)
+        if png is None:
+            return None
+        background_bytes = None
+        if load_background:
+            background_bytes = await load_background()
+            if background_bytes is None:
+                return None
+        mask = await image_processing.get_mask(ref)
+        return await image_processing.replace_background(png, mode, color, background_bytes, mask)
+
+    key = file_id_index.make_key(blob_store.make_ref(f"background:{ref}:{mode}:{variant}".encode()), 'JPG')
+    return await file_id_index.send_document(message, key, "background_replaced.jpg", load)
+
+
+async def handle_background(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    choice = query.data.split('_', 1)[1] # e.g., 'white', 'blur', 'custom'
+    ref, file_id = await db_helpers.get_last_result(query.from_user.id, context.user_data)
+    if not ref:
+        await query.edit_message_text("Sorry, I cannot find the processed image. Please send a new photo.")
+        return
+
+    if choice == 'custom':
+        # Shared by all workers; expires if no photo follows
+        await state_backend.get().set_value(
+            _awaiting_key(query.from_user.id), True, ttl=config.CUSTOM_BACKGROUND_TIMEOUT)
+        await query.message.reply_text("Send me the photo you want as the new background.")
+        return
+    await _take_awaiting_background(query.from_user.id)
+
+    if choice == 'blur':
+        if not file_id:
+            await query.edit_message_text("Sorry, the original photo is not available. Please send a new photo.")
+            return
+        
+        async def load_original():
+            original = await context.bot.get_file(file_id)
+            return await original.download_as_bytearray()
+        mode, variant, color, load_background = 'blur', 'original', None, load_original
+    elif choice in image_processing.BACKGROUND_COLORS:
+        mode, variant, color, load_background = 'color', choice, image_processing.BACKGROUND_COLORS[choice], None
+    else:
+        return
+
+    await query.edit_message_text("Replacing the background...")
+    sent = await _send_with_background(query.message, ref, mode, variant, color, load_background)
+    if sent:
+        await query.edit_message_text("Here is your image with the new background.")
+    else:
+        await query.edit_message_text("Sorry, I could not replace the background. Please send a new photo.")
+
+
+def _awaiting_key(user_id):
+    return f"awaiting_background:{user_id}"
+
+async def _take_awaiting_background(user_id):
+    """
+    Clears the "Custom Background" request. Returns True if one was pending.
+    """
+    backend = state_backend.get()
+    if not await backend.get_value(_awaiting_key(user_id)):
+        return False
+    await backend.delete_value(_awaiting_key(user_id))
+    return True
+
+
+async def _apply_custom_background(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    ref, _ = await db_helpers.get_last_result(user.id, context.user_data)
+    if not ref:
+        await update.message.reply_text("Sorry, I cannot find the processed image. Please send a new photo.")
+        return
+
+    admin = is_admin(user.id)
+    background = update.message.photo[-1]
+    verdict = False
+    async def load_custom():
+        # Only runs for a background not used before; it gets the same safety check as any photo
+        nonlocal verdict
+        background_file = await background.get_file()
+        background_bytes = await background_file.download_as_bytearray()
+        async def check_api():
+            return await scheduler.get('sightengine').run(
+                user.id, lambda: safety_check.check_image(background_bytes), priority=admin)
+        verdict = await moderation_index.check(
+            background_bytes, result_cache.content_hash(background_bytes), check_api)
+        if verdict is None or (verdict and not admin):
+            return None
+        return background_bytes
+
+    processing_msg = await update.message.reply_text("Replacing the background...")
+    sent = await _send_with_background(update.message, ref, 'image', background.file_unique_id, load_background=load_custom)
+    if sent:
+        await processing_msg.delete()
+    elif verdict is None:
+        await processing_msg.edit_text("Sorry, I could not check this photo right now. Please try again later.")
+    elif verdict and not admin:
+        await processing_msg.delete()
+        await _delete_message(update.message)
+        await _record_violation(update.message, context, user)
+    else:
+        await processing_msg.edit_text("Sorry, I could not replace the background. Please send a new photo.")
+
+
 # Handler to ignore messages in groups/channels
 async def ignore_non_private_chats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Requirement #12: Bot should not work in groups/channels
@@ -0,0 +1,63 @@
+import aiohttp
+import asyncio
+import config
+
+# One long-lived session shared by remove.bg and Sight Engine calls.
+# Keeps TCP/TLS connections alive between requests and caches DNS lookups.
+_session = None
+
+async def start():
+    """
+    Creates the shared session. Called once when the Application starts.
+    """
+    global _session
+    if _session is not None and not _session.closed:
+        return _session
+
+    connector = aiohttp.TCPConnector(
+        limit=config.HTTP_POOL_LIMIT,
+        limit_per_host=config.HTTP_POOL_LIMIT_PER_HOST,
+        keepalive_timeout=config.HTTP_KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=config.HTTP_DNS_CACHE_TTL,
+        use_dns_cache=True,
+    )
+    timeout = aiohttp.ClientTimeout(
+        total=config.HTTP_TIMEOUT,
+        sock_connect=config.HTTP_CONNECT_TIMEOUT,
+    )
+    _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return _session
+
+def get_session():
+    """
+    Returns the shared session. start() must have been awaited first.
+    """
+    if _session is None or _session.closed:
+        raise RuntimeError("HTTP client not started. Call http_client.start() on startup.")
+    return _session
+
+async def close():
+    """
+    Closes the shared session and its pooled connections on shutdown.
+    """
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+async def warm_up(urls):
+    """
+    Opens a pooled connection to each URL's host (DNS, TCP and TLS) so the first
+    real request does not pay for it. Any response counts; failures are ignored.
+    """
+    session = get_session()
+    timeout = aiohttp.ClientTimeout(total=config.WARM_UP_TIMEOUT)
+
+    async def _touch(url):
+        try:
+            async with session.head(url, timeout=timeout, allow_redirects=False) as response:
+                await response.read()
+        except Exception as e:
+            print(f"Warm-up of {url} failed: {e}")
+
+    await asyncio.gather(*(_touch(url) for url in urls))
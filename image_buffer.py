@@ -0,0 +1,57 @@
+import config
+import metrics
+import mmap
+import os
+import tempfile
+
+class ImageBuffer:
+    """
+    Holds a downloaded photo for the rest of the pipeline.
+    `view` is a memoryview over the bytes, so the safety check, hashing and remove.bg
+    all read the same buffer without copying it.
+    Small photos live in memory; oversized ones are spilled to a temp file and mmapped.
+    """
+
+    def __init__(self, data, path=None, mapped=None):
+        self._data = data
+        self._path = path
+        self._mapped = mapped
+        self.view = memoryview(data)
+
+    def __len__(self):
+        return len(self.view)
+
+    def close(self):
+        self.view.release()
+        if self._mapped is not None:
+            self._mapped.close()
+            self._mapped = None
+        if self._path and os.path.exists(self._path):
+            os.remove(self._path)
+            self._path = None
+        self._data = None
+
+async def download(photo_file, file_size=None):
+    """
+    Downloads a telegram.File into an ImageBuffer.
+    """
+    size = file_size or photo_file.file_size or 0
+
+    with metrics.timer('download'):
+        if size <= config.PHOTO_SPILL_BYTES:
+            data = await photo_file.download_as_bytearray()
+            metrics.add_bytes('telegram_download', len(data))
+            return ImageBuffer(data)
+
+        # Oversized: stream to a unique temp file and map it instead of holding it in RAM
+        fd, path = tempfile.mkstemp(suffix='.jpg', dir=config.PHOTO_SPILL_DIR)
+        os.close(fd)
+        try:
+            await photo_file.download_to_drive(path)
+            with open(path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            os.remove(path)
+            raise
+        metrics.add_bytes('telegram_download', len(mapped))
+        return ImageBuffer(mapped, path=path, mapped=mapped)
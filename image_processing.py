@@ -1,77 +1,339 @@
 import aiohttp
 import config
-from PIL import Image
+import http_client
+import worker_pool
+import blob_store
+import metrics
+import resilience
+import importlib.util
 import io
 import zipfile
 
-async def remove_background(image_path):
+# Pillow is imported inside the functions that use it, so starting the bot does not
+# pay for it. load_pillow() brings it in right after startup instead.
+
+def load_pillow():
+    """
+    Imports Pillow and all its format plugins. Run in the background once the bot
+    accepts traffic (see main.post_init), so the first photo does not wait for it.
+    """
+    importlib.import_module('PIL.ImageFilter')
+    importlib.import_module('PIL.ImageOps')
+    importlib.import_module('PIL.Image').init()
+
+async def _removebg_attempt(image_data):
+    """
+    One remove.bg request using the least-loaded API key.
+    Returns the response body, None on a permanent error (e.g. unreadable image),
+    or raises resilience.RetryableError.
+    """
+    key = resilience.removebg_keys.acquire()
+    status, headers = None, {}
+    try:
+        data = aiohttp.FormData()
+        data.add_field('image_file', image_data, filename='image.jpg',
+                       content_type='application/octet-stream')
+        data.add_field('size', 'auto')
+        if config.RBG_FORMAT == 'zip':
+            data.add_field('format', 'zip')
+        metrics.add_bytes('removebg_upload', len(image_data))
+
+        request_headers = {'X-Api-Key': key['key']}
+        
+        async with http_client.get_session().post(config.RBG_API_URL, data=data, headers=request_headers) as response:
+            status, headers = response.status, response.headers
+            if status == 200:
+                body = await response.read()
+                metrics.add_bytes('removebg_download', len(body))
+                return body
+            metrics.error('removebg', f"http_{status}")
+            print(f"Remove.bg Error: {status} - {await response.text()}")
+    finally:
+        resilience.removebg_keys.release(key, status, headers)
+
+    if status in (401, 402, 403, 429):
+        # This key is benched for now; the next attempt picks another one if there is one
+        raise resilience.RetryableError(f"remove.bg key rejected ({status})",
+                                        retry_after=resilience.removebg_keys.wait_time(), trip=False,
+                                        responded=True)
+    if status >= 500:
+        raise resilience.RetryableError(f"remove.bg returned {status}",
+                                        retry_after=resilience.parse_retry_after(headers.get('Retry-After')))
+    return None
+
+async def remove_background(image_data):
     """
     Removes background from an image.
+    `image_data` is a bytes-like object (bytes or memoryview); it is streamed as-is.
     Returns bytes of the processed image (PNG) or None if failed.
     """
-    if not config.RBG_API:
+    if not config.RBG_API_KEYS:
         print("Error: Remove.bg API key (RBG_API) not set.")
         return None
         
+    with metrics.timer('removebg'):
+        try:
+            body = await resilience.removebg.call(lambda: _removebg_attempt(image_data), size=len(image_data))
+        except resilience.Unavailable as e:
+            metrics.error('removebg', 'unavailable')
+            print(f"Remove.bg unavailable: {e}")
+            return None
+        except Exception as e:
+            metrics.error('removebg', type(e).__name__)
+            print(f"Error in remove_background: {e}")
+            return None
+
+    if body is not None and config.RBG_FORMAT == 'zip':
+        try:
+            return await _rebuild_from_zip(body)
+        except Exception as e:
+            print(f"Error rebuilding remove.bg ZIP result: {e}")
+            return None
+    return body
+
+# --- Alpha-mask transport (RBG_FORMAT=zip) ---
+# remove.bg's ZIP holds color.jpg (the subject, background filled in) and alpha.png
+# (the mask). Putting the mask into the JPEG's alpha channel gives the same RGBA result.
+
+def _zip_pixels(zip_bytes):
+    with zipfile.ZipFile(io.BytesIO(zip_bytes)) as zf:
+        return image_pixels(zf.read('color.jpg'))
+
+def _composite_zip(zip_bytes):
+    """
+    Returns (rgba_png, alpha_png) built from a remove.bg ZIP.
+    """
+    from PIL import Image
+    with zipfile.ZipFile(io.BytesIO(zip_bytes)) as zf:
+        color_jpg = zf.read('color.jpg')
+        alpha_png = zf.read('alpha.png')
+    img = Image.open(io.BytesIO(color_jpg)).convert('RGB')
+    alpha = Image.open(io.BytesIO(alpha_png)).convert('L')
+    if alpha.size != img.size:
+        alpha = alpha.resize(img.size, Image.BILINEAR)
+    img.putalpha(alpha)
+    return _save(img, format='PNG'), alpha_png
+
+def mask_ref(png_ref):
+    """
+    Blob store reference of the alpha mask that belongs to a result PNG.
+    """
+    return blob_store.make_ref(f"mask:{png_ref}".encode())
+
+async def get_mask(png_ref):
+    """
+    Returns the alpha mask (grayscale PNG) kept for a result, or None.
+    """
+    return await blob_store.get(mask_ref(png_ref))
+
+async def _rebuild_from_zip(zip_bytes):
+    png, alpha_png = await worker_pool.run(_zip_pixels(zip_bytes), _composite_zip, zip_bytes,
+                                           label='composite_zip')
+    # Keep the mask; background replacement cuts the subject out with it (get_mask)
+    await blob_store.put(alpha_png, ref=mask_ref(blob_store.make_ref(png)))
+    return png
+
+def image_pixels(image_bytes):
+    """
+    Returns width*height from the image header (does not decode pixel data).
+    """
+    from PIL import Image
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        return img.width * img.height
+
+def _shrink_for_upload(image_bytes, max_pixels, quality):
+    """
+    Downscales to at most `max_pixels` and/or re-encodes as JPEG.
+    Returns the new bytes, or None if that would not make the upload smaller.
+    """
+    from PIL import Image
+    img = Image.open(io.BytesIO(image_bytes))
+    resized = False
+    if max_pixels and img.width * img.height > max_pixels:
+        scale = (max_pixels / (img.width * img.height)) ** 0.5
+        size = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+        img.draft('RGB', size) # Lets the JPEG decoder skip most of the work
+        img = img.convert('RGB')
+        img.thumbnail(size, Image.LANCZOS)
+        resized = True
+    elif not quality:
+        return None
+    output = _save(img.convert('RGB'), format='JPEG', quality=quality or 90, optimize=True)
+    if not resized and len(output) >= len(image_bytes):
+        return None
+    return output
+
+_input_stats = {'photos': 0, 'bytes_in': 0, 'bytes_out': 0}
+
+async def prepare_upload(image_bytes, original_size=None):
+    """
+    Shrinks a downloaded photo before it is uploaded to the APIs, as configured by
+    INPUT_MAX_MP / INPUT_JPEG_QUALITY. `original_size` is the size of the largest
+    Telegram variant, so savings from picking a smaller variant are counted too.
+    Returns (bytes, bytes_saved); bytes is None if the input should be used as-is.
+    """
+    output = None
+    if config.INPUT_MAX_MP or config.INPUT_JPEG_QUALITY:
+        # A memoryview cannot be sent to a process pool
+        payload = bytes(image_bytes) if config.CONVERT_POOL_KIND == 'process' else image_bytes
+        try:
+            output = await worker_pool.run(
+                image_pixels(image_bytes), _shrink_for_upload, payload,
+                int(config.INPUT_MAX_MP * 1_000_000), config.INPUT_JPEG_QUALITY, label='prepare_upload')
+        except Exception as e:
+            print(f"Error in prepare_upload: {e}")
+    
+    size_in = max(original_size or 0, len(image_bytes))
+    size_out = len(output) if output is not None else len(image_bytes)
+    _input_stats['photos'] += 1
+    _input_stats['bytes_in'] += size_in
+    _input_stats['bytes_out'] += size_out
+    return output, size_in - size_out
+
+def input_stats():
+    return dict(_input_stats)
+
+# --- Background replacement ---
+# The subject (RGBA result) is pasted onto a new background using its alpha channel.
+
+BACKGROUND_COLORS = {
+    'white': (255, 255, 255),
+    'black': (0, 0, 0),
+}
+
+def _composite_background(png_bytes, mode, color, background_bytes, mask_bytes=None):
+    from PIL import Image, ImageFilter, ImageOps
+    if mask_bytes is not None:
+        # The mask kept from the ZIP transport: only the color channels are needed from the PNG
+        fg = Image.open(io.BytesIO(png_bytes)).convert('RGB')
+        mask = Image.open(io.BytesIO(mask_bytes)).convert('L')
+        if mask.size != fg.size:
+            mask = mask.resize(fg.size, Image.BILINEAR)
+    else:
+        fg = Image.open(io.BytesIO(png_bytes)).convert('RGBA')
+        mask = fg
+    if mode == 'color':
+        bg = Image.new('RGB', fg.size, color)
+    else:
+        bg = Image.open(io.BytesIO(background_bytes))
+        bg.draft('RGB', fg.size) # JPEG: decode at a reduced scale where possible
+        bg = ImageOps.fit(bg.convert('RGB'), fg.size, Image.LANCZOS)
+        if mode == 'blur':
+            # Blurring a quarter-size copy is far cheaper and looks the same once scaled back up
+            small = bg.resize((max(1, fg.width // 4), max(1, fg.height // 4)), Image.BILINEAR)
+            small = small.filter(ImageFilter.GaussianBlur(config.BACKGROUND_BLUR_RADIUS))
+            bg = small.resize(fg.size, Image.BILINEAR)
+    bg.paste(fg, (0, 0), mask)
+    return _save(bg, format='JPEG', quality=90, optimize=True)
+
+async def replace_background(png_bytes, mode, color=None, background_bytes=None, mask_bytes=None):
+    """
+    Puts the subject of a result PNG onto a new background and returns JPEG bytes (or None).
+    mode is 'color' (an RGB tuple), 'blur' (background_bytes = the original photo)
+    or 'image' (background_bytes = any photo). mask_bytes is the result's kept alpha
+    mask (get_mask), if there is one.
+    """
     try:
-        async with aiohttp.ClientSession() as session:
-            data = aiohttp.FormData()
-            data.add_field('image_file', open(image_path, 'rb'))
-            data.add_field('size', 'auto')
-
-            headers = {'X-Api-Key': config.RBG_API}
-            
-            async with session.post('https://api.remove.bg/v1.0/removebg', data=data, headers=headers) as response:
-                if response.status == 200:
-                    return await response.read()
-                else:
-                    print(f"Remove.bg Error: {response.status} - {await response.text()}")
-                    return None
+        # Subject, background and output are all held at once
+        pixels = 2 * image_pixels(png_bytes)
+        if background_bytes is not None:
+            pixels += image_pixels(background_bytes)
+            if config.CONVERT_POOL_KIND == 'process':
+                background_bytes = bytes(background_bytes)
+        return await worker_pool.run(pixels, _composite_background, png_bytes, mode, color, background_bytes,
+                                     mask_bytes, label=f"background_{mode}")
     except Exception as e:
-        print(f"Error in remove_background: {e}")
+        print(f"Error in replace_background: {e}")
         return None
 
+# --- Output format registry ---
+# name -> (filename, encoder). An encoder takes the PNG bytes and returns output bytes.
+# Encoders run inside worker_pool; `decodes=False` formats skip the pool and the pixel budget.
+
+FORMATS = {}
+
+def register_format(name, filename, encoder, decodes=True):
+    FORMATS[name] = {'filename': filename, 'encoder': encoder, 'decodes': decodes}
+
+def available_formats():
+    return list(FORMATS)
+
+def _save(img, **params):
+    output_bytes = io.BytesIO()
+    img.save(output_bytes, **params)
+    return output_bytes.getvalue()
+
+def _encode_jpg(image_bytes):
+    from PIL import Image
+    # Convert to RGB (for JPEG)
+    img = Image.open(io.BytesIO(image_bytes)).convert('RGB')
+    return _save(img, format='JPEG', quality=85, optimize=True, progressive=True)
+
+def _encode_png(image_bytes):
+    return bytes(image_bytes) # Already the remove.bg PNG; no re-encode
+
+def _encode_pdf(image_bytes):
+    from PIL import Image
+    # Convert to RGB (PDF doesn't handle RGBA well)
+    img = Image.open(io.BytesIO(image_bytes)).convert('RGB')
+    return _save(img, format='PDF', resolution=100.0)
+
+def _encode_webp(image_bytes):
+    from PIL import Image
+    img = Image.open(io.BytesIO(image_bytes))
+    return _save(img, format='WEBP', quality=80, alpha_quality=90, method=4)
+
+def _encode_avif(image_bytes):
+    from PIL import Image
+    img = Image.open(io.BytesIO(image_bytes))
+    return _save(img, format='AVIF', quality=60, speed=6)
+
+def _encode_tiff(image_bytes):
+    from PIL import Image
+    img = Image.open(io.BytesIO(image_bytes))
+    return _save(img, format='TIFF', compression='tiff_adobe_deflate')
+
+def _encode_bmp(image_bytes):
+    from PIL import Image
+    img = Image.open(io.BytesIO(image_bytes))
+    return _save(img, format='BMP')
+
+def _encode_zip(image_bytes):
+    output_bytes = io.BytesIO()
+    # Store the PNG inside the zip as-is (it is already compressed; nothing to decode)
+    with zipfile.ZipFile(output_bytes, 'w', compression=zipfile.ZIP_STORED) as zf:
+        zf.writestr('bg_removed.png', bytes(image_bytes))
+    return output_bytes.getvalue()
+
+register_format('JPG', 'converted.jpg', _encode_jpg)
+register_format('PDF', 'converted.pdf', _encode_pdf)
+register_format('WEBP', 'converted.webp', _encode_webp)
+if importlib.util.find_spec('PIL._avif') is not None: # Checked without importing Pillow
+    register_format('AVIF', 'converted.avif', _encode_avif)
+register_format('TIFF', 'converted.tiff', _encode_tiff)
+register_format('BMP', 'converted.bmp', _encode_bmp)
+register_format('PNG', 'converted.png', _encode_png, decodes=False)
+register_format('ZIP', 'converted.zip', _encode_zip, decodes=False)
+
 async def convert_format(image_bytes, target_format):
     """
     Converts image bytes (PNG) to a target format.
+    The decode/encode work runs in the worker pool, not on the event loop.
     Returns (file_bytes, filename) tuple.
     """
+    fmt = FORMATS.get(target_format.upper())
+    if fmt is None:
+        return None, None # Unsupported format
+    
     try:
-        img = Image.open(io.BytesIO(image_bytes))
-        output_bytes = io.BytesIO()
-        
-        target_format = target_format.upper()
-        
-        if target_format == 'JPG':
-            # Convert to RGB (for JPEG)
-            img = img.convert('RGB')
-            img.save(output_bytes, format='JPEG')
-            filename = 'converted.jpg'
+        if not fmt['decodes']:
+            return fmt['encoder'](image_bytes), fmt['filename']
         
-        elif target_format == 'PNG':
-            img.save(output_bytes, format='PNG')
-            filename = 'converted.png'
-            
-        elif target_format == 'PDF':
-            # Convert to RGB (PDF doesn't handle RGBA well)
-            img = img.convert('RGB')
-            img.save(output_bytes, format='PDF', resolution=100.0)
-            filename = 'converted.pdf'
-            
-        elif target_format == 'ZIP':
-            with zipfile.ZipFile(output_bytes, 'w') as zf:
-                # Save the PNG inside the zip
-                img.save(io.BytesIO(), format='PNG')
-                zf.writestr('bg_removed.png', io.BytesIO(image_bytes).getvalue())
-            filename = 'converted.zip'
-
-        # ... আপনি এখানে আরও ফরম্যাট যোগ করতে পারেন (e.g., WEBP, BMP)
-            
-        else:
-            return None, None # Unsupported format
-
-        output_bytes.seek(0)
-        return output_bytes.getvalue(), filename
+        pixels = image_pixels(image_bytes)
+        with metrics.timer('convert'):
+            output = await worker_pool.run(pixels, fmt['encoder'], image_bytes,
+                                           label=f"convert_{target_format.upper()}")
+        return output, fmt['filename']
         
     except Exception as e:
         print(f"Error in convert_format: {e}")
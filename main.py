@@ -1,41 +1,128 @@
 import config
+import startup
 import handlers_user
 import handlers_admin
 import db_helpers
+import http_client
+import worker_pool
+import broadcast
+import state_backend
+import ban_index
+import metrics
+import scheduler
+import resilience
+import image_processing
+import diagnostics
+from update_processor import UserOrderedUpdateProcessor
+from sqlite_persistence import SQLitePersistence
 
 import os
 import asyncio
+import json
+import hmac
 import telegram
-import urllib.request
-from flask import Flask, request
-
-# asgiref ইম্পোর্ট করুন (নতুন)
-from asgiref.wsgi import WsgiToAsgi
 
 from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
-    PicklePersistence,
     filters
 )
 
-# --- Flask অ্যাপ তৈরি ---
-server = Flask(__name__)
+startup.record('imports', startup.STARTED)
+
+WEBHOOK_PATH = '/' + config.BOT_TOKEN
+MAX_BODY_BYTES = 1024 * 1024
+METRICS_PATH = '/metrics'
+
+async def post_init(application: Application):
+    """
+    Runs once after the application is initialized. Opens shared HTTP connections
+    and warms them up (Application.initialize already made the first Bot API call).
+    """
+    diagnostics.start()
+    with startup.phase('http_client'):
+        await http_client.start()
+    # API hosts are connected to while the rest of post_init runs
+    warm_up = asyncio.ensure_future(_warm_up_connections()) if config.WARM_UP else None
+    with startup.phase('ban_index'):
+        await ban_index.start(application)
+    with startup.phase('broadcast'):
+        await db_helpers.migrate_shared_state(application)
+        await broadcast.resume(application)
+    if warm_up is not None:
+        await warm_up
+        # Pillow loads while the first updates are already being served
+        startup.background('pillow', _warm_up_pillow())
+
+async def _warm_up_connections():
+    with startup.phase('warm_up_api'):
+        await http_client.warm_up([config.RBG_API_URL, config.SE_API_URL])
+
+async def _warm_up_pillow():
+    # Workers first: forking a process pool while another thread imports can hang the child
+    await worker_pool.warm_up(image_processing.load_pillow)
+    await asyncio.to_thread(image_processing.load_pillow)
+
+async def post_stop(application: Application):
+    """
+    Runs before the application is shut down, while the bot and persistence are still usable.
+    Stops background senders so their state gets persisted.
+    """
+    await broadcast.shutdown()
+    await ban_index.stop()
+    await diagnostics.stop()
+    await db_helpers.shutdown_db_channel_queue(application)
+
+async def post_shutdown(application: Application):
+    """
+    Runs once after the application is shut down. Closes shared HTTP connections.
+    """
+    await http_client.close()
+    await state_backend.close()
+    worker_pool.shutdown()
 
-# --- কনভার্টার দিয়ে Flask কে ASGI অ্যাপে রূপান্তর করুন (নতুন লাইন) ---
-# এই 'asgi_app' কে আমরা Dockerfile এ ব্যবহার করব
-asgi_app = WsgiToAsgi(server)
+def register_metrics(application):
+    """
+    Queue depths that live in other modules, read when /metrics is scraped.
+    """
+    metrics.register_gauge("bot_update_queue_size", "Updates received but not yet dispatched.",
+                           application.update_queue.qsize)
+    metrics.register_gauge("bot_updates_queued", "Updates being handled or waiting for their user's turn.",
+                           application.update_processor.queued)
+    metrics.register_gauge("bot_api_queue_waiting", "Calls waiting for a paid API slot.",
+                           lambda: {name: q['waiting'] for name, q in scheduler.all_stats().items()}, label='api')
+    metrics.register_gauge("bot_api_queue_running", "Paid API calls in progress.",
+                           lambda: {name: q['running'] for name, q in scheduler.all_stats().items()}, label='api')
+    metrics.register_gauge("bot_convert_pool_waiting", "Image jobs waiting for the pixel budget.",
+                           lambda: worker_pool.stats()['waiting'])
+    metrics.register_gauge("bot_convert_pool_pixels_in_use", "Pixels reserved by running image jobs.",
+                           lambda: worker_pool.stats()['pixels_in_use'])
+    metrics.register_gauge("bot_circuit_open", "1 while an API's circuit breaker is not closed.",
+                           lambda: {name: int(e['state'] != 'closed')
+                                    for name, e in resilience.stats()['endpoints'].items()}, label='api')
+    metrics.register_gauge("bot_db_channel_pending", "Users waiting for a DB channel edit.",
+                           db_helpers.pending_count)
+    metrics.register_gauge("bot_event_loop_lag_max_seconds", "Largest event-loop lag seen since start.",
+                           lambda: diagnostics.stats()['lag_max'])
+    metrics.register_gauge("bot_startup_seconds", "Time spent in each startup phase.",
+                           lambda: startup.stats()['phases'], label='phase')
 
 def setup_bot():
     """
     Sets up the bot application.
     """
-    persistence = PicklePersistence(filepath='bot_persistence')
+    persistence = SQLitePersistence(config.PERSISTENCE_DB, migrate_from=config.PERSISTENCE_PICKLE)
     application = (Application.builder()
         .token(config.BOT_TOKEN)
+        .base_url(config.TELEGRAM_BASE_URL)
+        .base_file_url(config.TELEGRAM_BASE_FILE_URL)
         .persistence(persistence)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .concurrent_updates(UserOrderedUpdateProcessor(config.MAX_CONCURRENT_UPDATES, config.USER_UPDATE_BACKLOG))
         .build())
 
     # --- User Handlers ---
@@ -47,12 +134,17 @@ def setup_bot():
     # --- Callback Handlers ---
     application.add_handler(CallbackQueryHandler(handlers_user.show_credits_callback, pattern="^show_credits$"))
     application.add_handler(CallbackQueryHandler(handlers_user.handle_conversion, pattern="^convert_"))
+    application.add_handler(CallbackQueryHandler(handlers_user.handle_background, pattern="^bg_"))
     
     # --- Admin Handlers ---
     application.add_handler(CommandHandler("ban", handlers_admin.ban_user))
     application.add_handler(CommandHandler("unban", handlers_admin.unban_user))
     application.add_handler(CommandHandler("sendmsg", handlers_admin.send_message_to_user))
     application.add_handler(CommandHandler("sendmsgall", handlers_admin.send_message_all))
+    application.add_handler(CommandHandler("stopbroadcast", handlers_admin.stop_broadcast))
+    application.add_handler(CommandHandler("stats", handlers_admin.show_stats))
+    application.add_handler(CommandHandler("profile", handlers_admin.profile_command))
+    application.add_handler(CommandHandler("slow", handlers_admin.slow_updates))
 
     # --- Ignore Group Messages ---
     application.add_handler(MessageHandler(
@@ -60,42 +152,135 @@ def setup_bot():
         handlers_user.ignore_non_private_chats
     ))
 
+    register_metrics(application)
     return application
 
 # বট অ্যাপ সেটআপ
-application = setup_bot()
+with startup.phase('setup_bot'):
+    application = setup_bot()
+
+# --- Native ASGI app (Flask/WsgiToAsgi ছাড়া) ---
 
-@server.route('/' + config.BOT_TOKEN, methods=['POST'])
-async def webhook_update():
+async def _read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if len(body) > MAX_BODY_BYTES:
+            return None
+        if not message.get('more_body'):
+            return body
+
+async def _respond(send, status, text):
+    body = text.encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'text/plain; charset=utf-8'),
+                    (b'content-length', str(len(body)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+async def webhook_update(scope, receive, send):
     """
-    Async Webhook Handler
+    Webhook Handler. Validates and queues the update, then acks immediately;
+    the application's update processor handles it in the background.
     """
-    if not application._initialized:
-        await application.initialize()
+    if config.WEBHOOK_SECRET:
+        headers = dict(scope['headers'])
+        token = headers.get(b'x-telegram-bot-api-secret-token', b'').decode()
+        if not hmac.compare_digest(token, config.WEBHOOK_SECRET):
+            await _respond(send, 403, "forbidden")
+            return
 
-    update_json = request.get_json()
-    
-    if update_json:
-        update = telegram.Update.de_json(update_json, application.bot)
-        await application.process_update(update)
-            
-    return "ok", 200
-
-@server.route("/")
-def set_webhook():
+    body = await _read_body(receive)
+    if body is None:
+        await _respond(send, 413, "too large")
+        return
+
+    try:
+        update_json = json.loads(body)
+    except ValueError:
+        update_json = None
+    if not isinstance(update_json, dict):
+        await _respond(send, 400, "bad request")
+        return
+
+    # Banned users are dropped before any parsing or dispatch (still acked, so Telegram won't retry)
+    if update_json and not ban_index.should_drop(update_json):
+        try:
+            update = telegram.Update.de_json(update_json, application.bot)
+        except Exception as e:
+            # Redelivering it would fail the same way; ack and drop it
+            print(f"Dropping update that could not be parsed: {e}")
+        else:
+            await application.update_queue.put(update)
+
+    await _respond(send, 200, "ok")
+
+async def set_webhook(scope, receive, send):
     host_url = os.environ.get("RENDER_EXTERNAL_HOSTNAME")
     if not host_url:
-        return "Webhook setup failed: Host URL not found.", 500
+        await _respond(send, 500, "Webhook setup failed: Host URL not found.")
+        return
 
-    bot_url = f"https://{host_url}/{config.BOT_TOKEN}"
-    api_url = f"https://api.telegram.org/bot{config.BOT_TOKEN}/"
+    bot_url = f"https://{host_url}{WEBHOOK_PATH}"
     
     try:
-        req = urllib.request.Request(api_url + "setWebhook?url=" + bot_url)
-        urllib.request.urlopen(req)
-        return f"Webhook set successfully to {bot_url}", 200
+        await application.bot.set_webhook(url=bot_url, secret_token=config.WEBHOOK_SECRET)
+        await _respond(send, 200, f"Webhook set successfully to {bot_url}")
     except Exception as e:
-        return f"Webhook error: {e}", 500
+        await _respond(send, 500, f"Webhook error: {e}")
+
+async def lifespan(receive, send):
+    """
+    Starts the application (and its update processor) before traffic is accepted,
+    and stops it cleanly on shutdown. Prints how long each startup phase took.
+    """
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                with startup.phase('initialize'):
+                    await application.initialize()
+                with startup.phase('post_init'):
+                    await application.post_init(application)
+                with startup.phase('start'):
+                    await application.start()
+            except Exception as e:
+                await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                return
+            startup.ready()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if application.running:
+                await application.stop()
+            if application._initialized:
+                await application.post_stop(application)
+                await application.shutdown()
+                await application.post_shutdown(application)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def asgi_app(scope, receive, send):
+    """
+    ASGI entry point (Dockerfile এ এটি ব্যবহার করা হয়).
+    """
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    path, method = scope['path'], scope['method']
+    if method == 'POST' and path == WEBHOOK_PATH:
+        await webhook_update(scope, receive, send)
+    elif method == 'GET' and path == METRICS_PATH:
+        await _respond(send, 200, metrics.render())
+    elif method == 'GET' and path == '/':
+        await set_webhook(scope, receive, send)
+    else:
+        await _respond(send, 404, "not found")
 
 if __name__ == "__main__":
     # লোকাল টেস্ট এর জন্য
@@ -0,0 +1,131 @@
+import contextvars
+import time
+from bisect import bisect_left
+
+# Small in-process metrics registry, rendered in the Prometheus text format at /metrics.
+# Recording is a few dict/list operations with no locks or I/O, so it is cheap enough
+# for every request. Values are per process (each worker exposes its own).
+# Stages: download, sightengine, removebg, convert, upload, db_edit; also update (whole
+# handling time) and event_loop_lag.
+
+# Upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_histograms = {}   # stage -> [bucket counts..., +Inf count, sum]
+_in_flight = {}    # stage -> count
+_errors = {}       # (stage, cause) -> count
+_bytes = {}        # direction -> count
+_gauges = []       # (name, help, fn, label); fn() returns a number or {label value: number}
+
+# Stages timed while handling one update, for slow-update reports (see diagnostics.py).
+# Tasks started by the handler inherit the list, so their stages are included too.
+_trace = contextvars.ContextVar('metrics_trace', default=None)
+
+def observe(stage, seconds):
+    h = _histograms.get(stage)
+    if h is None:
+        h = _histograms[stage] = [0] * (len(BUCKETS) + 2)
+    h[bisect_left(BUCKETS, seconds)] += 1
+    h[-1] += seconds
+
+def start_trace():
+    """
+    Starts collecting (stage, seconds) for timers in the current context; returns the list.
+    """
+    trace = []
+    _trace.set(trace)
+    return trace
+
+def error(stage, cause):
+    key = (stage, cause)
+    _errors[key] = _errors.get(key, 0) + 1
+
+def add_bytes(direction, count):
+    _bytes[direction] = _bytes.get(direction, 0) + count
+
+def register_gauge(name, help_text, fn, label='name'):
+    """
+    Adds a gauge read at scrape time, e.g. a queue depth owned by another module.
+    """
+    _gauges.append((name, help_text, fn, label))
+
+class timer:
+    """
+    Times a stage and tracks it as in flight:
+
+        with metrics.timer('removebg'):
+            ...
+
+    An exception escaping the block is counted as an error with its class name as cause.
+    """
+
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        _in_flight[self.stage] = _in_flight.get(self.stage, 0) + 1
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        observe(self.stage, elapsed)
+        trace = _trace.get()
+        if trace is not None:
+            trace.append((self.stage, elapsed))
+        _in_flight[self.stage] -= 1
+        if exc_type is not None and not issubclass(exc_type, GeneratorExit):
+            error(self.stage, exc_type.__name__)
+        return False
+
+# --- Rendering ---
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render():
+    lines = [
+        "# HELP bot_stage_seconds Latency of each photo pipeline stage.",
+        "# TYPE bot_stage_seconds histogram",
+    ]
+    for stage, h in sorted(_histograms.items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS, h):
+            cumulative += count
+            lines.append(f'bot_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+        cumulative += h[len(BUCKETS)]
+        lines.append(f'bot_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {cumulative}')
+        lines.append(f'bot_stage_seconds_sum{{stage="{stage}"}} {h[-1]:.6f}')
+        lines.append(f'bot_stage_seconds_count{{stage="{stage}"}} {cumulative}')
+
+    lines += ["# HELP bot_stage_in_flight Operations of each stage currently running.",
+              "# TYPE bot_stage_in_flight gauge"]
+    for stage, count in sorted(_in_flight.items()):
+        lines.append(f'bot_stage_in_flight{{stage="{stage}"}} {count}')
+
+    lines += ["# HELP bot_errors_total Errors by stage and cause.",
+              "# TYPE bot_errors_total counter"]
+    for (stage, cause), count in sorted(_errors.items()):
+        lines.append(f'bot_errors_total{{stage="{stage}",cause="{_escape(cause)}"}} {count}')
+
+    lines += ["# HELP bot_bytes_total Bytes transferred, by direction.",
+              "# TYPE bot_bytes_total counter"]
+    for direction, count in sorted(_bytes.items()):
+        lines.append(f'bot_bytes_total{{direction="{direction}"}} {count}')
+
+    for name, help_text, fn, label_name in _gauges:
+        try:
+            value = fn()
+        except Exception as e:
+            print(f"Metrics gauge {name} failed: {e}")
+            continue
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+        if isinstance(value, dict):
+            for label, v in sorted(value.items()):
+                lines.append(f'{name}{{{label_name}="{_escape(label)}"}} {v}')
+        else:
+            lines.append(f"{name} {value}")
+
+    return "\n".join(lines) + "\n"
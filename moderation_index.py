@@ -0,0 +1,184 @@
+import config
+import asyncio
+import io
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import image_processing
+import worker_pool
+
+# Local index in front of the Sight Engine check.
+# 1. Exact: the verdict for a photo we have already checked, by content hash.
+# 2. Near-duplicate: a perceptual hash (dHash) within a small Hamming distance of an
+#    image we flagged before, so lightly edited re-sends of explicit images are caught.
+# Only flagged hashes go into the near-duplicate search; a clean verdict is never
+# inferred from similarity.
+
+_MEMORY_ITEMS = 50_000
+
+_verdicts = OrderedDict()   # content hash -> explicit (bool)
+_tree = None                # BK-tree of flagged perceptual hashes
+_conn = None
+_lock = threading.Lock()
+
+_stats = {'checks': 0, 'exact_hits': 0, 'near_hits': 0, 'api_calls': 0}
+
+# --- Perceptual hash ---
+
+def _dhash(image_bytes):
+    """
+    64-bit difference hash: one bit per horizontally adjacent pixel pair of a 9x8 thumbnail.
+    """
+    from PIL import Image
+    img = Image.open(io.BytesIO(image_bytes))
+    img.draft('L', (72, 64)) # JPEG: decode at 1/8 scale where possible
+    pixels = list(img.convert('L').resize((9, 8), Image.BILINEAR).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+def _distance(a, b):
+    return bin(a ^ b).count('1')
+
+class _BKTree:
+    """
+    Burkhard-Keller tree over Hamming distance; a radius search only visits
+    children whose edge distance is within radius of the query's distance.
+    """
+
+    def __init__(self):
+        self.root = None   # [hash, {distance: child}]
+        self.size = 0
+
+    def add(self, value):
+        self.size += 1
+        if self.root is None:
+            self.root = [value, {}]
+            return
+        node = self.root
+        while True:
+            d = _distance(value, node[0])
+            if d == 0:
+                self.size -= 1
+                return
+            child = node[1].get(d)
+            if child is None:
+                node[1][d] = [value, {}]
+                return
+            node = child
+
+    def find(self, value, radius):
+        """
+        Returns True if any stored hash is within `radius` of value.
+        """
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            d = _distance(value, node[0])
+            if d <= radius:
+                return True
+            for edge, child in node[1].items():
+                if d - radius <= edge <= d + radius:
+                    stack.append(child)
+        return False
+
+# --- Storage ---
+
+def _execute(sql, params=(), fetch=None):
+    global _conn
+    with _lock:
+        if _conn is None:
+            _conn = sqlite3.connect(config.MODERATION_DB, timeout=10, check_same_thread=False, isolation_level=None)
+            _conn.execute("PRAGMA journal_mode=WAL")
+            _conn.execute("CREATE TABLE IF NOT EXISTS verdicts ("
+                          "digest TEXT PRIMARY KEY, explicit INTEGER NOT NULL, phash TEXT, updated REAL NOT NULL)")
+        cur = _conn.execute(sql, params)
+        if fetch == 'one':
+            return cur.fetchone()
+        if fetch == 'all':
+            return cur.fetchall()
+        return None
+
+def _load_tree():
+    tree = _BKTree()
+    for (phash,) in _execute("SELECT phash FROM verdicts WHERE explicit = 1 AND phash IS NOT NULL", fetch='all'):
+        tree.add(int(phash, 16))
+    return tree
+
+async def _get_tree():
+    global _tree
+    if _tree is None:
+        tree = await asyncio.to_thread(_load_tree)
+        if _tree is None:
+            _tree = tree
+            print(f"Moderation index loaded: {tree.size} flagged hashes")
+    return _tree
+
+def _remember(digest, explicit):
+    _verdicts[digest] = explicit
+    _verdicts.move_to_end(digest)
+    while len(_verdicts) > _MEMORY_ITEMS:
+        _verdicts.popitem(last=False)
+
+async def _lookup(digest):
+    explicit = _verdicts.get(digest)
+    if explicit is None:
+        row = await asyncio.to_thread(_execute, "SELECT explicit FROM verdicts WHERE digest = ?", (digest,), 'one')
+        if row is None:
+            return None
+        explicit = bool(row[0])
+        _remember(digest, explicit)
+    return explicit
+
+async def _record(digest, explicit, phash):
+    _remember(digest, explicit)
+    if explicit and phash is not None:
+        (await _get_tree()).add(phash)
+    await asyncio.to_thread(
+        _execute, "INSERT OR REPLACE INTO verdicts (digest, explicit, phash, updated) VALUES (?, ?, ?, ?)",
+        (digest, int(explicit), f"{phash:016x}" if phash is not None else None, time.time()))
+
+async def _phash(image_data):
+    payload = bytes(image_data) if config.CONVERT_POOL_KIND == 'process' else image_data
+    return await worker_pool.run(image_processing.image_pixels(image_data), _dhash, payload, label='phash')
+
+# --- Public API ---
+
+async def check(image_data, digest, check_api):
+    """
+    Returns True if the image is explicit. Answers from the index when it can;
+    otherwise awaits check_api() (the Sight Engine call) and records its verdict.
+    A None result from check_api (API failure) is passed through and not recorded.
+    """
+    _stats['checks'] += 1
+    explicit = await _lookup(digest)
+    if explicit is not None:
+        _stats['exact_hits'] += 1
+        return explicit
+
+    try:
+        phash = await _phash(image_data)
+    except Exception as e:
+        print(f"Could not hash image for moderation: {e}")
+        phash = None
+
+    if phash is not None and (await _get_tree()).find(phash, config.MODERATION_HAMMING_RADIUS):
+        _stats['near_hits'] += 1
+        await _record(digest, True, phash)
+        return True
+
+    _stats['api_calls'] += 1
+    explicit = await check_api()
+    if explicit is not None:
+        await _record(digest, bool(explicit), phash)
+    return explicit
+
+def stats():
+    s = dict(_stats)
+    s['flagged_hashes'] = _tree.size if _tree is not None else 0
+    s['avoided_rate'] = ((s['exact_hits'] + s['near_hits']) / s['checks']) if s['checks'] else 0.0
+    return s
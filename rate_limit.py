@@ -0,0 +1,43 @@
+import asyncio
+import time
+
+class TokenBucket:
+    """
+    Async token-bucket rate limiter shared by all callers.
+    pause() blocks every caller until a Telegram flood wait has passed.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+def retry_seconds(error):
+    """
+    Seconds to wait from a telegram.error.RetryAfter (int or timedelta depending on PTB version).
+    """
+    delay = error.retry_after
+    if hasattr(delay, 'total_seconds'):
+        delay = delay.total_seconds()
+    return float(delay)
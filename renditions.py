@@ -0,0 +1,83 @@
+import config
+import asyncio
+import hashlib
+from collections import OrderedDict
+
+import blob_store
+import image_processing
+
+# Converted outputs, memoized per (source PNG ref, format).
+# Popular formats are rendered in the background right after a removal succeeds,
+# so most conversion button presses are answered from memory or the blob store.
+
+_memory = OrderedDict()   # (ref, fmt) -> bytes
+_memory_bytes = 0
+_in_flight = {}           # (ref, fmt) -> asyncio.Task
+_background = set()
+
+def _blob_key(ref, fmt):
+    return hashlib.sha256(f"rendition:{ref}:{fmt}".encode()).hexdigest()
+
+def _remember(key, data):
+    global _memory_bytes
+    if len(data) > config.RENDITION_MEM_BYTES:
+        return
+    if key in _memory:
+        _memory_bytes -= len(_memory.pop(key))
+    _memory[key] = data
+    _memory_bytes += len(data)
+    while _memory_bytes > config.RENDITION_MEM_BYTES:
+        _, old = _memory.popitem(last=False)
+        _memory_bytes -= len(old)
+
+async def _render(ref, image_bytes, fmt):
+    key = (ref, fmt)
+    if not image_processing.FORMATS[fmt]['decodes']:
+        # PNG/ZIP just wrap the source bytes; not worth a disk copy
+        data, _ = await image_processing.convert_format(image_bytes, fmt)
+        return data
+    
+    data = await blob_store.get(_blob_key(ref, fmt))
+    if data is None:
+        data, _ = await image_processing.convert_format(image_bytes, fmt)
+        if data is None:
+            return None
+        await blob_store.put(data, ref=_blob_key(ref, fmt))
+    _remember(key, data)
+    return data
+
+async def get(ref, image_bytes, target_format):
+    """
+    Returns (file_bytes, filename) for the PNG `image_bytes` (stored under `ref`).
+    """
+    fmt = target_format.upper()
+    spec = image_processing.FORMATS.get(fmt)
+    if spec is None:
+        return None, None
+    ref = ref or blob_store.make_ref(image_bytes)
+    key = (ref, fmt)
+
+    data = _memory.get(key)
+    if data is not None:
+        _memory.move_to_end(key)
+        return data, spec['filename']
+
+    # Share a render that is already running (e.g. the eager one)
+    task = _in_flight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_render(ref, image_bytes, fmt))
+        _in_flight[key] = task
+        task.add_done_callback(lambda _: _in_flight.pop(key, None))
+    data = await asyncio.shield(task)
+    return (data, spec['filename']) if data is not None else (None, None)
+
+def prefetch(ref, image_bytes):
+    """
+    Starts background renders of EAGER_RENDITIONS for a fresh result.
+    """
+    for fmt in config.EAGER_RENDITIONS:
+        if fmt not in image_processing.FORMATS or (ref, fmt) in _memory or (ref, fmt) in _in_flight:
+            continue
+        task = asyncio.ensure_future(get(ref, image_bytes, fmt))
+        _background.add(task)
+        task.add_done_callback(_background.discard)
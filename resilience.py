@@ -0,0 +1,287 @@
+import aiohttp
+import config
+import asyncio
+import random
+import time
+
+# Failure handling for the remote APIs (remove.bg, Sight Engine).
+# Each endpoint has a circuit breaker (fail fast while the API is down), a timeout
+# that follows observed latency, jittered retries that honor Retry-After, and optional
+# hedging (a second copy of a slow request). remove.bg requests also spread over a
+# pool of API keys.
+
+class RetryableError(Exception):
+    """
+    Raised by an attempt when trying again may succeed (429, 5xx, timeout, exhausted key).
+    `trip=False` means the endpoint itself is not at fault (e.g. one key ran out of
+    credits), so the circuit breaker does not count it as a failure. `responded=True`
+    means the endpoint did answer, which counts as a success for the breaker.
+    """
+
+    def __init__(self, message, retry_after=None, trip=True, responded=False):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.trip = trip
+        self.responded = responded
+
+class Unavailable(Exception):
+    """
+    The call was not made or gave up: circuit open, no usable key, or retries exhausted.
+    """
+
+def parse_retry_after(value):
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failures. After `reset` seconds one trial call
+    is let through (half-open); its success closes the circuit, its failure reopens it.
+    """
+
+    def __init__(self, threshold, reset):
+        self.threshold = threshold
+        self.reset = reset
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset:
+            return 'half_open'
+        return 'open'
+
+    def allow(self):
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half_open' and not self.trial_running:
+            self.trial_running = True
+            return True
+        return False
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def release_trial(self):
+        """
+        The half-open trial ended without telling whether the endpoint works
+        (no request was sent); the next call may probe instead.
+        """
+        self.trial_running = False
+
+    def failure(self):
+        self.failures += 1
+        if self.trial_running or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+        self.trial_running = False
+
+
+class LatencyTracker:
+    """
+    Smoothed latency and its variation (as TCP does for retransmission timeouts).
+    """
+
+    def __init__(self, min_timeout, max_timeout):
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.srtt = None
+        self.rttvar = 0.0
+
+    def observe(self, seconds):
+        if self.srtt is None:
+            self.srtt, self.rttvar = seconds, seconds / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - seconds)
+            self.srtt = 0.875 * self.srtt + 0.125 * seconds
+
+    def timeout(self):
+        if self.srtt is None:
+            return self.max_timeout
+        return min(self.max_timeout, max(self.min_timeout, self.srtt + 4 * self.rttvar))
+
+    def hedge_delay(self):
+        # Roughly the slow tail of normal responses
+        if self.srtt is None:
+            return self.max_timeout
+        return self.srtt + 2 * self.rttvar
+
+
+class Endpoint:
+    """
+    `paid=True` (remove.bg) means a request that timed out may still have been charged,
+    so timeouts are not retried and the timeout grows with the upload size.
+    """
+
+    def __init__(self, name, retries, hedge, paid=False):
+        self.name = name
+        self.retries = retries
+        self.hedge = hedge
+        self.paid = paid
+        self.breaker = CircuitBreaker(config.BREAKER_FAILURES, config.BREAKER_RESET)
+        self.latency = LatencyTracker(config.API_MIN_TIMEOUT, config.HTTP_TIMEOUT)
+        self.stats = {'calls': 0, 'retries': 0, 'timeouts': 0, 'hedges': 0, 'rejected': 0, 'failed': 0}
+
+    def timeout(self, size=0):
+        timeout = self.latency.timeout()
+        if self.paid and size:
+            # Time to push the upload at the slowest expected rate, on top of the usual latency
+            timeout = min(config.HTTP_TIMEOUT, timeout + size / config.API_MIN_UPLOAD_RATE)
+        return timeout
+
+    async def _timed(self, attempt, size=0):
+        start = time.monotonic()
+        timeout = self.timeout(size)
+        try:
+            result = await asyncio.wait_for(attempt(), timeout=timeout)
+        except asyncio.TimeoutError:
+            self.stats['timeouts'] += 1
+            if self.paid:
+                raise Unavailable(f"{self.name} timed out after {timeout:.1f}s (not retried, may be charged)")
+            raise RetryableError(f"{self.name} timed out after {timeout:.1f}s")
+        except aiohttp.ClientError as e:
+            raise RetryableError(f"{self.name} connection error: {e}")
+        self.latency.observe(time.monotonic() - start)
+        return result
+
+    async def _hedged(self, attempt, size=0):
+        pending = {asyncio.ensure_future(self._timed(attempt, size))}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=self.latency.hedge_delay())
+            if not done:
+                # Slower than usual: race a second copy, first success wins
+                self.stats['hedges'] += 1
+                pending.add(asyncio.ensure_future(self._timed(attempt, size)))
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def call(self, attempt, size=0):
+        """
+        Runs `attempt()` (a coroutine function doing one request) with retries.
+        `size` is the upload size in bytes. Raises Unavailable if the circuit is open,
+        every attempt failed or a paid request timed out.
+        """
+        self.stats['calls'] += 1
+        for n in range(self.retries + 1):
+            if not self.breaker.allow():
+                self.stats['rejected'] += 1
+                raise Unavailable(f"{self.name} circuit is {self.breaker.state}")
+            try:
+                if self.hedge:
+                    result = await self._hedged(attempt, size)
+                else:
+                    result = await self._timed(attempt, size)
+            except RetryableError as e:
+                if e.trip:
+                    self.breaker.failure()
+                elif e.responded:
+                    self.breaker.success() # Still proves the endpoint answers
+                else:
+                    self.breaker.release_trial()
+                if n == self.retries:
+                    self.stats['failed'] += 1
+                    raise Unavailable(f"{self.name}: {e}")
+                # Full jitter backoff, unless the server said how long to wait
+                delay = e.retry_after
+                if delay is None:
+                    delay = random.uniform(0, min(config.RETRY_MAX_DELAY, config.RETRY_BASE_DELAY * 2 ** n))
+                if delay > config.RETRY_MAX_DELAY:
+                    self.stats['failed'] += 1
+                    raise Unavailable(f"{self.name}: asked to wait {delay:.0f}s")
+                self.stats['retries'] += 1
+                await asyncio.sleep(delay)
+                continue
+            except asyncio.CancelledError:
+                self.breaker.release_trial() # Don't leave a half-open circuit stuck
+                raise
+            except Exception as e:
+                self.breaker.failure()
+                if isinstance(e, Unavailable):
+                    self.stats['failed'] += 1
+                raise
+            self.breaker.success()
+            return result
+
+    def snapshot(self):
+        return dict(self.stats, state=self.breaker.state, timeout=self.timeout(),
+                    latency=self.latency.srtt or 0.0)
+
+
+class KeyPool:
+    """
+    remove.bg API keys. Each request takes the usable key with the fewest requests in
+    flight (ties: fewest credits charged). A key is benched on 429 for Retry-After,
+    on 402 (no credits left) for KEY_EXHAUSTED_COOLDOWN, on 401/403 (bad key) for a day.
+    """
+
+    def __init__(self, keys):
+        self.keys = [{'key': key, 'in_flight': 0, 'requests': 0, 'credits': 0.0,
+                      'benched_until': 0.0, 'last_status': None} for key in keys]
+
+    def acquire(self):
+        now = time.monotonic()
+        usable = [k for k in self.keys if k['benched_until'] <= now]
+        if not usable:
+            raise RetryableError("all remove.bg keys are benched", retry_after=self.wait_time(), trip=False)
+        entry = min(usable, key=lambda k: (k['in_flight'], k['credits']))
+        entry['in_flight'] += 1
+        entry['requests'] += 1
+        return entry
+
+    def release(self, entry, status=None, headers=None):
+        entry['in_flight'] -= 1
+        if status is None:
+            return
+        entry['last_status'] = status
+        headers = headers or {}
+        if status == 200:
+            charged = parse_retry_after(headers.get('X-Credits-Charged'))
+            entry['credits'] += charged if charged is not None else 1
+        elif status == 429:
+            wait = parse_retry_after(headers.get('Retry-After'))
+            entry['benched_until'] = time.monotonic() + (wait if wait is not None else 1.0)
+        elif status == 402:
+            entry['benched_until'] = time.monotonic() + config.KEY_EXHAUSTED_COOLDOWN
+        elif status in (401, 403):
+            entry['benched_until'] = time.monotonic() + 24 * 3600
+
+    def wait_time(self):
+        """
+        Seconds until some key is usable again (0 if one is usable now).
+        """
+        now = time.monotonic()
+        return max(0.0, min(k['benched_until'] for k in self.keys) - now)
+
+    def snapshot(self):
+        now = time.monotonic()
+        return [{'key': k['key'][-4:], 'in_flight': k['in_flight'], 'requests': k['requests'],
+                 'credits': k['credits'], 'benched_for': max(0.0, k['benched_until'] - now),
+                 'last_status': k['last_status']} for k in self.keys]
+
+
+removebg = Endpoint('removebg', retries=config.REMOVEBG_RETRIES, hedge=config.REMOVEBG_HEDGE, paid=True)
+sightengine = Endpoint('sightengine', retries=config.SIGHTENGINE_RETRIES, hedge=config.SIGHTENGINE_HEDGE)
+removebg_keys = KeyPool(config.RBG_API_KEYS)
+
+def stats():
+    return {
+        'endpoints': {e.name: e.snapshot() for e in (removebg, sightengine)},
+        'removebg_keys': removebg_keys.snapshot(),
+    }
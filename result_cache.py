@@ -0,0 +1,201 @@
+import config
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict
+
+# Two-tier cache for remove.bg results.
+# Results are stored by content hash. Telegram's file_unique_id points at a content hash,
+# so a re-sent or forwarded photo can be answered before it is even downloaded.
+
+_memory = OrderedDict()   # content_hash -> png bytes (LRU order)
+_memory_bytes = 0
+_unique_ids = OrderedDict()   # file_unique_id -> content_hash
+
+_disk_bytes = None    # Running size estimate of the disk tier, computed on first write
+_EVICT_EVERY = 32     # Full directory scan at most once per this many writes (as in blob_store)
+_writes_since_scan = 0
+
+_stats = {
+    'memory_hits': 0,
+    'disk_hits': 0,
+    'misses': 0,
+    'stores': 0,
+    'evictions': 0,
+}
+
+def content_hash(image_bytes):
+    return hashlib.sha256(image_bytes).hexdigest()
+
+def _png_path(digest):
+    return os.path.join(config.RESULT_CACHE_DIR, digest[:2], f"{digest}.png")
+
+def _id_path(unique_id):
+    return os.path.join(config.RESULT_CACHE_DIR, 'ids', unique_id)
+
+# --- Memory tier ---
+
+def _memory_get(digest):
+    png = _memory.get(digest)
+    if png is not None:
+        _memory.move_to_end(digest)
+    return png
+
+def _memory_put(digest, png):
+    global _memory_bytes
+    if len(png) > config.RESULT_CACHE_MEM_BYTES:
+        return
+    if digest in _memory:
+        _memory_bytes -= len(_memory.pop(digest))
+    _memory[digest] = png
+    _memory_bytes += len(png)
+
+    while _memory and (len(_memory) > config.RESULT_CACHE_MEM_ITEMS or
+                       _memory_bytes > config.RESULT_CACHE_MEM_BYTES):
+        _, old = _memory.popitem(last=False)
+        _memory_bytes -= len(old)
+        _stats['evictions'] += 1
+
+def _remember_unique_id(unique_id, digest):
+    _unique_ids[unique_id] = digest
+    _unique_ids.move_to_end(unique_id)
+    while len(_unique_ids) > config.RESULT_CACHE_MEM_ITEMS * 16:
+        _unique_ids.popitem(last=False)
+
+# --- Disk tier (blocking, run in a thread) ---
+
+def _disk_get(digest):
+    path = _png_path(digest)
+    try:
+        if time.time() - os.path.getmtime(path) > config.RESULT_CACHE_TTL:
+            os.remove(path)
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+def _disk_lookup_unique_id(unique_id):
+    try:
+        with open(_id_path(unique_id), 'r') as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+def _disk_put(digest, png, unique_id):
+    global _disk_bytes, _writes_since_scan
+    path = _png_path(digest)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(png)
+    os.replace(tmp_path, path)
+
+    if unique_id:
+        os.makedirs(os.path.dirname(_id_path(unique_id)), exist_ok=True)
+        with open(_id_path(unique_id), 'w') as f:
+            f.write(digest)
+
+    _writes_since_scan += 1
+    if _disk_bytes is not None:
+        _disk_bytes += len(png)
+    if (_disk_bytes is None or _disk_bytes > config.RESULT_CACHE_DISK_BYTES
+            or _writes_since_scan >= _EVICT_EVERY):
+        _disk_evict()
+
+def _disk_evict():
+    """
+    Drops expired entries, then the oldest ones until the tier fits RESULT_CACHE_DISK_BYTES.
+    """
+    global _disk_bytes, _writes_since_scan
+    now = time.time()
+    entries = []
+    total = 0
+    for root, _, files in os.walk(config.RESULT_CACHE_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if now - st.st_mtime > config.RESULT_CACHE_TTL:
+                try:
+                    os.remove(path)
+                    _stats['evictions'] += 1
+                except OSError:
+                    pass
+                continue
+            if name.endswith('.png'):
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+    entries.sort()
+    for _, size, path in entries:
+        if total <= config.RESULT_CACHE_DISK_BYTES:
+            break
+        try:
+            os.remove(path)
+            total -= size
+            _stats['evictions'] += 1
+        except OSError:
+            pass
+    _disk_bytes = total
+    _writes_since_scan = 0
+
+# --- Public API ---
+
+async def get(unique_id=None, digest=None):
+    """
+    Looks up a cached result by file_unique_id, falling back to content hash.
+    Returns (png_bytes, content_hash) or (None, content_hash_if_known).
+    A lookup by file_unique_id alone is a probe before the download: its misses are
+    not counted, because the caller looks the photo up again by content hash.
+    """
+    probe = digest is None
+    if digest is None and unique_id:
+        digest = _unique_ids.get(unique_id)
+        if digest is None:
+            digest = await asyncio.to_thread(_disk_lookup_unique_id, unique_id)
+
+    if digest is None:
+        if not probe:
+            _stats['misses'] += 1
+        return None, None
+
+    png = _memory_get(digest)
+    if png is not None:
+        _stats['memory_hits'] += 1
+    else:
+        png = await asyncio.to_thread(_disk_get, digest)
+        if png is None:
+            if not probe:
+                _stats['misses'] += 1
+            return None, digest
+        _stats['disk_hits'] += 1
+        _memory_put(digest, png)
+
+    if unique_id:
+        _remember_unique_id(unique_id, digest)
+    return png, digest
+
+async def put(digest, png, unique_id=None):
+    """
+    Stores a processed PNG under its input's content hash (and file_unique_id if given).
+    """
+    _memory_put(digest, png)
+    if unique_id:
+        _remember_unique_id(unique_id, digest)
+    _stats['stores'] += 1
+    try:
+        await asyncio.to_thread(_disk_put, digest, png, unique_id)
+    except OSError as e:
+        print(f"Result cache write failed: {e}")
+
+def stats():
+    hits = _stats['memory_hits'] + _stats['disk_hits']
+    lookups = hits + _stats['misses']
+    return dict(_stats,
+                memory_items=len(_memory),
+                memory_bytes=_memory_bytes,
+                hit_rate=(hits / lookups) if lookups else 0.0)
@@ -1,43 +1,64 @@
 import aiohttp
 import config
+import http_client
+import metrics
+import resilience
 
-async def check_image(image_path):
+async def check_image(image_data):
     """
     Checks an image against the Sight Engine API for explicit content.
-    Returns True if explicit, False otherwise.
+    `image_data` is a bytes-like object (bytes or memoryview); it is sent without copying.
+    Returns True if explicit, False if not, None if the check could not be made.
     """
     if not config.SE_API_USER or not config.SE_API_SECRET:
         print("Warning: Sight Engine API credentials not set. Skipping safety check.")
         return False
 
-    try:
-        async with aiohttp.ClientSession() as session:
-            data = {
-                'models': 'nudity-2.0,wad', # Check for nudity, weapons, alcohol, drugs
-                'api_user': config.SE_API_USER,
-                'api_secret': config.SE_API_SECRET
-            }
+    with metrics.timer('sightengine'):
+        try:
+            return await resilience.sightengine.call(lambda: _check_attempt(image_data))
+        except resilience.Unavailable as e:
+            metrics.error('sightengine', 'unavailable')
+            print(f"Sight Engine unavailable: {e}")
+            return None # Callers stop and ask the user to try again later
+        except Exception as e:
+            metrics.error('sightengine', type(e).__name__)
+            print(f"Error in safety_check: {e}")
+            return None # Fail safe
+
+async def _check_attempt(image_data):
+    """
+    One Sight Engine request. Returns the verdict, None on a permanent error,
+    or raises resilience.RetryableError.
+    """
+    data = aiohttp.FormData()
+    data.add_field('models', 'nudity-2.0,wad') # Check for nudity, weapons, alcohol, drugs
+    data.add_field('api_user', config.SE_API_USER)
+    data.add_field('api_secret', config.SE_API_SECRET)
+    data.add_field('media', image_data, filename='image.jpg',
+                   content_type='application/octet-stream')
+    metrics.add_bytes('sightengine_upload', len(image_data))
+
+    async with http_client.get_session().post(config.SE_API_URL, data=data) as response:
+        if response.status == 200:
+            result = await response.json()
             
-            with open(image_path, 'rb') as f:
-                data['media'] = f.read()
+            # Check nudity (e.g., raw score > 0.5)
+            if result.get('nudity', {}).get('raw', 0) > 0.5:
+                return True
+            # Check weapons/alcohol/drugs (any probability > 0.5)
+            if result.get('weapon', 0) > 0.5 or \
+               result.get('alcohol', 0) > 0.5 or \
+               result.get('drugs', 0) > 0.5:
+                return True
+                
+            return False
 
-                async with session.post('https://api.sightengine.com/1.0/check.json', data=data) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                        
-                        # Check nudity (e.g., raw score > 0.5)
-                        if result.get('nudity', {}).get('raw', 0) > 0.5:
-                            return True
-                        # Check weapons/alcohol/drugs (any probability > 0.5)
-                        if result.get('weapon', 0) > 0.5 or \
-                           result.get('alcohol', 0) > 0.5 or \
-                           result.get('drugs', 0) > 0.5:
-                            return True
-                            
-                        return False
-                    else:
-                        print(f"Sight Engine Error: {await response.text()}")
-                        return False # Fail safe: treat as non-explicit if API fails
-    except Exception as e:
-        print(f"Error in safety_check: {e}")
-        return False # Fail safe
+        metrics.error('sightengine', f"http_{response.status}")
+        print(f"Sight Engine Error: {await response.text()}")
+        if response.status == 429 or response.status >= 500:
+            raise resilience.RetryableError(
+                f"Sight Engine returned {response.status}",
+                retry_after=resilience.parse_retry_after(response.headers.get('Retry-After')),
+                trip=response.status >= 500)
+        return None
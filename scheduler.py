@@ -0,0 +1,123 @@
+import config
+import asyncio
+import heapq
+import itertools
+import math
+
+# Fair admission control for the paid APIs.
+# Each backend (remove.bg, Sight Engine) has a global concurrency limit. Waiting calls are
+# ordered by start-time fair queuing across users, so one user with many photos cannot
+# starve everyone else. Admins use a separate lane that is always served first.
+
+ADMIN_LANE = 0
+USER_LANE = 1
+
+class _Job:
+    __slots__ = ('key', 'user_id', 'future')
+
+    def __init__(self, key, user_id, future):
+        self.key = key
+        self.user_id = user_id
+        self.future = future
+
+class FairScheduler:
+    def __init__(self, name, concurrency):
+        self.name = name
+        self.concurrency = concurrency
+        self.running = 0
+        self.avg_service_time = 5.0   # EWMA, seconds
+        self._heap = []
+        self._virtual_time = 0.0
+        self._last_tag = {}           # user_id -> start tag of their last job
+        self._seq = itertools.count()
+
+    def waiting(self):
+        return len(self._heap)
+
+    def _position(self, job):
+        return 1 + sum(1 for entry in self._heap if entry[0] < job.key)
+
+    def eta(self, position):
+        """
+        Estimated seconds until a job at `position` in the queue starts.
+        """
+        return math.ceil(position / self.concurrency) * self.avg_service_time
+
+    def _dispatch(self):
+        while self._heap and self.running < self.concurrency:
+            key, job = heapq.heappop(self._heap)
+            if job.future.done(): # Cancelled while waiting
+                continue
+            self._virtual_time = key[1]
+            self.running += 1
+            job.future.set_result(None)
+
+    async def run(self, user_id, func, priority=False, weight=1.0, on_wait=None):
+        """
+        Awaits func() once a slot is free. on_wait(position, eta) is awaited once
+        if the call has to queue.
+        """
+        tag = max(self._virtual_time, self._last_tag.get(user_id, 0.0)) + 1.0 / weight
+        self._last_tag[user_id] = tag
+        key = (ADMIN_LANE if priority else USER_LANE, tag, next(self._seq))
+        job = _Job(key, user_id, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._heap, (key, job))
+        self._dispatch()
+
+        if not job.future.done():
+            if on_wait is not None:
+                position = self._position(job)
+                try:
+                    await on_wait(position, self.eta(position))
+                except Exception as e:
+                    print(f"Scheduler on_wait error: {e}")
+            try:
+                await job.future
+            except asyncio.CancelledError:
+                if job.future.done() and not job.future.cancelled():
+                    # Slot was granted just as we were cancelled; hand it back
+                    self.running -= 1
+                    self._dispatch()
+                raise
+
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            return await func()
+        finally:
+            elapsed = loop.time() - start
+            self.avg_service_time = 0.8 * self.avg_service_time + 0.2 * elapsed
+            self.running -= 1
+            self._forget_idle(user_id)
+            self._dispatch()
+
+    def _forget_idle(self, user_id):
+        # Keep _last_tag bounded: a tag at or below virtual time has no effect anyway
+        if self._last_tag.get(user_id, 0.0) <= self._virtual_time:
+            self._last_tag.pop(user_id, None)
+
+    def stats(self):
+        return {
+            'running': self.running,
+            'waiting': self.waiting(),
+            'concurrency': self.concurrency,
+            'avg_service_time': self.avg_service_time,
+        }
+
+
+_schedulers = {}
+
+def get(name):
+    """
+    Returns the scheduler for a backend API ('removebg' or 'sightengine').
+    """
+    if name not in _schedulers:
+        limits = {
+            'removebg': config.REMOVEBG_CONCURRENCY,
+            'sightengine': config.SIGHTENGINE_CONCURRENCY,
+        }
+        _schedulers[name] = FairScheduler(name, limits[name])
+    return _schedulers[name]
+
+def all_stats():
+    return {name: s.stats() for name, s in _schedulers.items()}
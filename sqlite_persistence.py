@@ -0,0 +1,230 @@
+import asyncio
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+# One row per user/chat instead of one pickle for the whole world.
+# Flushes write only the rows that changed; user rows are loaded the first time
+# that user sends an update (refresh_user_data), not at startup.
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_data (id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS chat_data (id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS conversations (
+    name TEXT NOT NULL, key BLOB NOT NULL, state BLOB NOT NULL,
+    PRIMARY KEY (name, key)
+);
+"""
+
+class _LenientUnpickler(pickle.Unpickler):
+    # PicklePersistence replaces Bot instances with persistent IDs; we don't need them back.
+    def persistent_load(self, pid):
+        return None
+
+def _dumps(obj):
+    return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+def _digest(blob):
+    return hashlib.blake2b(blob, digest_size=16).digest()
+
+class SQLitePersistence(BasePersistence):
+    """
+    BasePersistence backed by SQLite in WAL mode.
+    """
+
+    def __init__(self, filepath, migrate_from=None, store_data=None, update_interval=60):
+        super().__init__(store_data=store_data or PersistenceInput(), update_interval=update_interval)
+        self.filepath = filepath
+        self.migrate_from = migrate_from
+        self._conn = None
+        self._lock = threading.Lock()
+        self._loaded_users = set()
+        self._loaded_chats = set()
+        self._last_written = {}   # (table, id) -> digest of the pickled bytes last written
+
+    # --- SQLite helpers (blocking, run via asyncio.to_thread) ---
+
+    def _connect(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.filepath, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+            self._migrate_pickle()
+        return self._conn
+
+    def _execute(self, sql, params=(), fetch=None):
+        with self._lock:
+            cur = self._connect().execute(sql, params)
+            if fetch == 'one':
+                return cur.fetchone()
+            if fetch == 'all':
+                return cur.fetchall()
+            return None
+
+    def _migrate_pickle(self):
+        """
+        One-shot import of an existing PicklePersistence file (single_file=True layout).
+        The pickle is renamed afterwards so this never runs twice.
+        """
+        if not self.migrate_from or not os.path.exists(self.migrate_from):
+            return
+        if self._conn.execute("SELECT 1 FROM kv WHERE key = 'migrated'").fetchone():
+            return
+
+        print(f"Migrating persistence from {self.migrate_from} to {self.filepath}...")
+        with open(self.migrate_from, 'rb') as f:
+            data = _LenientUnpickler(f).load()
+
+        conn = self._conn
+        conn.execute("BEGIN")
+        try:
+            for user_id, ud in (data.get('user_data') or {}).items():
+                conn.execute("INSERT OR REPLACE INTO user_data (id, data) VALUES (?, ?)", (user_id, _dumps(ud)))
+            for chat_id, cd in (data.get('chat_data') or {}).items():
+                conn.execute("INSERT OR REPLACE INTO chat_data (id, data) VALUES (?, ?)", (chat_id, _dumps(cd)))
+            if data.get('bot_data') is not None:
+                conn.execute("INSERT OR REPLACE INTO kv (key, data) VALUES ('bot_data', ?)", (_dumps(data['bot_data']),))
+            if data.get('callback_data') is not None:
+                conn.execute("INSERT OR REPLACE INTO kv (key, data) VALUES ('callback_data', ?)", (_dumps(data['callback_data']),))
+            for name, conv in (data.get('conversations') or {}).items():
+                for key, state in conv.items():
+                    conn.execute("INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                                 (name, _dumps(key), _dumps(state)))
+            conn.execute("INSERT OR REPLACE INTO kv (key, data) VALUES ('migrated', ?)", (_dumps(True),))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        os.replace(self.migrate_from, f"{self.migrate_from}.migrated")
+        print(f"Migrated {len(data.get('user_data') or {})} users.")
+
+    def _write_row(self, table, row_id, data):
+        blob = _dumps(data)
+        digest = _digest(blob)
+        if self._last_written.get((table, row_id)) == digest:
+            return # Unchanged since last write
+        self._execute(f"INSERT OR REPLACE INTO {table} (id, data) VALUES (?, ?)", (row_id, blob))
+        self._last_written[(table, row_id)] = digest
+
+    def _write_kv(self, key, data):
+        blob = _dumps(data)
+        digest = _digest(blob)
+        if self._last_written.get(('kv', key)) == digest:
+            return
+        self._execute("INSERT OR REPLACE INTO kv (key, data) VALUES (?, ?)", (key, blob))
+        self._last_written[('kv', key)] = digest
+
+    def _read_row(self, table, row_id):
+        row = self._execute(f"SELECT data FROM {table} WHERE id = ?", (row_id,), fetch='one')
+        if row is None:
+            return None
+        self._last_written[(table, row_id)] = _digest(row[0])
+        return pickle.loads(row[0])
+
+    def _read_kv(self, key):
+        row = self._execute("SELECT data FROM kv WHERE key = ?", (key,), fetch='one')
+        if row is None:
+            return None
+        self._last_written[('kv', key)] = _digest(row[0])
+        return pickle.loads(row[0])
+
+    # --- Loading ---
+
+    async def get_user_data(self):
+        # Loaded lazily per user in refresh_user_data
+        await asyncio.to_thread(self._execute, "SELECT 1")
+        return {}
+
+    async def get_chat_data(self):
+        await asyncio.to_thread(self._execute, "SELECT 1")
+        return {}
+
+    async def get_bot_data(self):
+        data = await asyncio.to_thread(self._read_kv, 'bot_data')
+        return data if data is not None else {}
+
+    async def get_callback_data(self):
+        return await asyncio.to_thread(self._read_kv, 'callback_data')
+
+    async def get_conversations(self, name):
+        rows = await asyncio.to_thread(
+            self._execute, "SELECT key, state FROM conversations WHERE name = ?", (name,), 'all')
+        return {pickle.loads(key): pickle.loads(state) for key, state in rows}
+
+    async def refresh_user_data(self, user_id, user_data):
+        if user_id in self._loaded_users:
+            return
+        stored = await asyncio.to_thread(self._read_row, 'user_data', user_id)
+        self._loaded_users.add(user_id)
+        if stored:
+            # Anything set before the row was loaded wins over the stored value
+            for key, value in stored.items():
+                user_data.setdefault(key, value)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        if chat_id in self._loaded_chats:
+            return
+        stored = await asyncio.to_thread(self._read_row, 'chat_data', chat_id)
+        self._loaded_chats.add(chat_id)
+        if stored:
+            for key, value in stored.items():
+                chat_data.setdefault(key, value)
+
+    async def refresh_bot_data(self, bot_data):
+        pass # bot_data is loaded once at startup and only changed in-process
+
+    # --- Writing ---
+
+    async def update_user_data(self, user_id, data):
+        if user_id not in self._loaded_users:
+            # Never overwrite a stored row with data we have not merged yet
+            await self.refresh_user_data(user_id, data)
+        await asyncio.to_thread(self._write_row, 'user_data', user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        if chat_id not in self._loaded_chats:
+            await self.refresh_chat_data(chat_id, data)
+        await asyncio.to_thread(self._write_row, 'chat_data', chat_id, data)
+
+    async def update_bot_data(self, data):
+        await asyncio.to_thread(self._write_kv, 'bot_data', data)
+
+    async def update_callback_data(self, data):
+        await asyncio.to_thread(self._write_kv, 'callback_data', data)
+
+    async def update_conversation(self, name, key, new_state):
+        if new_state is None:
+            await asyncio.to_thread(self._execute, "DELETE FROM conversations WHERE name = ? AND key = ?",
+                                    (name, _dumps(key)))
+        else:
+            await asyncio.to_thread(self._execute,
+                                    "INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                                    (name, _dumps(key), _dumps(new_state)))
+
+    async def drop_user_data(self, user_id):
+        self._loaded_users.discard(user_id)
+        self._last_written.pop(('user_data', user_id), None)
+        await asyncio.to_thread(self._execute, "DELETE FROM user_data WHERE id = ?", (user_id,))
+
+    async def drop_chat_data(self, chat_id):
+        self._loaded_chats.discard(chat_id)
+        self._last_written.pop(('chat_data', chat_id), None)
+        await asyncio.to_thread(self._execute, "DELETE FROM chat_data WHERE id = ?", (chat_id,))
+
+    async def flush(self):
+        # Rows are written as they change; just checkpoint the WAL and close.
+        def _close():
+            with self._lock:
+                if self._conn is not None:
+                    self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                    self._conn.close()
+                    self._conn = None
+        await asyncio.to_thread(_close)
@@ -0,0 +1,53 @@
+import asyncio
+import time
+from contextlib import contextmanager
+
+# Cold start timing. Each phase (imports, Application.initialize, post_init, ...) is
+# recorded as it finishes; report() prints the breakdown once the service accepts
+# traffic, and stats() feeds /stats and /metrics.
+
+STARTED = time.monotonic()
+
+_phases = {}     # name -> seconds, in the order they finished
+_ready = None    # seconds from STARTED until traffic was accepted
+_tasks = set()   # background warm-up tasks (kept referenced until done)
+
+def record(name, started):
+    _phases[name] = time.monotonic() - started
+
+@contextmanager
+def phase(name):
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        record(name, started)
+
+def background(name, coro):
+    """
+    Runs a warm-up step after startup without delaying traffic; its time is recorded as `name`.
+    """
+    async def _run():
+        started = time.monotonic()
+        try:
+            await coro
+        except Exception as e:
+            print(f"Warm-up step {name} failed: {e}")
+        record(name, started)
+        print(f"Startup: {name} warmed up in background in {_phases[name]:.2f}s")
+
+    task = asyncio.ensure_future(_run())
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+def ready():
+    """
+    Marks the service as accepting traffic and prints the startup breakdown.
+    """
+    global _ready
+    _ready = time.monotonic() - STARTED
+    print("Startup: ready in {:.2f}s ({})".format(
+        _ready, ", ".join(f"{name} {seconds:.2f}s" for name, seconds in _phases.items())))
+
+def stats():
+    return {'ready': _ready, 'phases': dict(_phases)}
@@ -0,0 +1,424 @@
+import config
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+import uuid
+
+# State that must be shared by every gunicorn worker: daily credits, the "already
+# processing" lock, the spam window, the ban list, the known users (for /sendmsgall),
+# violation counts and small JSON values (broadcast checkpoint, last result per user).
+# bot_data/user_data are per process, so nothing above may live there.
+# Two implementations: SQLite (single host, many workers) and Redis (many hosts).
+
+class StateBackend:
+    """
+    Interface used by handlers_user, handlers_admin and db_helpers.
+    """
+
+    async def take_credits(self, user_id, day, daily_limit, amount=1):
+        """
+        Atomically takes up to `amount` credits for `day`. Returns (granted, remaining).
+        """
+        raise NotImplementedError
+
+    async def refund_credits(self, user_id, day, daily_limit, amount=1):
+        raise NotImplementedError
+
+    async def get_credits(self, user_id, day, daily_limit):
+        raise NotImplementedError
+
+    async def acquire_lock(self, key, lease):
+        """
+        Returns an owner token if the lock was acquired, None if someone else holds it.
+        The lock expires after `lease` seconds even if never released.
+        """
+        raise NotImplementedError
+
+    async def release_lock(self, key, token):
+        raise NotImplementedError
+
+    async def renew_lock(self, key, token, lease):
+        """
+        Extends a held lock to `lease` seconds from now. Returns False if it was lost.
+        """
+        raise NotImplementedError
+
+    async def hit_window(self, key, window):
+        """
+        Records one event now and returns how many events fell in the last `window` seconds.
+        """
+        raise NotImplementedError
+
+    async def set_banned(self, user_id, banned):
+        raise NotImplementedError
+
+    async def is_banned(self, user_id):
+        raise NotImplementedError
+
+    async def banned_users(self):
+        raise NotImplementedError
+
+    async def add_user(self, user_id):
+        raise NotImplementedError
+
+    async def remove_user(self, user_id):
+        raise NotImplementedError
+
+    async def user_ids(self):
+        raise NotImplementedError
+
+    async def add_violations(self, user_id, count):
+        """
+        Adds `count` violations and returns the user's new total.
+        """
+        raise NotImplementedError
+
+    async def get_violations(self, user_id):
+        raise NotImplementedError
+
+    async def seed_violations(self, user_id, count):
+        """
+        Sets the count only if none is recorded yet (migrating old per-process counts).
+        """
+        raise NotImplementedError
+
+    async def get_value(self, key):
+        """
+        Returns the JSON value stored under `key`, or None.
+        """
+        raise NotImplementedError
+
+    async def set_value(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    async def delete_value(self, key):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS credits (user_id INTEGER PRIMARY KEY, day TEXT NOT NULL, remaining INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS locks (key TEXT PRIMARY KEY, token TEXT NOT NULL, expires REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS window_events (key TEXT NOT NULL, ts REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS window_events_key_ts ON window_events (key, ts);
+CREATE TABLE IF NOT EXISTS bans (user_id INTEGER PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS violations (user_id INTEGER PRIMARY KEY, count INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL);
+"""
+
+class SQLiteStateBackend(StateBackend):
+    """
+    File-backed state for several worker processes on one host.
+    Every operation is one IMMEDIATE transaction, so it is atomic across processes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SQLITE_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def _tx(self, fn, *args):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(conn, *args)
+                conn.execute("COMMIT")
+                return result
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    async def _run(self, fn, *args):
+        return await asyncio.to_thread(self._tx, fn, *args)
+
+    # --- Credits ---
+
+    @staticmethod
+    def _remaining(conn, user_id, day, daily_limit):
+        row = conn.execute("SELECT day, remaining FROM credits WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None or row[0] != day:
+            return daily_limit # New day, fresh credits
+        return row[1]
+
+    async def take_credits(self, user_id, day, daily_limit, amount=1):
+        def fn(conn):
+            remaining = self._remaining(conn, user_id, day, daily_limit)
+            granted = max(0, min(amount, remaining))
+            conn.execute("INSERT OR REPLACE INTO credits (user_id, day, remaining) VALUES (?, ?, ?)",
+                         (user_id, day, remaining - granted))
+            return granted, remaining - granted
+        return await self._run(fn)
+
+    async def refund_credits(self, user_id, day, daily_limit, amount=1):
+        def fn(conn):
+            remaining = min(daily_limit, self._remaining(conn, user_id, day, daily_limit) + amount)
+            conn.execute("INSERT OR REPLACE INTO credits (user_id, day, remaining) VALUES (?, ?, ?)",
+                         (user_id, day, remaining))
+            return remaining
+        return await self._run(fn)
+
+    async def get_credits(self, user_id, day, daily_limit):
+        return await self._run(lambda conn: self._remaining(conn, user_id, day, daily_limit))
+
+    # --- Locks ---
+
+    async def acquire_lock(self, key, lease):
+        token = uuid.uuid4().hex
+        def fn(conn):
+            now = time.time()
+            conn.execute("DELETE FROM locks WHERE key = ? AND expires < ?", (key, now))
+            cur = conn.execute("INSERT OR IGNORE INTO locks (key, token, expires) VALUES (?, ?, ?)",
+                               (key, token, now + lease))
+            return token if cur.rowcount == 1 else None
+        return await self._run(fn)
+
+    async def release_lock(self, key, token):
+        await self._run(lambda conn: conn.execute("DELETE FROM locks WHERE key = ? AND token = ?", (key, token)))
+
+    async def renew_lock(self, key, token, lease):
+        def fn(conn):
+            now = time.time()
+            cur = conn.execute("UPDATE locks SET expires = ? WHERE key = ? AND token = ? AND expires >= ?",
+                               (now + lease, key, token, now))
+            return cur.rowcount == 1
+        return await self._run(fn)
+
+    # --- Sliding window ---
+
+    async def hit_window(self, key, window):
+        def fn(conn):
+            now = time.time()
+            conn.execute("DELETE FROM window_events WHERE key = ? AND ts < ?", (key, now - window))
+            conn.execute("INSERT INTO window_events (key, ts) VALUES (?, ?)", (key, now))
+            return conn.execute("SELECT COUNT(*) FROM window_events WHERE key = ?", (key,)).fetchone()[0]
+        return await self._run(fn)
+
+    # --- Bans ---
+
+    async def set_banned(self, user_id, banned):
+        if banned:
+            sql = "INSERT OR IGNORE INTO bans (user_id) VALUES (?)"
+        else:
+            sql = "DELETE FROM bans WHERE user_id = ?"
+        await self._run(lambda conn: conn.execute(sql, (user_id,)))
+
+    async def is_banned(self, user_id):
+        return await self._run(
+            lambda conn: conn.execute("SELECT 1 FROM bans WHERE user_id = ?", (user_id,)).fetchone() is not None)
+
+    async def banned_users(self):
+        return await self._run(lambda conn: {row[0] for row in conn.execute("SELECT user_id FROM bans")})
+
+    # --- Users ---
+
+    async def add_user(self, user_id):
+        await self._run(lambda conn: conn.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,)))
+
+    async def remove_user(self, user_id):
+        await self._run(lambda conn: conn.execute("DELETE FROM users WHERE user_id = ?", (user_id,)))
+
+    async def user_ids(self):
+        return await self._run(lambda conn: {row[0] for row in conn.execute("SELECT user_id FROM users")})
+
+    # --- Violations ---
+
+    async def add_violations(self, user_id, count):
+        def fn(conn):
+            conn.execute("INSERT INTO violations (user_id, count) VALUES (?, ?) "
+                         "ON CONFLICT (user_id) DO UPDATE SET count = count + excluded.count", (user_id, count))
+            return conn.execute("SELECT count FROM violations WHERE user_id = ?", (user_id,)).fetchone()[0]
+        return await self._run(fn)
+
+    async def get_violations(self, user_id):
+        def fn(conn):
+            row = conn.execute("SELECT count FROM violations WHERE user_id = ?", (user_id,)).fetchone()
+            return row[0] if row else 0
+        return await self._run(fn)
+
+    async def seed_violations(self, user_id, count):
+        await self._run(lambda conn: conn.execute(
+            "INSERT OR IGNORE INTO violations (user_id, count) VALUES (?, ?)", (user_id, count)))
+
+    # --- JSON values ---
+
+    async def get_value(self, key):
+        def fn(conn):
+            row = conn.execute("SELECT value, expires FROM kv WHERE key = ?", (key,)).fetchone()
+            if row is None or (row[1] is not None and row[1] < time.time()):
+                return None
+            return json.loads(row[0])
+        return await self._run(fn)
+
+    async def set_value(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        await self._run(lambda conn: conn.execute(
+            "INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)", (key, json.dumps(value), expires)))
+
+    async def delete_value(self, key):
+        await self._run(lambda conn: conn.execute("DELETE FROM kv WHERE key = ?", (key,)))
+
+    async def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+# Lua scripts keep each operation atomic on the Redis side
+_TAKE_CREDITS = """
+local remaining = tonumber(redis.call('GET', KEYS[1]) or ARGV[1])
+local granted = math.max(0, math.min(tonumber(ARGV[2]), remaining))
+redis.call('SET', KEYS[1], remaining - granted, 'EX', 172800)
+return {granted, remaining - granted}
+"""
+_REFUND_CREDITS = """
+local remaining = tonumber(redis.call('GET', KEYS[1]) or ARGV[1])
+remaining = math.min(tonumber(ARGV[1]), remaining + tonumber(ARGV[2]))
+redis.call('SET', KEYS[1], remaining, 'EX', 172800)
+return remaining
+"""
+_RELEASE_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+_RENEW_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+class RedisStateBackend(StateBackend):
+    """
+    Redis (or any Redis-compatible server) backed state for multiple hosts.
+    """
+
+    def __init__(self, url):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("STATE_BACKEND_URL is redis:// but the 'redis' package is not installed.")
+        self.redis = redis.from_url(url, decode_responses=True)
+
+    @staticmethod
+    def _credits_key(user_id, day):
+        return f"credits:{user_id}:{day}"
+
+    async def take_credits(self, user_id, day, daily_limit, amount=1):
+        granted, remaining = await self.redis.eval(
+            _TAKE_CREDITS, 1, self._credits_key(user_id, day), daily_limit, amount)
+        return int(granted), int(remaining)
+
+    async def refund_credits(self, user_id, day, daily_limit, amount=1):
+        return int(await self.redis.eval(
+            _REFUND_CREDITS, 1, self._credits_key(user_id, day), daily_limit, amount))
+
+    async def get_credits(self, user_id, day, daily_limit):
+        value = await self.redis.get(self._credits_key(user_id, day))
+        return daily_limit if value is None else int(value)
+
+    async def acquire_lock(self, key, lease):
+        token = uuid.uuid4().hex
+        acquired = await self.redis.set(f"lock:{key}", token, nx=True, ex=lease)
+        return token if acquired else None
+
+    async def release_lock(self, key, token):
+        await self.redis.eval(_RELEASE_LOCK, 1, f"lock:{key}", token)
+
+    async def renew_lock(self, key, token, lease):
+        return bool(await self.redis.eval(_RENEW_LOCK, 1, f"lock:{key}", token, lease))
+
+    async def hit_window(self, key, window):
+        now = time.time()
+        redis_key = f"window:{key}"
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zremrangebyscore(redis_key, 0, now - window)
+            pipe.zadd(redis_key, {f"{now}:{uuid.uuid4().hex[:8]}": now})
+            pipe.zcard(redis_key)
+            pipe.expire(redis_key, int(window) + 1)
+            results = await pipe.execute()
+        return int(results[2])
+
+    async def set_banned(self, user_id, banned):
+        if banned:
+            await self.redis.sadd("bans", user_id)
+        else:
+            await self.redis.srem("bans", user_id)
+
+    async def is_banned(self, user_id):
+        return bool(await self.redis.sismember("bans", user_id))
+
+    async def banned_users(self):
+        return {int(user_id) for user_id in await self.redis.smembers("bans")}
+
+    async def add_user(self, user_id):
+        await self.redis.sadd("users", user_id)
+
+    async def remove_user(self, user_id):
+        await self.redis.srem("users", user_id)
+
+    async def user_ids(self):
+        return {int(user_id) for user_id in await self.redis.smembers("users")}
+
+    async def add_violations(self, user_id, count):
+        return int(await self.redis.hincrby("violations", user_id, count))
+
+    async def get_violations(self, user_id):
+        return int(await self.redis.hget("violations", user_id) or 0)
+
+    async def seed_violations(self, user_id, count):
+        await self.redis.hsetnx("violations", user_id, count)
+
+    async def get_value(self, key):
+        value = await self.redis.get(f"value:{key}")
+        return None if value is None else json.loads(value)
+
+    async def set_value(self, key, value, ttl=None):
+        await self.redis.set(f"value:{key}", json.dumps(value), ex=ttl or None)
+
+    async def delete_value(self, key):
+        await self.redis.delete(f"value:{key}")
+
+    async def close(self):
+        await self.redis.aclose()
+
+
+_backend = None
+
+def get():
+    """
+    Returns the process-wide backend selected by STATE_BACKEND_URL.
+    """
+    global _backend
+    if _backend is None:
+        url = config.STATE_BACKEND_URL
+        if url.startswith(('redis://', 'rediss://', 'unix://')):
+            _backend = RedisStateBackend(url)
+        elif url.startswith('sqlite:///'):
+            _backend = SQLiteStateBackend(url[len('sqlite:///'):])
+        else:
+            raise ValueError(f"Unsupported STATE_BACKEND_URL: {url}")
+    return _backend
+
+async def close():
+    global _backend
+    if _backend is not None:
+        await _backend.close()
+        _backend = None
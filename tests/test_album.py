@@ -0,0 +1,62 @@
+import asyncio
+
+from telegram import Update
+
+import album
+import config
+from update_processor import UserOrderedUpdateProcessor
+
+# Albums must be processed as one batch even when they arrive while the user's
+# turn is taken (a photo still processing, or another album just before).
+
+def _update(message_id, media_group_id=None, user_id=1):
+    message = {'message_id': message_id, 'date': 0, 'chat': {'id': user_id, 'type': 'private'},
+               'from': {'id': user_id, 'is_bot': False, 'first_name': 'u'}, 'photo': []}
+    if media_group_id:
+        message['media_group_id'] = media_group_id
+    return Update.de_json({'update_id': message_id, 'message': message}, None)
+
+def _run(arrivals, monkeypatch):
+    """
+    Feeds (message_id, media_group_id) updates 10 ms apart and returns the batches handled.
+    """
+    monkeypatch.setattr(config, 'ALBUM_WINDOW', 0.2)
+    batches = []
+
+    async def process(updates, context):
+        batches.append([u.message.message_id for u in updates])
+
+    async def handle(update):
+        if update.message.media_group_id:
+            await album.collect(update, None, process)
+        else:
+            await asyncio.sleep(0.5) # A single photo still processing
+            batches.append(['single', update.message.message_id])
+
+    async def main():
+        processor = UserOrderedUpdateProcessor(4, 100)
+        await processor.initialize()
+        tasks = []
+        for message_id, group_id in arrivals:
+            update = _update(message_id, group_id)
+            tasks.append(asyncio.create_task(processor.process_update(update, handle(update))))
+            await asyncio.sleep(0.01)
+        await asyncio.gather(*tasks)
+        assert not album._groups
+    asyncio.run(main())
+    return batches
+
+def test_album_alone_is_one_batch(monkeypatch):
+    assert _run([(1, 'a'), (2, 'a'), (3, 'a')], monkeypatch) == [[1, 2, 3]]
+
+def test_album_while_photo_is_processing(monkeypatch):
+    arrivals = [(10, None), (11, 'a'), (12, 'a'), (13, 'a')]
+    assert _run(arrivals, monkeypatch) == [['single', 10], [11, 12, 13]]
+
+def test_albums_back_to_back(monkeypatch):
+    arrivals = [(1, 'a'), (2, 'a'), (3, 'a'), (4, 'b'), (5, 'b'), (6, 'b')]
+    assert _run(arrivals, monkeypatch) == [[1, 2, 3], [4, 5, 6]]
+
+def test_later_update_waits_for_album(monkeypatch):
+    arrivals = [(1, 'a'), (2, 'a'), (3, None)]
+    assert _run(arrivals, monkeypatch) == [[1, 2], ['single', 3]]
@@ -0,0 +1,143 @@
+import asyncio
+import os
+
+import pytest
+
+import state_backend
+
+# Every test runs against both backends. Redis uses a real server when TEST_REDIS_URL
+# is set (it is flushed), otherwise fakeredis (with lupa for the Lua scripts).
+
+def _sqlite(tmp_path):
+    return state_backend.SQLiteStateBackend(str(tmp_path / 'state.sqlite3'))
+
+def _redis():
+    url = os.getenv('TEST_REDIS_URL')
+    if url:
+        backend = state_backend.RedisStateBackend(url)
+        asyncio.run(backend.redis.flushdb())
+        # The client's connections belong to the loop above; start with fresh ones
+        backend = state_backend.RedisStateBackend(url)
+        return backend
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')
+    backend = state_backend.RedisStateBackend('redis://localhost')
+    backend.redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+    return backend
+
+@pytest.fixture(params=['sqlite', 'redis'])
+def backend(request, tmp_path):
+    if request.param == 'sqlite':
+        return _sqlite(tmp_path)
+    pytest.importorskip('redis')
+    return _redis()
+
+def run(backend, coro):
+    async def main():
+        try:
+            return await coro
+        finally:
+            await backend.close()
+    return asyncio.run(main())
+
+# --- Credits ---
+
+def test_take_credits_grants_up_to_remaining(backend):
+    async def scenario():
+        first = await backend.take_credits(1, '2024-01-01', 3, 2)
+        second = await backend.take_credits(1, '2024-01-01', 3, 2)
+        third = await backend.take_credits(1, '2024-01-01', 3)
+        return first, second, third
+    assert run(backend, scenario()) == ((2, 1), (1, 0), (0, 0))
+
+def test_take_credits_new_day_is_fresh(backend):
+    async def scenario():
+        await backend.take_credits(1, '2024-01-01', 3, 3)
+        return await backend.take_credits(1, '2024-01-02', 3), await backend.get_credits(1, '2024-01-02', 3)
+    assert run(backend, scenario()) == ((1, 2), 2)
+
+def test_refund_credits_capped_at_daily_limit(backend):
+    async def scenario():
+        await backend.take_credits(1, '2024-01-01', 3, 2)
+        refunded = await backend.refund_credits(1, '2024-01-01', 3)
+        capped = await backend.refund_credits(1, '2024-01-01', 3, 5)
+        return refunded, capped, await backend.get_credits(1, '2024-01-01', 3)
+    assert run(backend, scenario()) == (2, 3, 3)
+
+def test_concurrent_takes_never_overdraw(backend):
+    async def scenario():
+        results = await asyncio.gather(*(backend.take_credits(1, '2024-01-01', 3) for _ in range(10)))
+        return sum(granted for granted, _ in results), await backend.get_credits(1, '2024-01-01', 3)
+    assert run(backend, scenario()) == (3, 0)
+
+# --- Locks ---
+
+def test_lock_is_exclusive_until_released(backend):
+    async def scenario():
+        token = await backend.acquire_lock('user:1', 30)
+        while_held = await backend.acquire_lock('user:1', 30)
+        await backend.release_lock('user:1', 'not-the-owner')
+        after_wrong_release = await backend.acquire_lock('user:1', 30)
+        await backend.release_lock('user:1', token)
+        after_release = await backend.acquire_lock('user:1', 30)
+        return token, while_held, after_wrong_release, after_release
+    token, while_held, after_wrong_release, after_release = run(backend, scenario())
+    assert token and while_held is None and after_wrong_release is None and after_release
+
+def test_lock_lease_expires(backend):
+    async def scenario():
+        token = await backend.acquire_lock('user:1', 1)
+        await asyncio.sleep(2.1)
+        takeover = await backend.acquire_lock('user:1', 30)
+        renewed_by_old_owner = await backend.renew_lock('user:1', token, 30)
+        return token, takeover, renewed_by_old_owner
+    token, takeover, renewed_by_old_owner = run(backend, scenario())
+    assert token and takeover and takeover != token
+    assert not renewed_by_old_owner
+
+def test_renew_lock_extends_lease(backend):
+    async def scenario():
+        token = await backend.acquire_lock('broadcast', 2)
+        await asyncio.sleep(1)
+        renewed = await backend.renew_lock('broadcast', token, 3)
+        await asyncio.sleep(1.5)
+        return renewed, await backend.acquire_lock('broadcast', 30)
+    renewed, other = run(backend, scenario())
+    assert renewed and other is None
+
+# --- Sliding window ---
+
+def test_hit_window_counts_recent_events(backend):
+    async def scenario():
+        counts = [await backend.hit_window('photos:1', 1) for _ in range(3)]
+        other_key = await backend.hit_window('photos:2', 1)
+        await asyncio.sleep(1.2)
+        counts.append(await backend.hit_window('photos:1', 1))
+        return counts, other_key
+    assert run(backend, scenario()) == ([1, 2, 3, 1], 1)
+
+# --- Users, violations, values ---
+
+def test_users_and_violations(backend):
+    async def scenario():
+        await backend.add_user(1)
+        await backend.add_user(2)
+        await backend.add_user(1)
+        await backend.remove_user(2)
+        await backend.seed_violations(1, 2)
+        await backend.seed_violations(1, 4) # Already recorded, ignored
+        total = await backend.add_violations(1, 1)
+        return await backend.user_ids(), total, await backend.get_violations(1), await backend.get_violations(2)
+    assert run(backend, scenario()) == ({1}, 3, 3, 0)
+
+def test_values_round_trip_and_expire(backend):
+    async def scenario():
+        await backend.set_value('broadcast', {'next_index': 10, 'user_ids': [1, 2]})
+        await backend.set_value('last:1', {'ref': 'abc'}, ttl=1)
+        stored = await backend.get_value('broadcast'), await backend.get_value('last:1')
+        await asyncio.sleep(1.2)
+        await backend.delete_value('broadcast')
+        return stored, await backend.get_value('broadcast'), await backend.get_value('last:1')
+    stored, deleted, expired = run(backend, scenario())
+    assert stored == ({'next_index': 10, 'user_ids': [1, 2]}, {'ref': 'abc'})
+    assert deleted is None and expired is None
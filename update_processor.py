@@ -0,0 +1,86 @@
+import asyncio
+import album
+import diagnostics
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# Updates from different users run in parallel (up to MAX_CONCURRENT_UPDATES);
+# updates from the same user run strictly one after another, in arrival order.
+# E.g. a photo followed by a convert_JPG press always runs photo first.
+
+# The base class semaphore only caps the total backlog; the real concurrency
+# limit is taken after the per-user lock, so queued updates of a busy user
+# do not occupy processing slots.
+_BACKLOG_LIMIT = 10_000
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+
+    def __init__(self, max_concurrent_updates, user_backlog):
+        super().__init__(_BACKLOG_LIMIT)
+        self.limit = max_concurrent_updates
+        self.user_backlog = user_backlog
+        self._slots = None
+        self._users = {}   # key -> [asyncio.Lock, queued count]
+
+    @staticmethod
+    def _key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        if album.is_open(update):
+            # Joins an album whose first photo already holds this user's turn (see album.py)
+            await coroutine
+            return
+
+        key = self._key(update)
+        if key is None:
+            await self._run(update, coroutine)
+            return
+
+        entry = self._users.get(key)
+        if entry is None:
+            entry = self._users[key] = [asyncio.Lock(), 0]
+        if entry[1] >= self.user_backlog:
+            # Someone is flooding us; their earlier updates are still queued
+            print(f"Dropping update from {key}: {entry[1]} updates already queued")
+            coroutine.close()
+            return
+
+        # An album's first photo opens its group now, so the rest of the album joins it
+        # even while this update waits for the user's turn
+        album.register(update)
+        entry[1] += 1
+        try:
+            async with entry[0]:   # FIFO, so per-user order is kept
+                await self._run(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._users[key]
+            album.discard(update)
+
+    async def _run(self, update, coroutine):
+        async with self._slots:
+            # Handling time starts once the update holds a slot (see diagnostics)
+            key = diagnostics.update_started(update)
+            try:
+                await coroutine
+            finally:
+                diagnostics.update_finished(key)
+
+    def queued(self):
+        """
+        Updates accepted for processing (running or waiting for their user's turn).
+        """
+        return sum(entry[1] for entry in self._users.values())
+
+    async def initialize(self):
+        self._slots = asyncio.Semaphore(self.limit)
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,96 @@
+import config
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# Bounded pool for CPU-heavy Pillow work, so the event loop keeps serving other users.
+# Admission is by pixel budget: a job reserves width*height pixels before it may run.
+
+_executor = None
+_budget_cond = None
+_pixels_in_use = 0
+
+_stats = {
+    'waiting': 0,
+    'running': 0,
+    'max_waiting': 0,
+}
+_timings = {}   # label -> {'count', 'total', 'max'}
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        if config.CONVERT_POOL_KIND == 'process':
+            _executor = ProcessPoolExecutor(max_workers=config.CONVERT_POOL_WORKERS)
+        else:
+            _executor = ThreadPoolExecutor(max_workers=config.CONVERT_POOL_WORKERS,
+                                           thread_name_prefix='convert')
+    return _executor
+
+def _get_cond():
+    global _budget_cond
+    if _budget_cond is None:
+        _budget_cond = asyncio.Condition()
+    return _budget_cond
+
+def _record(label, elapsed):
+    t = _timings.setdefault(label, {'count': 0, 'total': 0.0, 'max': 0.0})
+    t['count'] += 1
+    t['total'] += elapsed
+    t['max'] = max(t['max'], elapsed)
+
+async def run(pixels, func, *args, label='job'):
+    """
+    Runs func(*args) in the pool once `pixels` fit in the budget.
+    An image larger than the whole budget is admitted alone.
+    """
+    global _pixels_in_use
+    pixels = min(max(int(pixels), 1), config.CONVERT_PIXEL_BUDGET)
+    cond = _get_cond()
+
+    _stats['waiting'] += 1
+    _stats['max_waiting'] = max(_stats['max_waiting'], _stats['waiting'])
+    try:
+        async with cond:
+            await cond.wait_for(lambda: _pixels_in_use + pixels <= config.CONVERT_PIXEL_BUDGET)
+            _pixels_in_use += pixels
+    finally:
+        _stats['waiting'] -= 1
+
+    _stats['running'] += 1
+    start = time.perf_counter()
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_get_executor(), func, *args)
+    finally:
+        _record(label, time.perf_counter() - start)
+        _stats['running'] -= 1
+        async with cond:
+            _pixels_in_use -= pixels
+            cond.notify_all()
+
+async def warm_up(func):
+    """
+    Starts the pool's workers and runs func() once per worker, outside the pixel budget.
+    Used after startup to load Pillow before the first photo arrives.
+    """
+    loop = asyncio.get_running_loop()
+    executor = _get_executor()
+    await asyncio.gather(*(loop.run_in_executor(executor, func) for _ in range(config.CONVERT_POOL_WORKERS)))
+
+def stats():
+    """
+    Queue depth, budget usage and per-label encode times (seconds), for sizing the pool.
+    """
+    return dict(_stats,
+                pixels_in_use=_pixels_in_use,
+                pixel_budget=config.CONVERT_PIXEL_BUDGET,
+                workers=config.CONVERT_POOL_WORKERS,
+                timings={label: dict(t, avg=t['total'] / t['count'])
+                         for label, t in _timings.items()})
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None